@@ -0,0 +1,142 @@
+"""
+Compares sending every message on its own against batching bursts of them, for
+a busy channel. Each event is turned into a socket.io packet and written to a
+real socket, like a websocket frame would be, so the number of sends is the
+number of syscalls the server would make.
+
+Run it from the root of the repository:
+    python benchmarks/batching.py [clients] [messages] [messages a second]
+"""
+
+import asyncio
+import json
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, "server")
+
+from broadcast import Broadcaster, MessageBatcher  # noqa: E402
+
+
+class Packet:
+    """
+    Just enough of socketio.Packet, encoding an event the way socket.io does.
+    """
+
+    def __init__(self, packet_type: int, data: list, namespace: str | None = None):
+        self.packet_type = packet_type
+        self.data = data
+
+    def encode(self) -> str:
+        return str(self.packet_type) + json.dumps(self.data, separators=(",", ":"))
+
+
+class SocketServer:
+    """
+    Just enough of socketio.AsyncServer for the broadcaster. Every client has a
+    socket, and a thread on the other end throws away whatever it's sent. It
+    stands in for socket.io's manager and engine.io server too.
+    """
+
+    packet_class = Packet
+
+    def __init__(self, clients: int):
+        self.sockets = {}
+        self.sends = 0
+        self.bytes = 0
+        self.manager = self.eio = self
+
+        for i in range(clients):
+            ours, theirs = socket.socketpair()
+            self.sockets[f"sid{i}"] = ours
+            threading.Thread(target=self.drain, args=(theirs,), daemon=True).start()
+
+    @staticmethod
+    def drain(sock: socket.socket) -> None:
+        while sock.recv(1 << 16):
+            pass
+
+    def eio_sid_from_sid(self, sid: str, namespace: str) -> str:
+        return sid
+
+    async def send(self, sid: str, encoded: str) -> None:
+        packet = ("4" + encoded).encode()
+        self.sockets[sid].sendall(packet)
+        self.sends += 1
+        self.bytes += len(packet)
+
+    def close(self) -> None:
+        for sock in self.sockets.values():
+            sock.close()
+
+
+async def run(clients: int, messages: int, rate: float, window: float | None) -> dict:
+    sio = SocketServer(clients)
+    delivered = clients * messages
+    broadcaster = Broadcaster(sio, queue_size=messages + 1)
+    batcher = MessageBatcher(broadcaster, window)
+
+    for sid in sio.sockets:
+        broadcaster.add_client(sid)
+
+    message = {
+        "id": "370502957784911872",
+        "message": "hello there, how is everyone doing today?",
+        "markup": "hello there, how is everyone doing today?",
+        "author": {"username": "someone", "displayname": "Someone"},
+        "channel": "general",
+        "timestamp": 1704067200000,
+        "type": 0,
+        "revision": 0,
+    }
+
+    # Only the event loop's thread is timed, not the threads reading the sockets.
+    cpu = time.thread_time()
+    start = time.perf_counter()
+
+    for i in range(messages):
+        batcher.add("general", message)
+
+        # Send at the given rate, as near as the event loop can.
+        delay = start + (i + 1) / rate - time.perf_counter()
+        await asyncio.sleep(max(delay, 0))
+
+    # Wait for the last batch, then for every client to be sent everything.
+    while batcher.pending:
+        await asyncio.sleep(0.001)
+
+    await broadcaster.flush(60)
+
+    cpu = time.thread_time() - cpu
+    batcher.close()
+    await broadcaster.close()
+    sio.close()
+
+    return {
+        "sends": sio.sends / delivered,
+        "bytes": sio.bytes / delivered,
+        "cpu": cpu / delivered * 1_000_000,
+    }
+
+
+def main() -> None:
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rate = float(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    print(f"{clients} clients, {messages} messages at {rate:g} a second:")
+
+    modes = (("One at a time", None), ("10ms batches", 0.01), ("50ms batches", 0.05))
+
+    for label, window in modes:
+        result = asyncio.run(run(clients, messages, rate, window))
+        print(
+            f"    {label}: {result['sends']:.3f} sends, {result['bytes']:.0f} bytes "
+            f"and {result['cpu']:.1f} µs of CPU per delivered message"
+        )
+
+
+if __name__ == "__main__":
+    main()
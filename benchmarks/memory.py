@@ -0,0 +1,70 @@
+"""
+Measures how much memory connected users and processed messages take up.
+
+Run it from the root of the repository:
+    python benchmarks/memory.py [connections]
+"""
+
+import asyncio
+import sys
+import tracemalloc
+
+sys.path.insert(0, "server")
+
+from database import Message, User  # noqa: E402
+from objects import Context  # noqa: E402
+
+
+def measure_users(connections: int) -> float:
+    """
+    Get the bytes each connected user takes, not counting their strings.
+    """
+    names = [(f"user{i}", f"user{i}@test.test", f"sid{i}") for i in range(connections)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = [User(name, email, sid=sid) for name, email, sid in names]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert len(users) == connections
+    return (after - before) / connections
+
+
+async def measure_messages(count: int) -> tuple[float, float]:
+    """
+    Get the allocations and bytes each processed message holds onto, not
+    counting its content.
+    """
+    author = User("author", "author@test.test", sid="sid")
+    contents = [f"message number {i} with some words in it" for i in range(count)]
+    contexts = []
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    for content in contents:
+        contexts.append(await Context.from_message(None, Message(content, author)))
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+
+    return blocks / count, size / count
+
+
+def main() -> None:
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+
+    per_user = measure_users(connections)
+    blocks, size = asyncio.run(measure_messages(10_000))
+
+    print(f"{connections} connected users: {per_user:.0f} bytes per user")
+    print(f"Processed messages: {blocks:.1f} allocations, {size:.0f} bytes per message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Times the queries the server makes most often, against either storage backend.
+
+Run it from the root of the repository, with an SQLite path or a PostgreSQL URL:
+    python benchmarks/storage.py [database_url] [messages]
+
+By default it uses an in-memory SQLite database, so nothing is left behind.
+Point it at an empty database, since it adds its own users and messages.
+"""
+
+import asyncio
+import sys
+import time
+
+sys.path.insert(0, "server")
+
+from database import open_storage  # noqa: E402
+from snowflake import SnowflakeGenerator  # noqa: E402
+
+
+async def timed(name: str, count: int, run) -> None:
+    """
+    Run a query count times, and print how long each one took on average.
+    """
+    start = time.perf_counter()
+
+    for i in range(count):
+        await run(i)
+
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed / count * 1_000_000:.0f} µs per query ({count} queries)")
+
+
+async def main() -> None:
+    url = sys.argv[1] if len(sys.argv) > 1 else ":memory:"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+
+    storage = open_storage(url)
+    await storage.connect()
+
+    ids = SnowflakeGenerator(1)
+    sent = []
+
+    async def insert(i: int) -> None:
+        id = ids.next_id()
+        sent.append(id)
+        await storage.messages.insert(
+            {
+                "id": id,
+                "message": f"message number {i}",
+                "author": f"user{i % 100}",
+                "channel": "benchmark",
+                "created_at": int(time.time() * 1000),
+            }
+        )
+
+    async def create_user(i: int) -> None:
+        user = {
+            "username": f"benchmark{i}",
+            "email": f"benchmark{i}@test.test",
+            "permissions": 71,
+            "displayname": f"benchmark{i}",
+            "dob": "2000-01-01",
+        }
+        await storage.users.create(user, b"password", b"salt")
+
+    try:
+        await timed("Insert message", count, insert)
+        await timed(
+            "Recent messages",
+            count // 10,
+            lambda i: storage.messages.recent("benchmark", 50, sent[-1 - i]),
+        )
+        await timed(
+            "Messages after",
+            count // 10,
+            lambda i: storage.messages.after("benchmark", sent[i], 50),
+        )
+        await timed("Get message", count, lambda i: storage.messages.get(sent[i]))
+        await timed("Create user", count // 10, create_user)
+        await timed(
+            "Get user",
+            count,
+            lambda i: storage.users.get(f"benchmark{i % (count // 10)}"),
+        )
+    finally:
+        await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
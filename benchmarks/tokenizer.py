@@ -0,0 +1,82 @@
+"""
+Compares the single-pass tokenizer against splitting the content once for every
+thing we want out of it, which is how messages used to be parsed.
+
+Run it from the root of the repository:
+    python benchmarks/tokenizer.py [messages]
+"""
+
+import html
+import random
+import sys
+import timeit
+
+sys.path.insert(0, "server")
+
+from config import COMMAND_PREFIX  # noqa: E402
+from tokenizer import tokenize  # noqa: E402
+
+PLAIN = ["hello", "there", "the", "quick", "brown", "fox", "<b>x</b>", "and"]
+SPECIAL = ["@someone", "https://example.com/page"]
+
+
+def make_message(length: int, command: bool, special_every: int | None) -> str:
+    """
+    Make a message of about length characters out of random words, with a
+    mention or link every special_every words, if it's given.
+    """
+    words = [f"{COMMAND_PREFIX}remind"] if command else []
+
+    while sum(len(word) + 1 for word in words) < length:
+        special = special_every and len(words) % special_every == special_every - 1
+        words.append(random.choice(SPECIAL if special else PLAIN))
+
+    return " ".join(words)[:length]
+
+
+def split_each_time(content: str) -> tuple:
+    """
+    The old way: strip for the empty check, then split once for mentions,
+    once for the command, and once more for its arguments. The old way never
+    escaped anything, so that's added here to compare like with like.
+    """
+    if content.strip() == "":
+        return None
+
+    mentions = [word[1:] for word in content.split() if word.startswith("@")]
+    command = content.split()[0][1:] if content.startswith(COMMAND_PREFIX) else None
+    args = content.split()[1:] if command is not None else []
+
+    return command, args, mentions, html.escape(content)
+
+
+def measure(parse, messages: list[str]) -> float:
+    """
+    Get the best time it took to parse each message, in microseconds.
+    """
+    best = min(timeit.repeat(lambda: [parse(m) for m in messages], number=1, repeat=5))
+    return best / len(messages) * 1_000_000
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    random.seed(0)
+
+    scenarios = (
+        ("Plain text", None),
+        ("A mention or link every 40 words", 40),
+        ("Mostly mentions and links", 3),
+    )
+
+    for label, special_every in scenarios:
+        messages = [
+            make_message(1000, i % 10 == 0, special_every) for i in range(count)
+        ]
+
+        print(f"{label}, 1000 character messages:")
+        print(f"    Split each time: {measure(split_each_time, messages):.1f} µs")
+        print(f"    Tokenizer: {measure(tokenize, messages):.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+File attachments. Uploads are streamed to disk a chunk at a time and hashed as
+they're written, then named by their SHA-256 hash, so a file that's uploaded
+many times is only stored once and a stored file never changes. That makes the
+hash a perfect ETag.
+
+    attachments/
+        ab/ab3f...        The files
+        thumbnails/ab/ab3f....jpg
+        tmp/              Uploads that haven't finished
+
+Thumbnails of images are made in a pool of processes, so resizing a big image
+never holds up the event loop. They need Pillow, and without it images are
+simply shown full size.
+"""
+
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import secrets
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterable, BinaryIO
+
+from clock import clock
+from config import (
+    ATTACHMENTS_DIR,
+    INLINE_CONTENT_TYPES,
+    MAX_ATTACHMENT_SIZE,
+    THUMBNAIL_PROCESSES,
+    THUMBNAIL_SIZE,
+)
+from errors import AttachmentTooLargeError
+from spans import span
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed for thumbnails
+    Image = None
+
+
+def new_attachment_id() -> int:
+    """
+    Make an ID for an attachment. Files are served to anyone who has their
+    link, so unlike message IDs, these are random, so they can't be guessed.
+    """
+    return secrets.randbits(63)
+
+
+def clean_filename(filename: str | None) -> str:
+    """
+    Make an uploaded file's name safe to show and to put in a header.
+    """
+    filename = os.path.basename((filename or "").replace("\\", "/")).strip()
+    filename = "".join(char for char in filename if char.isprintable() and char != '"')
+
+    return filename[:255] or "file"
+
+
+def is_inline(content_type: str) -> bool:
+    """
+    Whether a file can be shown in the browser, rather than downloaded.
+    """
+    return content_type in INLINE_CONTENT_TYPES
+
+
+def attachment_sendable(attachment: dict) -> dict:
+    """
+    Get an attachment in the format messages carry it in. Like message IDs,
+    the ID is a string, since JavaScript numbers can't hold it.
+    """
+    return {
+        "id": str(attachment["id"]),
+        "filename": attachment["filename"],
+        "content_type": attachment["content_type"],
+        "size": attachment["size"],
+        "thumbnail": bool(attachment["thumbnail"]),
+    }
+
+
+def make_thumbnail(source: str, destination: str, size: int) -> bool:
+    """
+    Shrink an image to fit in a square of size pixels, and save it as a JPEG.
+    This runs in the thumbnail processes. Returns whether it worked, since
+    plenty of files that say they're images aren't.
+    """
+    temporary = f"{destination}.{uuid.uuid4().hex}.tmp"
+
+    try:
+        with Image.open(source) as image:
+            image.thumbnail((size, size))
+
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            image.save(temporary, "JPEG", quality=80)
+
+        os.replace(temporary, destination)
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+        return False
+
+
+class AttachmentStore:
+    """
+    Keeps uploaded files and their thumbnails on disk.
+    """
+
+    def __init__(
+        self,
+        root: str = ATTACHMENTS_DIR,
+        max_size: int = MAX_ATTACHMENT_SIZE,
+        thumbnail_size: int = THUMBNAIL_SIZE,
+        processes: int = THUMBNAIL_PROCESSES,
+    ):
+        self.root = root
+        self.max_size = max_size
+        self.thumbnail_size = thumbnail_size
+        self.processes = processes
+        self.pool: ProcessPoolExecutor | None = (
+            None  # Started the first time it's needed
+        )
+        self.deduplicated = 0  # How many uploads were already stored
+
+    def path_of(self, hash: str) -> str:
+        return os.path.join(self.root, hash[:2], hash)
+
+    def thumbnail_path_of(self, hash: str) -> str:
+        return os.path.join(self.root, "thumbnails", hash[:2], f"{hash}.jpg")
+
+    async def save(self, chunks: AsyncIterable[bytes]) -> tuple[str, int]:
+        """
+        Write an upload to disk as it comes in, and get its hash and size.
+        Raises AttachmentTooLargeError as soon as it's too big, and nothing
+        is kept.
+        """
+        temporary = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(temporary), exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+
+        with span("attachments.save"):
+            try:
+                with open(temporary, "wb") as file:
+                    async for chunk in chunks:
+                        size += len(chunk)
+
+                        if size > self.max_size:
+                            raise AttachmentTooLargeError(
+                                f"Files can be up to {self.max_size // (1024 * 1024)}MB."
+                            )
+
+                        # Hashing and writing both let go of the GIL, so doing
+                        # them in a thread keeps the event loop free.
+                        await asyncio.to_thread(self._write, file, digest, chunk)
+
+                hash = digest.hexdigest()
+                path = self.path_of(hash)
+
+                if os.path.exists(path):
+                    self.deduplicated += 1
+                    os.remove(temporary)
+                else:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(temporary, path)
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+
+                raise
+
+        return hash, size
+
+    async def make_thumbnail(self, hash: str, content_type: str) -> bool:
+        """
+        Make a thumbnail of an image, if it doesn't have one already. Returns
+        whether the image has a thumbnail.
+        """
+        if Image is None or not content_type.startswith("image/"):
+            return False
+
+        destination = self.thumbnail_path_of(hash)
+
+        if os.path.exists(destination):
+            return True
+
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        if self.pool is None:
+            # Forking a process with threads running isn't safe, so the
+            # processes are started fresh.
+            self.pool = ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context("spawn")
+            )
+
+        with span("attachments.thumbnail"):
+            return await asyncio.get_running_loop().run_in_executor(
+                self.pool,
+                make_thumbnail,
+                self.path_of(hash),
+                destination,
+                self.thumbnail_size,
+            )
+
+    async def create(
+        self,
+        chunks: AsyncIterable[bytes],
+        filename: str | None,
+        content_type: str | None,
+        uploader: str,
+    ) -> dict:
+        """
+        Store an upload, and get the row to add for it.
+        """
+        hash, size = await self.save(chunks)
+        content_type = (
+            (content_type or "application/octet-stream").split(";")[0].strip().lower()
+        )
+
+        return {
+            "id": new_attachment_id(),
+            "hash": hash,
+            "filename": clean_filename(filename),
+            "content_type": content_type,
+            "size": size,
+            "uploader": uploader,
+            "created_at": clock.now(),
+            "thumbnail": await self.make_thumbnail(hash, content_type),
+        }
+
+    async def shutdown(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {"deduplicated": self.deduplicated}
+
+    @staticmethod
+    def _write(file: BinaryIO, digest: "hashlib._Hash", chunk: bytes) -> None:
+        digest.update(chunk)
+        file.write(chunk)
@@ -0,0 +1,54 @@
+"""
+A Bloom filter is a set that can only say "definitely not in here" or "maybe in
+here", in a fraction of the memory a real set would take. We keep one of every
+username that's taken, so checking whether a username is free usually doesn't
+need the database at all. Only a "maybe" has to be checked for real.
+"""
+
+import hashlib
+import math
+from typing import Iterable
+
+
+class BloomFilter:
+    """
+    A Bloom filter sized to hold capacity items while saying "maybe" for about
+    error_rate of the items that aren't in it. Adding more than capacity items
+    still works, it just says "maybe" more often.
+    """
+
+    def __init__(
+        self, capacity: int, error_rate: float = 0.01, items: Iterable[str] = ()
+    ):
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+        for item in items:
+            self.add(item)
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def stats(self) -> dict:
+        return {"items": self.count, "bytes": len(self.bits), "hashes": self.hashes}
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # Two halves of one hash are enough to make as many as we need.
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+
+        return ((first + i * second) % self.size for i in range(self.hashes))
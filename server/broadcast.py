@@ -0,0 +1,362 @@
+"""
+The broadcaster sends events to clients in the background, so whoever is sending
+a message doesn't have to wait for every client to receive it. Every client gets
+its own bounded queue, so one slow client can't make the server buffer forever.
+
+Each event is turned into a socket.io packet once, when it's published, and the
+same packet is written to every client it's for, like socket.io does for rooms.
+"""
+
+import asyncio
+from typing import TYPE_CHECKING, Collection
+
+from socketio import packet
+
+from spans import Span, current_span, span
+
+if TYPE_CHECKING:
+    from socketio import AsyncServer
+
+
+class ClientQueue:
+    """
+    The outbound queue of a single client, and the task that empties it.
+    """
+
+    def __init__(self, sid: str, size: int):
+        self.sid = sid
+        # Events are queued already encoded, with the span they were published
+        # in, if any.
+        self.queue: asyncio.Queue[tuple[str, list, Span | None]] = asyncio.Queue(size)
+        self.task: asyncio.Task | None = None
+        self.dropped = 0  # How many events this client never got
+        self.sent = 0  # How many events were sent to this client
+        # Whether events were dropped that the client hasn't been told about
+        self.gap = False
+        # Whether an event has been taken off the queue but not sent
+        self.sending = False
+
+
+class Broadcaster:
+    """
+    Owns the outbound queues of every connected client.
+
+    When a client's queue fills up, the policy decides what happens:
+    "drop" throws away the oldest event in the queue, and "disconnect"
+    kicks the client so it can reconnect and catch up from the history.
+    Clients that had events dropped are sent a "history_gap" event where
+    the events would have been, so they know to catch up too.
+    """
+
+    def __init__(self, sio: "AsyncServer", queue_size: int = 256, policy: str = "drop"):
+        if policy not in ("drop", "disconnect"):
+            raise ValueError(f"Unknown slow client policy: {policy}")
+
+        self.sio = sio
+        self.queue_size = queue_size
+        self.policy = policy
+        self.clients: dict[str, ClientQueue] = {}
+        self.dropped = 0
+        self.disconnected = 0
+        # Disconnects of clients that fell behind, which run in the background.
+        self.disconnecting: set[asyncio.Task] = set()
+
+    def add_client(self, sid: str) -> None:
+        """
+        Start sending events to a newly connected client.
+        """
+        if sid in self.clients:
+            return
+
+        client = ClientQueue(sid, self.queue_size)
+        client.task = asyncio.create_task(self._send_loop(client))
+        self.clients[sid] = client
+
+    async def remove_client(self, sid: str) -> None:
+        """
+        Stop sending events to a client. Anything still in its queue is thrown away.
+        """
+        client = self.clients.pop(sid, None)
+
+        if client is None or client.task is None:
+            return
+
+        if client.dropped:
+            print(f"{sid} left, after missing {client.dropped} events")
+
+        client.task.cancel()
+
+        try:
+            await client.task
+        except asyncio.CancelledError:
+            pass
+
+    def publish(
+        self, event: str, data: object, to: str | Collection[str] | None = None
+    ) -> None:
+        """
+        Queue an event for one client, a few clients, or everyone if to is None.
+        This never waits on a client.
+        """
+        if isinstance(to, str):
+            to = (to,)
+
+        # Sending happens later, in each client's task, so it's timed as part
+        # of whatever published the event.
+        parent = current_span.get()
+        clients = (
+            [self.clients[sid] for sid in to if sid in self.clients]
+            if to is not None
+            else list(self.clients.values())
+        )
+
+        if not clients:
+            return
+
+        packets = self._encode(event, data)
+
+        for client in clients:
+            self._enqueue(client, event, packets, parent)
+
+    def relay(
+        self, event: str, data: object, room: str, skip: Collection[str] = ()
+    ) -> None:
+        """
+        Send an event to a room through socket.io's message queue, so clients
+        connected to other servers get it too. Clients in skip are left out,
+        since they were already sent it through their queues.
+        """
+        task = asyncio.create_task(
+            self.sio.emit(event, data, room=room, skip_sid=list(skip))
+        )
+        task.add_done_callback(self._relayed)
+
+    async def close(self) -> None:
+        """
+        Stop sending events to every client.
+        """
+        for sid in list(self.clients):
+            await self.remove_client(sid)
+
+        await asyncio.gather(*self.disconnecting, return_exceptions=True)
+
+    async def flush(self, timeout: float) -> bool:
+        """
+        Wait until everything queued for every client has been sent. Returns
+        False if that took longer than timeout seconds.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while any(
+            client.queue.qsize() or client.sending for client in self.clients.values()
+        ):
+            if loop.time() >= deadline:
+                return False
+
+            await asyncio.sleep(0.01)
+
+        return True
+
+    def stats(self) -> dict:
+        """
+        Get numbers on how far behind clients are.
+        """
+        depths = [client.queue.qsize() for client in self.clients.values()]
+
+        return {
+            "clients": len(depths),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "queue_size": self.queue_size,
+            "policy": self.policy,
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+        }
+
+    def _relayed(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Failed to relay an event: {task.exception()}")
+
+    def _encode(self, event: str, data: object) -> list:
+        """
+        Turn an event into the packets that are written to a client. Events
+        with binary data take more than one.
+        """
+        encoded = self.sio.packet_class(
+            packet.EVENT, data=[event, data], namespace="/"
+        ).encode()
+
+        return encoded if isinstance(encoded, list) else [encoded]
+
+    def _enqueue(
+        self, client: ClientQueue, event: str, packets: list, parent: Span | None = None
+    ) -> None:
+        if not client.queue.full():
+            client.queue.put_nowait((event, packets, parent))
+            return
+
+        # The client has fallen too far behind.
+        if self.policy == "disconnect":
+            self.clients.pop(client.sid, None)
+            self.disconnected += 1
+
+            if client.task is not None:
+                client.task.cancel()
+
+            task = asyncio.create_task(self.sio.disconnect(client.sid))
+            self.disconnecting.add(task)
+            task.add_done_callback(self.disconnecting.discard)
+            print(f"Disconnected {client.sid}, since it fell too far behind")
+            return
+
+        if not client.dropped:
+            print(f"{client.sid} fell too far behind, so its oldest events are dropped")
+
+        client.queue.get_nowait()
+        client.queue.put_nowait((event, packets, parent))
+        client.gap = True
+        client.dropped += 1
+        self.dropped += 1
+
+    async def _send_loop(self, client: ClientQueue) -> None:
+        # The task was started inside the connecting client's span, which isn't
+        # what anything sent later belongs to.
+        current_span.set(None)
+
+        while True:
+            event, packets, parent = await client.queue.get()
+            client.sending = True
+
+            # socket.io keeps its own unbounded buffer for each connection. Don't
+            # pile more into it while it's still full, so slow clients back up
+            # into our bounded queue instead.
+            while self._transport_backlog(client.sid) >= self.queue_size:
+                await asyncio.sleep(0.05)
+
+            try:
+                with span("sio.emit", parent=parent, event=event, sid=client.sid):
+                    eio_sid = self.sio.manager.eio_sid_from_sid(client.sid, "/")
+
+                    # Whatever was dropped came before this event, and could've
+                    # been an edit or a delete as well as a message, so the
+                    # client has to be told to catch up before it gets this.
+                    if client.gap:
+                        client.gap = False
+                        gap = {"channel": None, "dropped": client.dropped}
+                        packets = self._encode("history_gap", gap) + packets
+
+                    for encoded in packets:
+                        await self.sio.eio.send(eio_sid, encoded)
+
+                client.sent += 1
+            except Exception as error:
+                print(f"Failed to send {event} to {client.sid}: {error}")
+
+            client.sending = False
+
+    def _transport_backlog(self, sid: str) -> int:
+        """
+        How many packets are waiting to be written to a client's connection.
+        """
+        try:
+            eio_sid = self.sio.manager.eio_sid_from_sid(sid, "/")
+            return self.sio.eio.sockets[eio_sid].queue.qsize()
+        except (AttributeError, KeyError, TypeError):
+            return 0
+
+
+class MessageBatcher:
+    """
+    Coalesces bursts of messages in a channel into one "messages" event, so a
+    busy channel sends each client a few big frames instead of thousands of
+    tiny ones.
+
+    The first message after a quiet spell is sent straight away as a normal
+    "message" event, and opens a window. Anything else sent in the channel
+    during the window is held, then sent together when the window closes or
+    max_size messages are waiting. Quiet channels never wait, and busy ones
+    wait at most one window.
+    """
+
+    def __init__(
+        self, broadcaster: Broadcaster, window: float | None = None, max_size: int = 50
+    ):
+        self.broadcaster = broadcaster
+        self.window = window  # In seconds. None sends every message on its own.
+        self.max_size = max_size
+        self.pending: dict[str, list[dict]] = {}  # Held messages, by channel
+        self.timers: dict[str, asyncio.TimerHandle] = {}  # Open windows, by channel
+        self.batches = 0
+        self.batched = 0  # How many messages were sent in batches
+
+    def add(self, channel: str, message: dict) -> None:
+        """
+        Send a message to everyone, now or as part of a batch.
+        """
+        if not self.window:
+            self.broadcaster.publish("message", message)
+            return
+
+        if channel not in self.timers:
+            self.broadcaster.publish("message", message)
+            self._open_window(channel)
+            return
+
+        pending = self.pending.setdefault(channel, [])
+        pending.append(message)
+
+        if len(pending) >= self.max_size:
+            self.flush(channel)
+
+    def flush(self, channel: str) -> None:
+        """
+        Send the messages being held for a channel right away. Anything else
+        sent about the channel, like edits, should flush it first, so it can't
+        arrive before the message it's about.
+        """
+        pending = self.pending.pop(channel, None)
+
+        if not pending:
+            return
+
+        if len(pending) == 1:
+            self.broadcaster.publish("message", pending[0])
+        else:
+            self.broadcaster.publish("messages", pending)
+            self.batches += 1
+            self.batched += len(pending)
+
+    def close(self) -> None:
+        """
+        Send everything that's being held, and stop every window.
+        """
+        for timer in self.timers.values():
+            timer.cancel()
+
+        self.timers.clear()
+
+        for channel in list(self.pending):
+            self.flush(channel)
+
+    def stats(self) -> dict:
+        return {
+            "window": self.window,
+            "batches": self.batches,
+            "batched": self.batched,
+            "held": sum(len(pending) for pending in self.pending.values()),
+        }
+
+    def _open_window(self, channel: str) -> None:
+        self.timers[channel] = asyncio.get_running_loop().call_later(
+            self.window, self._close_window, channel
+        )
+
+    def _close_window(self, channel: str) -> None:
+        del self.timers[channel]
+
+        # Messages came in during the window, so the channel is busy. Send
+        # them, and keep batching until a window goes by with nothing in it.
+        if self.pending.get(channel):
+            self.flush(channel)
+            self._open_window(channel)
@@ -0,0 +1,32 @@
+"""
+The message clock gives every message its timestamp. Timestamps are milliseconds
+since the Unix epoch, and they come from the server, not the client, so every
+message is timestamped the same way.
+"""
+
+import time
+
+
+class MessageClock:
+    """
+    A clock that never goes backwards. If the system clock is turned back, the
+    clock holds at the last time it gave out until the system clock catches up,
+    so messages are never timestamped out of order.
+    """
+
+    def __init__(self) -> None:
+        self.last = 0
+
+    def now(self) -> int:
+        """
+        Get the current time, in milliseconds since the Unix epoch.
+        """
+        now = time.time_ns() // 1_000_000
+
+        if now > self.last:
+            self.last = now
+
+        return self.last
+
+
+clock = MessageClock()
@@ -1,3 +1,117 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
 # The prefix for commands. This is used to determine if a message is a command or not.
 COMMAND_PREFIX = "~"
 REQUIRED_USER_FIELDS = ["email", "username", "password", "dob"]
+# The longest a message is allowed to be, in characters.
+MAX_MESSAGE_LENGTH = 1000
+# How many recent messages of each channel are kept in memory.
+HISTORY_CACHE_SIZE = 500
+# The most messages a reconnecting client will be sent to catch up. If they missed
+# more than this, they are told to page through the history instead.
+RESUME_MAX_MESSAGES = 200
+# How many events can be waiting to be sent to a single client.
+SEND_QUEUE_SIZE = 256
+# What to do with a client whose queue is full: "drop" their oldest event,
+# or "disconnect" them so they reconnect and catch up.
+SLOW_CLIENT_POLICY = "drop"
+# How many seconds a command can run for before it is cancelled, unless the
+# command sets its own timeout.
+COMMAND_TIMEOUT = 5.0
+# How many threads are used to run commands that do a lot of work.
+COMMAND_THREADS = 4
+# How often, in seconds, to check the database for tokens that other servers
+# have revoked, so they're turned away here too. Set this to None if only one
+# server ever runs at once.
+REVOCATION_SYNC_INTERVAL = 5.0
+# How often, in seconds, to check the plugins directory for changed commands.
+# Set this to None to only reload plugins when an admin asks for it.
+PLUGIN_RELOAD_INTERVAL = 2.0
+# Every server that writes messages needs its own worker ID, between 0 and 1023,
+# so the message IDs they make never clash.
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))
+# Where to keep the app's data. This is either the path to an SQLite database,
+# or a postgresql:// URL.
+DATABASE_URL = os.getenv("DATABASE_URL", "server/database/database.db")
+# Print the query plan of each database statement the first time it runs, and
+# warn about statements that have to scan a whole table.
+EXPLAIN_QUERIES = os.getenv("EXPLAIN_QUERIES", "0") == "1"
+# Database statements that take longer than this many milliseconds are logged.
+# Set it to None to turn the slow query log off.
+SLOW_QUERY_MS = 50.0
+# Statements that are expected to take longer than SLOW_QUERY_MS, by name, with
+# their own threshold. Catching up a client can read a few hundred messages.
+SLOW_QUERY_THRESHOLDS = {"messages.after": 200.0}
+# A redis:// URL for socket.io to pass events between servers through. Only
+# needed when more than one server is running.
+MESSAGE_QUEUE_URL = os.getenv("MESSAGE_QUEUE_URL")
+# The most people that can be in one direct message conversation.
+MAX_CONVERSATION_MEMBERS = 10
+# How many conversations' members are kept in memory, so sending a direct
+# message doesn't have to look them up.
+CONVERSATION_CACHE_SIZE = 10_000
+# A file to record every event clients send to, so it can be replayed with
+# server/simulator.py. Traces hold message content, so keep them safe.
+TRACE_FILE = os.getenv("TRACE_FILE")
+# A file to write tracing spans to, showing where the time went in every event
+# and request. Open it in https://ui.perfetto.dev or chrome://tracing.
+SPANS_FILE = os.getenv("SPANS_FILE")
+# How often, in seconds, the sampling profiler looks at what the server is doing.
+PROFILE_INTERVAL = 0.005
+# The longest an admin can profile the server for at once, in seconds.
+PROFILE_MAX_SECONDS = 60
+# Where uploaded files are kept. They're named by the hash of what's in them.
+ATTACHMENTS_DIR = os.getenv("ATTACHMENTS_DIR", "server/database/attachments")
+# The biggest file that can be uploaded, in bytes.
+MAX_ATTACHMENT_SIZE = 10 * 1024 * 1024
+# The most files that can be attached to one message.
+MAX_ATTACHMENTS = 10
+# How big thumbnails of images are, in pixels along their longest side.
+THUMBNAIL_SIZE = 320
+# How many processes make thumbnails. Thumbnails are only made if Pillow is installed.
+THUMBNAIL_PROCESSES = 2
+# Uploads that are shown in the browser. Anything else, such as HTML or SVG,
+# could run scripts on our site, so it's always downloaded instead.
+INLINE_CONTENT_TYPES = {
+    "image/png",
+    "image/jpeg",
+    "image/gif",
+    "image/webp",
+    "video/mp4",
+    "video/webm",
+    "audio/mpeg",
+    "audio/ogg",
+    "audio/wav",
+    "text/plain",
+}
+# Batch up bursts of messages in a channel, and send each burst to clients as
+# one "messages" event, at most this many seconds late. Something from 0.01 to
+# 0.05 suits busy servers. Set it to None to send every message on its own.
+MESSAGE_BATCH_WINDOW = None
+# The most messages that are held for one batch before it's sent anyway.
+MESSAGE_BATCH_SIZE = 50
+# How many usernames the filter of taken usernames is sized for, and how often
+# it should say a free username might be taken. It takes about 1.2MB per
+# million usernames at 1%.
+USERNAME_FILTER_CAPACITY = 1_000_000
+USERNAME_FILTER_ERROR_RATE = 0.01
+# How many threads hash passwords, so signing up and logging in never block
+# the event loop. bcrypt lets go of the GIL, so they really run at once.
+HASH_THREADS = 4
+# Where the server listens, as host:port, with commas between more than one.
+BIND = os.getenv("BIND", "localhost:5000").split(",")
+# Let more than one server listen on the same port, so a new server can start
+# before the old one stops. Only works on Linux and BSDs. Each server needs its
+# own WORKER_ID, and channel messages aren't shared between them while both
+# are running, so keep the overlap short.
+REUSE_PORT = os.getenv("REUSE_PORT", "0") == "1"
+# When the server is told to stop, it waits up to this many seconds for
+# messages being handled to be saved and sent, before disconnecting everyone.
+DRAIN_TIMEOUT = 10.0
+# Disconnected clients are each told to reconnect at a random time up to this
+# many seconds later, so they don't all come back at once.
+RECONNECT_SPREAD = 30.0
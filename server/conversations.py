@@ -0,0 +1,148 @@
+"""
+Direct messages. A conversation is a private channel between a fixed group of
+people, and its messages are kept in the messages table under the channel
+"dm:<conversation id>", so their history is read the same way as any channel's.
+"""
+
+import asyncio
+import json
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from clock import clock
+from config import CONVERSATION_CACHE_SIZE, MAX_CONVERSATION_MEMBERS, WORKER_ID
+from errors import ConstraintError, ConversationNotFoundError
+from snowflake import SnowflakeGenerator
+
+if TYPE_CHECKING:
+    from storage import Storage
+
+CHANNEL_PREFIX = "dm:"
+
+conversation_ids = SnowflakeGenerator(WORKER_ID)
+
+
+def dm_channel(id: int) -> str:
+    """
+    Get the channel a conversation's messages are sent in.
+    """
+    return f"{CHANNEL_PREFIX}{id}"
+
+
+def is_dm_channel(channel: str) -> bool:
+    return channel.startswith(CHANNEL_PREFIX)
+
+
+def conversation_of(channel: str) -> int | None:
+    """
+    Get the ID of the conversation a channel belongs to, if it is one.
+    """
+    if not is_dm_channel(channel):
+        return None
+
+    try:
+        return int(channel.removeprefix(CHANNEL_PREFIX))
+    except ValueError:
+        return None
+
+
+class Conversations:
+    """
+    Finds, starts and keeps track of conversations. Members never change once a
+    conversation has started, so they are cached for as long as there's room.
+    """
+
+    def __init__(self, db: "Storage", cache_size: int = CONVERSATION_CACHE_SIZE):
+        self.db = db
+        self.cache_size = cache_size
+        self.members: OrderedDict[int, tuple[str, ...]] = OrderedDict()
+        # So two people can't start the same conversation at once. Other
+        # servers can, but only one of them gets to save it.
+        self.lock = asyncio.Lock()
+
+    async def open(self, usernames: list[str]) -> dict:
+        """
+        Get the conversation between a group of people, starting one if they
+        haven't talked yet.
+        """
+        members = sorted(set(usernames))
+
+        if not 2 <= len(members) <= MAX_CONVERSATION_MEMBERS:
+            raise ValueError(
+                f"Conversations must have between 2 and {MAX_CONVERSATION_MEMBERS} people in them."
+            )
+
+        key = json.dumps(members)
+
+        async with self.lock:
+            conversation = await self.db.conversations.find(key)
+
+            if conversation is None:
+                conversation = {
+                    "id": conversation_ids.next_id(),
+                    "members": key,
+                    "created_at": clock.now(),
+                }
+                try:
+                    await self.db.conversations.create(conversation, members)
+                except ConstraintError:
+                    # Another server started it first, so use theirs.
+                    conversation = await self.db.conversations.find(key)
+
+                    if conversation is None:
+                        raise
+
+        self._remember(conversation["id"], tuple(members))
+
+        return conversation
+
+    async def members_of(self, id: int) -> tuple[str, ...]:
+        """
+        Get the usernames of everyone in a conversation.
+        """
+        if id in self.members:
+            self.members.move_to_end(id)
+            return self.members[id]
+
+        conversation = await self.db.conversations.get(id)
+
+        if conversation is None:
+            raise ConversationNotFoundError("That conversation does not exist.")
+
+        members = tuple(json.loads(conversation["members"]))
+        self._remember(id, members)
+
+        return members
+
+    async def check_member(self, id: int, username: str) -> tuple[str, ...]:
+        """
+        Make sure a user is in a conversation, and get everyone who is. People
+        who aren't in a conversation are told it doesn't exist.
+        """
+        members = await self.members_of(id)
+
+        if username not in members:
+            raise ConversationNotFoundError("That conversation does not exist.")
+
+        return members
+
+    async def for_user(self, username: str) -> list[dict]:
+        """
+        Get every conversation a user is in, in a sendable format.
+        """
+        return [
+            {
+                "id": str(conversation["id"]),
+                "members": json.loads(conversation["members"]),
+                "unread": conversation["unread"],
+                "last_read_id": str(conversation["last_read_id"]),
+            }
+            for conversation in await self.db.conversations.for_user(username)
+        ]
+
+    def _remember(self, id: int, members: tuple[str, ...]) -> None:
+        self.members[id] = members
+        self.members.move_to_end(id)
+
+        while len(self.members) > self.cache_size:
+            self.members.popitem(last=False)
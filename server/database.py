@@ -1,53 +1,412 @@
 """
 Controls all database related things. This includes our
-pseudo-ORM objects like User and Message, and the main Database 
-object that they all connect to.
+pseudo-ORM objects like User and Message, and the SQLite Database
+that is used to store them unless another storage backend is picked.
 """
 
 import asyncio
-from typing import TYPE_CHECKING
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, AsyncIterable, AsyncIterator
 from uuid import uuid4
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import dataclass, field
 
 import aiosqlite
 import bcrypt
 from enums import Permissions, MessageType
-from errors import MalformedDataError
-from config import REQUIRED_USER_FIELDS
+from errors import ConstraintError, MalformedDataError
+from config import (
+    DATABASE_URL,
+    EXPLAIN_QUERIES,
+    HASH_THREADS,
+    REQUIRED_USER_FIELDS,
+    SLOW_QUERY_MS,
+    SLOW_QUERY_THRESHOLDS,
+    WORKER_ID,
+)
+from snowflake import SnowflakeGenerator, timestamp_of
+from spans import span
+from tokenizer import ParsedMessage, tokenize
+from storage import (
+    BINARY_COLUMNS,
+    CONFLICT_KEYS,
+    EXPORT_COLUMNS,
+    AttachmentRepository,
+    ConversationRepository,
+    MessageRepository,
+    Storage,
+    UserRepository,
+    import_values,
+    user_taken_error,
+)
 
 if TYPE_CHECKING:
     from objects import Context
 
+# Every statement the SQLite backend runs while serving requests, by name.
+# Going through names means each statement's SQL is always the same string, so
+# SQLite's statement cache can reuse the prepared statement, and timings and
+# query plans can be reported per statement.
+STATEMENTS: dict[str, str] = {
+    "users.get": "SELECT * FROM users WHERE username = ?",
+    "users.get_by_session": "SELECT username FROM users WHERE session = ?",
+    "users.get_password": "SELECT password FROM users WHERE username = ?",
+    "users.create": """
+        INSERT INTO users (username, email, permissions, displayname, dob, password, password_salt)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """,
+    "users.update": "UPDATE users SET (username, email, permissions, displayname, dob) = (?, ?, ?, ?, ?) WHERE username = ?",
+    "users.set_session": "UPDATE users SET session = ? WHERE username = ?",
+    "users.usernames": "SELECT username FROM users",
+    "users.username_taken": "SELECT 1 FROM users WHERE username = ?",
+    "users.email_taken": "SELECT 1 FROM users WHERE email = ? LIMIT 1",
+    "users.token_generations": "SELECT username, token_generation FROM users WHERE token_generation > 0",
+    "users.revoke_tokens": """
+        UPDATE users SET token_generation = token_generation + 1
+        WHERE username = ? RETURNING token_generation
+    """,
+    "messages.get": "SELECT * FROM messages WHERE id = ? AND deleted = 0",
+    "messages.insert": """
+        INSERT INTO messages (id, message, author, channel, created_at, attachments)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """,
+    "messages.edit": "UPDATE messages SET message = ?, revision = ? WHERE id = ?",
+    "messages.delete": "UPDATE messages SET message = '', deleted = 1 WHERE id = ?",
+    "messages.recent": """
+        SELECT * FROM messages
+        WHERE channel = ? AND id < ? AND deleted = 0
+        ORDER BY id DESC LIMIT ?
+    """,
+    "messages.after": """
+        SELECT * FROM messages
+        WHERE channel = ? AND id > ? AND deleted = 0
+        ORDER BY id LIMIT ?
+    """,
+    "conversations.get": "SELECT * FROM conversations WHERE id = ?",
+    "conversations.find": "SELECT * FROM conversations WHERE members = ?",
+    "conversations.create": "INSERT INTO conversations (id, members, created_at) VALUES (?, ?, ?)",
+    "conversations.add_member": "INSERT INTO conversation_members (conversation_id, username) VALUES (?, ?)",
+    "conversations.for_user": """
+        SELECT conversations.*, conversation_members.unread, conversation_members.last_read_id
+        FROM conversation_members
+        JOIN conversations ON conversations.id = conversation_members.conversation_id
+        WHERE conversation_members.username = ?
+        ORDER BY conversations.id DESC
+    """,
+    "conversations.mark_unread": """
+        UPDATE conversation_members SET unread = unread + 1
+        WHERE conversation_id = ? AND username != ?
+    """,
+    "conversations.mark_read": """
+        UPDATE conversation_members SET
+            last_read_id = max(last_read_id, ?),
+            unread = (
+                SELECT count(*) FROM messages
+                WHERE channel = ? AND id > max(conversation_members.last_read_id, ?)
+                AND author != conversation_members.username AND deleted = 0
+            )
+        WHERE conversation_id = ? AND username = ?
+    """,
+    "attachments.get": "SELECT * FROM attachments WHERE id = ?",
+    "attachments.create": """
+        INSERT INTO attachments (id, hash, filename, content_type, size, uploader, created_at, thumbnail)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+}
+
+
+class SQLiteUsers(UserRepository):
+    """
+    Stores users in SQLite.
+    """
+
+    def __init__(self, database: "Database") -> None:
+        self.db = database
+
+    async def get(self, username: str) -> dict | None:
+        user = await self.db.fetchone("users.get", (username,))
+
+        # The user doesn't exist. What a shame.
+        if user is None:
+            return None
+
+        user = dict(user)
+
+        del user["password"]
+        del user["password_salt"]
+
+        return user
+
+    async def get_by_session(self, session: str) -> str | None:
+        user = await self.db.fetchone("users.get_by_session", (session,))
+
+        # If no user was found with that token, screw them
+        if user is None:
+            return None
+
+        return user["username"]
+
+    async def get_password(self, username: str) -> bytes | None:
+        user = await self.db.fetchone("users.get_password", (username,))
+
+        return None if user is None else user["password"]
+
+    async def create(self, user: dict, password: bytes, salt: bytes) -> None:
+        # The unique index on usernames makes the check and the insert one step,
+        # so two people signing up with the same name at once can't both get it.
+        try:
+            await self.db.execute(
+                "users.create",
+                (
+                    user["username"],
+                    user["email"],
+                    user["permissions"],
+                    user["displayname"],
+                    user["dob"],
+                    password,
+                    salt,
+                ),
+            )
+        except sqlite3.IntegrityError as error:
+            raise user_taken_error(str(error)) from error
+
+        await self.db.commit()
+
+    async def update(self, username: str, user: dict) -> None:
+        try:
+            await self.db.execute(
+                "users.update",
+                (
+                    user["username"],
+                    user["email"],
+                    user["permissions"],
+                    user["displayname"],
+                    user["dob"],
+                    username,
+                ),
+            )
+        except sqlite3.IntegrityError as error:
+            raise user_taken_error(str(error)) from error
+
+        await self.db.commit()
+
+    async def usernames(self) -> list[str]:
+        return [user["username"] for user in await self.db.execute("users.usernames")]
 
-class Database:
+    async def username_taken(self, username: str) -> bool:
+        return await self.db.fetchone("users.username_taken", (username,)) is not None
+
+    async def email_taken(self, email: str) -> bool:
+        return await self.db.fetchone("users.email_taken", (email,)) is not None
+
+    async def set_session(self, username: str, session: str) -> None:
+        await self.db.execute("users.set_session", (session, username))
+        await self.db.commit()
+
+    async def token_generations(self) -> dict[str, int]:
+        users = await self.db.execute("users.token_generations")
+
+        return {user["username"]: user["token_generation"] for user in users}
+
+    async def revoke_tokens(self, username: str) -> int:
+        user = await self.db.fetchone("users.revoke_tokens", (username,))
+        await self.db.commit()
+
+        return 0 if user is None else user["token_generation"]
+
+
+class SQLiteMessages(MessageRepository):
+    """
+    Stores messages in SQLite.
+    """
+
+    def __init__(self, database: "Database") -> None:
+        self.db = database
+
+    async def get(self, id: int) -> dict | None:
+        message = await self.db.fetchone("messages.get", (id,))
+
+        return None if message is None else dict(message)
+
+    async def insert(self, message: dict) -> None:
+        await self.db.execute(
+            "messages.insert",
+            (
+                message["id"],
+                message["message"],
+                message["author"],
+                message["channel"],
+                message["created_at"],
+                message.get("attachments"),
+            ),
+        )
+        await self.db.commit()
+
+    async def edit(self, id: int, content: str, revision: int) -> None:
+        await self.db.execute("messages.edit", (content, revision, id))
+        await self.db.commit()
+
+    async def delete(self, id: int) -> None:
+        await self.db.execute("messages.delete", (id,))
+        await self.db.commit()
+
+    async def recent(
+        self, channel: str, amount: int, before: int | None = None
+    ) -> list[dict]:
+        messages = await self.db.execute(
+            "messages.recent",
+            (channel, before if before is not None else 2**63 - 1, amount),
+        )
+
+        return [dict(message) for message in messages][::-1]
+
+    async def after(self, channel: str, after: int, amount: int) -> list[dict]:
+        messages = await self.db.execute("messages.after", (channel, after, amount))
+
+        return [dict(message) for message in messages]
+
+
+class SQLiteConversations(ConversationRepository):
+    """
+    Stores conversations in SQLite.
+    """
+
+    def __init__(self, database: "Database") -> None:
+        self.db = database
+
+    async def get(self, id: int) -> dict | None:
+        conversation = await self.db.fetchone("conversations.get", (id,))
+
+        return None if conversation is None else dict(conversation)
+
+    async def find(self, members: str) -> dict | None:
+        conversation = await self.db.fetchone("conversations.find", (members,))
+
+        return None if conversation is None else dict(conversation)
+
+    async def create(self, conversation: dict, usernames: list[str]) -> None:
+        try:
+            await self.db.execute(
+                "conversations.create",
+                (
+                    conversation["id"],
+                    conversation["members"],
+                    conversation["created_at"],
+                ),
+            )
+        except sqlite3.IntegrityError as error:
+            raise ConstraintError("That conversation already exists.") from error
+
+        for username in usernames:
+            await self.db.execute(
+                "conversations.add_member", (conversation["id"], username)
+            )
+
+        await self.db.commit()
+
+    async def for_user(self, username: str) -> list[dict]:
+        conversations = await self.db.execute("conversations.for_user", (username,))
+
+        return [dict(conversation) for conversation in conversations]
+
+    async def mark_unread(self, id: int, author: str) -> None:
+        await self.db.execute("conversations.mark_unread", (id, author))
+        await self.db.commit()
+
+    async def mark_read(
+        self, id: int, channel: str, username: str, last_read_id: int
+    ) -> None:
+        await self.db.execute(
+            "conversations.mark_read",
+            (last_read_id, channel, last_read_id, id, username),
+        )
+        await self.db.commit()
+
+
+class SQLiteAttachments(AttachmentRepository):
+    """
+    Stores attachments in SQLite.
+    """
+
+    def __init__(self, database: "Database") -> None:
+        self.db = database
+
+    async def get(self, id: int) -> dict | None:
+        attachment = await self.db.fetchone("attachments.get", (id,))
+
+        return None if attachment is None else dict(attachment)
+
+    async def create(self, attachment: dict) -> None:
+        await self.db.execute(
+            "attachments.create",
+            (
+                attachment["id"],
+                attachment["hash"],
+                attachment["filename"],
+                attachment["content_type"],
+                attachment["size"],
+                attachment["uploader"],
+                attachment["created_at"],
+                int(attachment["thumbnail"]),
+            ),
+        )
+        await self.db.commit()
+
+
+class Database(Storage):
     """
     The database. This represents the database that the server
     will use to store data. It will be used to interface with
     the database directly.
+
+    This is the SQLite storage backend, and the default one. Passing
+    ":memory:" as the path gives you a throwaway database, which is
+    handy for tests and benchmarks.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        path: str,
+        explain: bool = EXPLAIN_QUERIES,
+        slow_query_ms: float | None = SLOW_QUERY_MS,
+        thresholds: dict[str, float] = SLOW_QUERY_THRESHOLDS,
+    ) -> None:
+        self.path = path
         self.conn: aiosqlite.Connection
-        self.c: aiosqlite.Cursor
+        self.c: aiosqlite.Cursor  # Only for setting up the tables in connect()
+        self.users = SQLiteUsers(self)
+        self.messages = SQLiteMessages(self)
+        self.conversations = SQLiteConversations(self)
+        self.attachments = SQLiteAttachments(self)
 
-    @classmethod
-    async def connect(cls, path: str) -> "Database":
+        # Query plans are only looked at once per statement.
+        self.explain = explain
+        self.explained: set[str] = set()
+
+        self.slow_query_ms = slow_query_ms
+        self.thresholds = thresholds
+        self.queries: dict[str, dict] = {}
+
+    async def connect(self) -> None:
         """
         Connect to the database. Also construct the database if
         it doesn't exist.
         """
-        database = cls()
-        database.conn = await aiosqlite.connect(path)
-        database.conn.row_factory = (
+        # Keep every named statement prepared, plus room for a few others.
+        self.conn = await aiosqlite.connect(
+            self.path, cached_statements=len(STATEMENTS) + 32
+        )
+        self.conn.row_factory = (
             aiosqlite.Row
         )  # I think this represents data in a dict-like format
-        database.c = (
-            await database.conn.cursor()
+        self.c = (
+            await self.conn.cursor()
         )  # There's our cursor to execute SQL statements with
 
         # Such as these ones
-        await database.c.execute(
+        await self.c.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
                 email TEXT NOT NULL,
@@ -58,60 +417,349 @@ class Database:
                 dob TEXT NOT NULL,
                 session TEXT NULL,
                 creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                permissions INTEGER DEFAULT 71
+                permissions INTEGER DEFAULT 71,
+                token_generation INTEGER NOT NULL DEFAULT 0
             )
         """
         )
-        await database.c.execute(
+        await self.c.execute(
             """
             CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id INTEGER PRIMARY KEY,
                 message TEXT NOT NULL,
                 author TEXT NOT NULL,
                 channel TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT (datetime(CURRENT_TIMESTAMP, 'localtime'))
+                created_at INTEGER NOT NULL,
+                revision INTEGER NOT NULL DEFAULT 0,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                attachments TEXT NULL
             )
         """
         )
-        await database.conn.commit()
-        return database
 
-    async def authenticate_user(self, token: str) -> None | str:
-        """
-        Make sure the session token that the client is trying to connect with exists
-        and is valid.
-        """
+        # Databases made before these columns existed need them added.
+        await self.add_column("messages", "revision", "INTEGER NOT NULL DEFAULT 0")
+        await self.add_column("messages", "deleted", "INTEGER NOT NULL DEFAULT 0")
+        await self.add_column("users", "token_generation", "INTEGER NOT NULL DEFAULT 0")
+        await self.add_column("messages", "attachments", "TEXT NULL")
+
+        # Messages used to be timestamped with a local time string. Those are
+        # turned into milliseconds since the epoch, like new messages are.
+        if await self.add_column("messages", "created_at", "INTEGER"):
+            await self.c.execute(
+                """
+                UPDATE messages
+                SET created_at = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) * 1000
+                WHERE created_at IS NULL
+            """
+            )
+
+        # History is always read one channel at a time, in ID order. IDs sort
+        # by when the message was sent, so that's the order it was sent in.
+        await self.c.execute("DROP INDEX IF EXISTS messages_channel_created")
+        await self.c.execute(
+            "CREATE INDEX IF NOT EXISTS messages_channel_id ON messages (channel, id)"
+        )
+        # Sessions are looked up by their token.
+        await self.c.execute(
+            "CREATE INDEX IF NOT EXISTS users_session ON users (session)"
+        )
+        # Revoked tokens are synced every few seconds, and few users ever have
+        # any, so only they are indexed.
         await self.c.execute(
+            "CREATE INDEX IF NOT EXISTS users_revoked ON users (token_generation) WHERE token_generation > 0"
+        )
+
+        # Nothing used to stop two people signing up with the same username.
+        # Only the first of them can ever log in, so the rest are dropped
+        # before usernames are made unique.
+        await self.c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'users_username'"
+        )
+
+        if await self.c.fetchone() is None:
+            await self.c.execute(
+                """
+                DELETE FROM users WHERE rowid NOT IN (
+                    SELECT min(rowid) FROM users GROUP BY username
+                )
             """
-            SELECT * FROM users WHERE session = ?
-        """,
-            (token,),
+            )
+
+            if self.c.rowcount > 0:
+                print(f"Removed {self.c.rowcount} users with duplicate usernames")
+
+            await self.c.execute(
+                "CREATE UNIQUE INDEX users_username ON users (username)"
+            )
+
+        # Emails weren't unique either, and were only checked before signing
+        # up, so two people could race for one. The oldest account keeps it.
+        await self.c.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'users_email'"
         )
-        user = await self.c.fetchone()
+        index = await self.c.fetchone()
 
-        # If no user was found with that token, screw them
-        if user is None:
-            return None
+        if index is None or not index[0].startswith("CREATE UNIQUE"):
+            await self.c.execute(
+                """
+                DELETE FROM users WHERE rowid NOT IN (
+                    SELECT min(rowid) FROM users GROUP BY email
+                )
+            """
+            )
 
-        return user["username"]
+            if self.c.rowcount > 0:
+                print(f"Removed {self.c.rowcount} users with duplicate emails")
+
+            await self.c.execute("DROP INDEX IF EXISTS users_email")
+            await self.c.execute("CREATE UNIQUE INDEX users_email ON users (email)")
 
-    async def get_messages(self, amount: int = 20) -> list[dict]:
+        # Direct messages. Their messages live in the messages table, in a
+        # channel of their own, so reading their history uses the same index.
+        await self.c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY,
+                members TEXT NOT NULL UNIQUE,
+                created_at INTEGER NOT NULL
+            )
         """
-        Get the last 10 messages from the database.
+        )
+        await self.c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversation_members (
+                conversation_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                unread INTEGER NOT NULL DEFAULT 0,
+                last_read_id INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (username, conversation_id)
+            )
         """
+        )
+        await self.c.execute(
+            "CREATE INDEX IF NOT EXISTS conversation_members_conversation ON conversation_members (conversation_id)"
+        )
+
+        # Uploaded files. The files are on disk, named by their hash.
         await self.c.execute(
             """
-            SELECT * FROM messages ORDER BY id DESC LIMIT ?
-        """,
-            (amount,),
+            CREATE TABLE IF NOT EXISTS attachments (
+                id INTEGER PRIMARY KEY,
+                hash TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                content_type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                uploader TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                thumbnail INTEGER NOT NULL DEFAULT 0
+            )
+        """
         )
 
-        messages = await self.c.fetchall()
+        await self.conn.commit()
 
-        return [dict(message) for message in messages][::-1]
+    async def close(self) -> None:
+        await self.conn.close()
+
+    async def commit(self) -> None:
+        with span("db.commit"):
+            await self.conn.commit()
+
+    async def execute(self, name: str, params: tuple = ()) -> list[aiosqlite.Row]:
+        """
+        Run one of the named statements in STATEMENTS, and return the rows it
+        gives back. Statements that take longer than their threshold are logged.
+        """
+        statement = STATEMENTS[name]
+
+        if self.explain and name not in self.explained:
+            await self.explain_query(name, params)
+
+        # Every call gets its own cursor, since other coroutines run statements
+        # while this one waits for its rows.
+        with span(f"db.{name}"):
+            start = time.perf_counter()
+
+            async with self.conn.execute(statement, params) as cursor:
+                rows = await cursor.fetchall()
+
+            elapsed = (time.perf_counter() - start) * 1000
+
+        stats = self.queries.setdefault(
+            name, {"calls": 0, "total_ms": 0.0, "slowest_ms": 0.0, "slow": 0}
+        )
+        stats["calls"] += 1
+        stats["total_ms"] += elapsed
+        stats["slowest_ms"] = max(stats["slowest_ms"], elapsed)
+
+        threshold = self.thresholds.get(name, self.slow_query_ms)
+
+        if threshold is not None and elapsed > threshold:
+            stats["slow"] += 1
+            print(f"Slow query {name} took {elapsed:.1f}ms (threshold {threshold}ms)")
+
+        return rows
+
+    async def fetchone(self, name: str, params: tuple = ()) -> aiosqlite.Row | None:
+        """
+        Run a named statement, and return the first row it gives back.
+        """
+        rows = await self.execute(name, params)
+
+        return rows[0] if rows else None
+
+    async def explain_query(self, name: str, params: tuple = ()) -> list[str]:
+        """
+        Print the query plan SQLite picked for a named statement, and warn about
+        any table it has to read all of because there's no index it can use.
+        """
+        self.explained.add(name)
+
+        async with self.conn.execute(
+            f"EXPLAIN QUERY PLAN {STATEMENTS[name]}", params
+        ) as cursor:
+            plan = [row["detail"] for row in await cursor.fetchall()]
+
+        print(f"Query plan for {name}:")
+
+        for step in plan:
+            print(f"    {step}")
+
+            # "SCAN table" reads every row, while "SCAN table USING INDEX"
+            # at least reads them in order from an index.
+            if step.startswith("SCAN ") and "INDEX" not in step:
+                print(f"Warning: {name} scans the whole {step.split()[1]} table")
 
+        return plan
 
-@dataclass
+    def stats(self) -> dict:
+        """
+        Get how often each named statement has run, and how long it took.
+        """
+        return {
+            name: {
+                **stats,
+                "average_ms": stats["total_ms"] / stats["calls"],
+            }
+            for name, stats in self.queries.items()
+        }
+
+    async def add_column(self, table: str, column: str, definition: str) -> bool:
+        """
+        Add a column to a table, if it isn't there already. Returns whether
+        the column was added.
+        """
+        await self.c.execute(f"PRAGMA table_info({table})")
+        columns = [row["name"] for row in await self.c.fetchall()]
+
+        if column in columns:
+            return False
+
+        await self.c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+
+    async def iter_rows(
+        self, table: str, batch_size: int = 1000
+    ) -> AsyncIterator[dict]:
+        """
+        Iterate over every row in a table. Rows are pulled from the database
+        in batches so that the whole table is never held in memory at once.
+        """
+        columns = EXPORT_COLUMNS[table]
+        binary = BINARY_COLUMNS[table]
+
+        # This uses its own cursor, so other queries can still use the shared
+        # one while an export is streaming.
+        async with self.conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid"
+        ) as cursor:
+            while rows := await cursor.fetchmany(batch_size):
+                for row in rows:
+                    row = dict(row)
+
+                    for column in binary:
+                        if isinstance(row[column], bytes):
+                            row[column] = row[column].decode("utf-8")
+
+                    yield row
+
+    async def import_rows(
+        self,
+        table: str,
+        rows: AsyncIterable[dict],
+        batch_size: int = 1000,
+    ) -> int:
+        """
+        Insert rows into a table. Rows are copied into a temporary table in
+        batches with executemany, on a connection of their own, and then moved
+        into the real table with one statement. That statement is the only
+        time the import holds the database's write lock, and it inserts every
+        row or none of them. Rows that clash with one that's already there
+        are skipped.
+
+        Returns the number of rows that were inserted.
+        """
+        columns = ", ".join(EXPORT_COLUMNS[table])
+        staging = f"import_{uuid4().hex}"
+
+        # An in-memory database can't be opened twice, so it's imported into
+        # over the same connection. Nothing here rolls back, so other
+        # coroutines' writes on it are never thrown away.
+        shared = self.path == ":memory:"
+        conn = self.conn if shared else await aiosqlite.connect(self.path)
+
+        try:
+            # The staging table doesn't read the real one, so nothing is
+            # locked while the rows come in.
+            await conn.execute(f"CREATE TEMP TABLE {staging} ({columns})")
+            statement = (
+                f"INSERT INTO temp.{staging} "
+                f"VALUES ({', '.join('?' for _ in EXPORT_COLUMNS[table])})"
+            )
+            batch = []
+            count = 0
+
+            async for row in rows:
+                count += 1
+                batch.append(import_values(table, row, count))
+
+                if len(batch) >= batch_size:
+                    await conn.executemany(statement, batch)
+                    batch.clear()
+
+            if batch:
+                await conn.executemany(statement, batch)
+
+            # "WHERE true" tells SQLite the ON CONFLICT isn't part of a join.
+            async with conn.execute(
+                f"INSERT INTO main.{table} ({columns}) "
+                f"SELECT {columns} FROM temp.{staging} WHERE true "
+                f"ON CONFLICT ({', '.join(CONFLICT_KEYS[table])}) DO NOTHING"
+            ) as cursor:
+                inserted = cursor.rowcount
+
+            await conn.commit()
+        except sqlite3.IntegrityError as error:
+            raise ConstraintError(str(error)) from error
+        finally:
+            if shared:
+                await conn.execute(f"DROP TABLE IF EXISTS temp.{staging}")
+            else:
+                # Anything that wasn't committed goes with the connection.
+                await conn.close()
+
+        return inserted
+
+
+# Makes the IDs of every message this server sends.
+message_ids = SnowflakeGenerator(WORKER_ID)
+# Hashes and checks passwords, which takes long enough on purpose that it
+# can't happen on the event loop.
+password_hashers = ThreadPoolExecutor(HASH_THREADS, thread_name_prefix="bcrypt")
+
+
+@dataclass(slots=True)
 class Message:
     """
     The Message object holds information that is useful when sending and receiving messages.
@@ -119,49 +767,109 @@ class Message:
 
     content: str  # The content of the message
     author: "User | str | None"  # The message's author
-    id: int | None = None  # The message's ID
+    id: int = field(
+        default_factory=message_ids.next_id
+    )  # The message's snowflake ID, given out as soon as the message is made
     channel: str = "general"  # The channel the message is in (possibly for future use)
-    timestamp: str = datetime.strftime(
-        datetime.now(), "%H:%M:%S"
-    )  # The time the message was created
+    timestamp: int | None = (
+        None  # When the server accepted the message, in milliseconds since the epoch
+    )
     type: MessageType = (
         MessageType.NORMAL
     )  # The type of message, used to determine how the message is displayed
+    revision: int = 0  # How many times the message has been edited
+    deleted: bool = False  # Whether the message has been deleted
+    attachments: list[dict] = field(
+        default_factory=list
+    )  # The files attached to the message, in a sendable format
+    _parsed: ParsedMessage | None = field(
+        default=None, init=False, repr=False, compare=False
+    )  # The tokenized content, made the first time it's needed
+
+    def __post_init__(self) -> None:
+        # New messages are timestamped with the time in their ID.
+        if self.timestamp is None:
+            self.timestamp = timestamp_of(self.id)
+
+    @property
+    def parsed(self) -> ParsedMessage:
+        """
+        The message's command, arguments, mentions, links and markup. The content
+        is only tokenized once, however many times this is used.
+        """
+        if self._parsed is None:
+            self._parsed = tokenize(self.content)
+
+        return self._parsed
 
     @classmethod
-    async def get(cls, id: int) -> "Message | None":
+    def from_row(cls, row: dict) -> "Message":
         """
-        Get a message from the database.
+        Create a Message from a row of the messages table.
         """
-        await db.c.execute(
-            """
-            SELECT * FROM messages WHERE id = ?
-        """,
-            (id,),
+        return cls(
+            content=row["message"],
+            author=row["author"],
+            id=row["id"],
+            channel=row["channel"],
+            timestamp=row["created_at"],
+            revision=row["revision"],
+            deleted=bool(row["deleted"]),
+            attachments=json.loads(row["attachments"])
+            if row.get("attachments")
+            else [],
         )
-        message = await db.c.fetchone()
+
+    @classmethod
+    async def get(cls, id: int) -> "Message | None":
+        """
+        Get a message from the database. Deleted messages are not returned.
+        """
+        message = await db.messages.get(id)
 
         if message is None:
             return None
 
-        return cls(**dict(message))
+        return cls.from_row(message)
 
     async def save(self) -> None:
         """
-        Save the message in the database. This also
-        attaches an ID argument to the message.
+        Save the message in the database. The message already has its ID,
+        so there's nothing to read back.
         """
-        await db.c.execute(
-            """
-            INSERT INTO messages (message, author, channel)
-            VALUES (?, ?, ?)
-        """,
-            (self.content, getattr(self.author, "username", self.author), self.channel),
-        )
-        await db.conn.commit()
+        with span("message.save", channel=self.channel):
+            await db.messages.insert(
+                {
+                    "id": self.id,
+                    "message": self.content,
+                    "author": getattr(self.author, "username", self.author),
+                    "channel": self.channel,
+                    "created_at": self.timestamp,
+                    "attachments": json.dumps(self.attachments)
+                    if self.attachments
+                    else None,
+                }
+            )
 
-        await db.c.execute("SELECT last_insert_rowid() as id")
-        self.id = (await db.c.fetchone())["id"]
+    async def edit(self, content: str) -> None:
+        """
+        Change the content of the message. The revision is bumped so clients
+        can tell which version of the message is the newest.
+        """
+        self.content = content
+        self.revision += 1
+        self._parsed = None
+
+        await db.messages.edit(self.id, self.content, self.revision)
+
+    async def delete(self) -> None:
+        """
+        Delete the message. The row is kept as a tombstone, so exports and
+        clients that already have the message can still see that it's gone.
+        """
+        self.deleted = True
+
+        await db.messages.delete(self.id)
 
     def serialize(self) -> dict:
         """
@@ -176,25 +884,32 @@ class Message:
             "channel": self.channel,
             "timestamp": self.timestamp,
             "type": self.type.value,
+            "revision": self.revision,
+            "deleted": self.deleted,
         }
 
     def as_sendable(self) -> dict:
         """
         Serialize the message into a dictionary, excluding
-        sensitive information.
+        sensitive information. IDs are sent as strings, since
+        JavaScript numbers can't hold a 64-bit ID.
         """
         return {
-            "id": self.id,
+            "id": str(self.id),
             "message": self.content,
             "author": self.author.as_sendable()
             if isinstance(self.author, User)
             else self.author,
+            "channel": self.channel,
+            "markup": self.parsed.markup,
+            "attachments": self.attachments,
             "timestamp": self.timestamp,
             "type": self.type.value,
+            "revision": self.revision,
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageResponse:
     """
     A MessageResponse used by the server to send messages to clients.
@@ -209,21 +924,23 @@ class MessageResponse:
         """
         Save a MessageResponse to the database.
         """
-        await db.c.execute(
-            "INSERT INTO messages (message, author, channel) VALUES (?, ?, ?)",
-            (
-                self.message.content,
-                self.user.username if isinstance(self.user, User) else self.user,
-                self.context_from.channel,
-            ),
+        await db.messages.insert(
+            {
+                "id": self.message.id,
+                "message": self.message.content,
+                "author": self.user.username
+                if isinstance(self.user, User)
+                else self.user,
+                "channel": self.context_from.channel,
+                "created_at": self.message.timestamp,
+            }
         )
 
-        await db.conn.commit()
-
     def serialize(self) -> dict:
         return {
-            "id": self.message.id,
+            "id": str(self.message.id),
             "message": self.message.content,
+            "markup": self.message.parsed.markup,
             "author": self.user.as_sendable()
             if isinstance(self.user, User)
             else self.user,
@@ -233,40 +950,82 @@ class MessageResponse:
         }
 
 
-@dataclass
 class User:
-    username: str
-    email: str
-    creation_date: str = datetime.strftime(datetime.now(), "%H:%M:%S")
-    permissions: Permissions = Permissions(71)
-    displayname: str | None = None
-    session: str | None = None
-    dob: str | None = None
-    sid: str | None = None
+    """
+    A user of the chat. Every connected client holds one of these, so it uses
+    slots to keep them small. Permissions are kept as a plain int, and only
+    turned into a Permissions flag when someone asks for one.
+    """
+
+    __slots__ = (
+        "username",
+        "email",
+        "creation_date",
+        "_permissions",
+        "displayname",
+        "session",
+        "dob",
+        "sid",
+        "token_generation",
+    )
+
+    def __init__(
+        self,
+        username: str,
+        email: str,
+        creation_date: str | None = None,
+        permissions: Permissions | int = 71,
+        displayname: str | None = None,
+        session: str | None = None,
+        dob: str | None = None,
+        sid: str | None = None,
+        token_generation: int = 0,
+    ) -> None:
+        self.username = username
+        self.email = email
+        self.creation_date = creation_date
+        self.permissions = permissions
+        self.displayname = displayname
+        self.session = session
+        self.dob = dob
+        self.sid = sid
+        self.token_generation = (
+            token_generation  # Tokens from older generations are revoked
+        )
+
+    def __repr__(self) -> str:
+        return f"User(username={self.username!r}, permissions={self._permissions}, sid={self.sid!r})"
+
+    @property
+    def permissions(self) -> Permissions:
+        return Permissions(self._permissions)
+
+    @permissions.setter
+    def permissions(self, value: Permissions | int) -> None:
+        self._permissions = (
+            value.value if isinstance(value, Permissions) else int(value)
+        )
+
+    def has_permission(self, permission: Permissions) -> bool:
+        """
+        Check whether the user has a permission. This is cheaper than going
+        through the permissions property, since no flag has to be made.
+        """
+        return self._permissions & permission.value != 0
 
     @classmethod
     async def get(cls, username: str, sid: str | None = None) -> "User | None":
         """
         Get a user from the database.
         """
-        await db.c.execute(
-            """
-            SELECT * FROM users WHERE username = ?
-        """,
-            (username,),
-        )
-        user = await db.c.fetchone()
+        with span("user.get"):
+            user = await db.users.get(username)
 
         # The user doesn't exist. What a shame.
         if user is None:
             return None
 
-        user = dict(user)
-
-        del user["password"]
-        del user["password_salt"]
-
-        user["permissions"] = Permissions(int(user["permissions"]))
+        user["permissions"] = int(user["permissions"])
 
         return cls(
             sid=sid,
@@ -284,12 +1043,7 @@ class User:
         if not all(key in serialized.keys() and serialized[key] for key in req_fields):
             raise MalformedDataError("Unable to save user: Missing key in data.")
 
-        await db.c.execute(
-            "UPDATE users SET (username, email, permissions, displayname, dob) = (?, ?, ?, ?, ?) WHERE username = ?",
-            (*serialized.values(), self.username),
-        )
-
-        await db.conn.commit()
+        await db.users.update(self.username, serialized)
 
     async def create(self, password: str) -> "User":
         """
@@ -304,19 +1058,13 @@ class User:
         if not all(key in serialized for key in new_req):
             raise MalformedDataError("Unable to create user: Missing key in data.")
 
-        salt = bcrypt.gensalt()
-        serialized["password"] = bcrypt.hashpw(bytes(password, encoding="utf-8"), salt)
-        serialized["password_salt"] = salt
-
-        await db.c.execute(
-            """
-            INSERT INTO users (username, email, permissions, displayname, dob, password, password_salt)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-            (*serialized.values(),),
-        )
+        with span("bcrypt.hashpw"):
+            salt = bcrypt.gensalt()
+            hashed = await asyncio.get_running_loop().run_in_executor(
+                password_hashers, bcrypt.hashpw, bytes(password, encoding="utf-8"), salt
+            )
 
-        await db.conn.commit()
+        await db.users.create(serialized, hashed, salt)
 
         return self
 
@@ -327,7 +1075,7 @@ class User:
         return {
             "username": self.username,
             "email": self.email,
-            "permissions": self.permissions.value,
+            "permissions": self._permissions,
             "displayname": self.display_name,
             "dob": self.dob,
         }
@@ -340,7 +1088,7 @@ class User:
         return {
             "username": self.username,
             "displayname": self.display_name,
-            "permissions": self.permissions.value,
+            "permissions": self._permissions,
             "creation_date": self.creation_date,
         }
 
@@ -349,15 +1097,18 @@ class User:
         Check if the user's password is correct.
         """
         # Get the password from the database
-        await db.c.execute(
-            """
-            SELECT password FROM users WHERE username = ?
-        """,
-            (self.username,),
-        )
-        correct_password = (await db.c.fetchone())["password"]
+        correct_password = await db.users.get_password(self.username)
+
+        if correct_password is None:
+            return False
 
-        return bcrypt.checkpw(bytes(password, encoding="utf-8"), correct_password)
+        with span("bcrypt.checkpw"):
+            return await asyncio.get_running_loop().run_in_executor(
+                password_hashers,
+                bcrypt.checkpw,
+                bytes(password, encoding="utf-8"),
+                correct_password,
+            )
 
     async def refresh_session(self) -> str:
         """
@@ -365,11 +1116,7 @@ class User:
         """
         self.session = str(uuid4())
 
-        await db.c.execute(
-            "UPDATE users SET session = ? WHERE username = ?",
-            (self.session, self.username),
-        )
-        await db.conn.commit()
+        await db.users.set_session(self.username, self.session)
 
         return self.session
 
@@ -382,4 +1129,18 @@ class User:
         self.displayname = value
 
 
-db = asyncio.run(Database.connect("server/database/database.db"))
+def open_storage(url: str) -> Storage:
+    """
+    Pick the storage backend for a database URL. PostgreSQL URLs use the
+    PostgreSQL backend, and anything else is treated as a path to an SQLite file.
+    The storage isn't connected until its connect method is called.
+    """
+    if url.startswith(("postgres://", "postgresql://")):
+        from postgres import PostgresStorage
+
+        return PostgresStorage(url)
+
+    return Database(url)
+
+
+db = open_storage(DATABASE_URL)
@@ -19,6 +19,7 @@ class Permissions(Flag):
     KICK = 32
     COMMANDS = 64
     DELETE_OTHERS = 128
+    ADMIN = 256
 
 
 class MessageType(Enum):
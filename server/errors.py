@@ -1,5 +1,5 @@
 """
-A collection of errors the app can raise. I do not think these are used anywhere.
+A collection of errors the app can raise.
 """
 
 
@@ -13,3 +13,57 @@ class MalformedDataError(DatabaseError):
     """
     Exception to be raised when the data is malformed.
     """
+
+
+class ConstraintError(DatabaseError):
+    """
+    Exception to be raised when data breaks one of the database's rules,
+    such as a column that can't be empty. field is the column that broke
+    it, when that's known.
+    """
+
+    def __init__(self, message: str, field: str | None = None):
+        super().__init__(message)
+        self.field = field
+
+
+class MessageNotFoundError(DatabaseError):
+    """
+    Exception to be raised when a message doesn't exist, or has been deleted.
+    """
+
+
+class ConversationNotFoundError(DatabaseError):
+    """
+    Exception to be raised when a conversation doesn't exist, or the user isn't in it.
+    """
+
+
+class PermissionDeniedError(Exception):
+    """
+    Exception to be raised when a user tries to do something they are not allowed to do.
+    """
+
+
+class CommandTimeoutError(Exception):
+    """
+    Exception to be raised when a command takes too long to run.
+    """
+
+
+class ProfilerBusyError(Exception):
+    """
+    Exception to be raised when a profile is asked for while another one is being taken.
+    """
+
+
+class AttachmentTooLargeError(Exception):
+    """
+    Exception to be raised when an uploaded file is bigger than we allow.
+    """
+
+
+class PluginImportError(Exception):
+    """
+    Exception to be raised when a command plugin's code fails to import.
+    """
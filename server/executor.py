@@ -0,0 +1,113 @@
+"""
+The command executor runs commands with a time limit, so a slow or stuck command
+can't hold up anything else. Commands that do a lot of work can also be run in
+a thread, so they don't block the event loop.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from errors import CommandTimeoutError
+from spans import span
+
+if TYPE_CHECKING:
+    from database import MessageResponse
+    from objects import Command, Context
+
+
+class CommandExecutor:
+    """
+    Runs commands for the app. Every command gets a timeout, an optional limit on
+    how many copies of it can run at once, and can be cancelled if the user who
+    ran it leaves.
+    """
+
+    def __init__(self, default_timeout: float = 5.0, threads: int = 4):
+        self.default_timeout = default_timeout
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="command")
+        self.limits: dict[str, asyncio.Semaphore] = {}
+        self.running: dict[str | None, set[asyncio.Task]] = {}
+        self.timeouts = 0
+
+    async def run(self, command: "Command", ctx: "Context") -> "MessageResponse | None":
+        """
+        Run a command and wait for its response. Raises CommandTimeoutError if the
+        command takes longer than it's allowed to.
+        """
+        # The command's task copies the span, so what it does is nested inside.
+        with span(f"command.{command.name}"):
+            timeout = command.timeout or self.default_timeout
+            sid = getattr(ctx.author, "sid", None)
+            task = asyncio.create_task(self._execute(command, ctx))
+
+            self.running.setdefault(sid, set()).add(task)
+
+            try:
+                # Waiting for a free slot counts towards the timeout too.
+                return await asyncio.wait_for(task, timeout)
+            except asyncio.TimeoutError as error:
+                self.timeouts += 1
+                raise CommandTimeoutError(
+                    f"{command.name} took longer than {timeout:g} seconds."
+                ) from error
+            finally:
+                tasks = self.running.get(sid)
+
+                if tasks is not None:
+                    tasks.discard(task)
+
+                    if not tasks:
+                        del self.running[sid]
+
+    def cancel(self, sid: str) -> None:
+        """
+        Cancel every command that a client is running, such as when they disconnect.
+        """
+        for task in self.running.pop(sid, set()):
+            task.cancel()
+
+    async def shutdown(self) -> None:
+        """
+        Cancel every running command and stop the thread pool.
+        """
+        tasks = [task for tasks in self.running.values() for task in tasks]
+        self.running.clear()
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Threads can't be interrupted, so don't wait on the ones still going.
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "running": sum(len(tasks) for tasks in self.running.values()),
+            "timeouts": self.timeouts,
+        }
+
+    async def _execute(
+        self, command: "Command", ctx: "Context"
+    ) -> "MessageResponse | None":
+        if command.max_concurrency is None:
+            return await self._call(command, ctx)
+
+        if command.name not in self.limits:
+            self.limits[command.name] = asyncio.Semaphore(command.max_concurrency)
+
+        async with self.limits[command.name]:
+            return await self._call(command, ctx)
+
+    async def _call(
+        self, command: "Command", ctx: "Context"
+    ) -> "MessageResponse | None":
+        try:
+            return await command.execute(ctx, self.pool)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            # A broken command shouldn't take the message handler down with it.
+            print(f"Command {command.name} failed: {error}")
+            return None
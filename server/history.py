@@ -0,0 +1,84 @@
+"""
+An in-memory cache of the most recent messages in each channel. Reconnecting
+clients are usually only a few messages behind, so this lets us catch them up
+without going to the database.
+"""
+
+from collections import deque
+
+
+class MessageHistory:
+    """
+    Holds the last few messages sent in each channel, in the same format
+    that they were sent to clients in.
+
+    Every message sent while the server is running is added in the order it
+    was sent, so a channel's cache always holds every message after the oldest
+    one it has. Like on the client, IDs are kept as strings.
+    """
+
+    def __init__(self, size: int = 500):
+        self.size = size
+        self.channels: dict[str, deque[dict]] = {}
+
+    def add(self, channel: str, message: dict) -> None:
+        """
+        Add a message that was just sent to a channel.
+        """
+        if channel not in self.channels:
+            self.channels[channel] = deque(maxlen=self.size)
+
+        self.channels[channel].append(message)
+
+    def edit(self, id: int, content: str, markup: str, revision: int) -> None:
+        """
+        Update a cached message after it has been edited.
+        """
+        for message in self._find(str(id)):
+            message["message"] = content
+            message["markup"] = markup
+            message["revision"] = revision
+
+    def delete(self, id: int) -> None:
+        """
+        Drop a cached message after it has been deleted.
+        """
+        id = str(id)
+
+        for channel in self.channels.values():
+            for message in list(channel):
+                if message.get("id") == id:
+                    channel.remove(message)
+
+    def after(self, channel: str, last_id: int, limit: int) -> list[dict] | None:
+        """
+        Get up to limit + 1 messages that were sent in a channel after the message
+        with the ID last_id. Returns None if that message isn't in the cache, since
+        then we can't know what came after it.
+        """
+        cached = self.channels.get(channel)
+        last_id = str(last_id)
+
+        if not cached:
+            return None
+
+        missed = []
+
+        # Walk backwards, since clients are usually only a few messages behind.
+        for message in reversed(cached):
+            if message["id"] == last_id:
+                missed.reverse()
+                return missed
+
+            # Keep looking for the message, but stop collecting once we have
+            # more than enough to know the gap is too big.
+            if len(missed) <= limit:
+                missed.append(message)
+
+        return None
+
+    def _find(self, id: str):
+        for channel in self.channels.values():
+            for message in channel:
+                if message.get("id") == id:
+                    yield message
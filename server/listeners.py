@@ -0,0 +1,94 @@
+"""
+Where the server listens, and what tells it to stop. To restart without turning
+anyone away, the new server has to be listening before the old one stops, which
+works one of two ways:
+
+- With REUSE_PORT set, every server binds the same port with SO_REUSEPORT, and
+  the kernel shares new connections between them. Start the new server with a
+  different WORKER_ID to the old one, then send the old one SIGTERM, and it
+  drains. Both write to the database while they overlap, and with the same
+  worker ID they'd make the same message IDs, so REUSE_PORT needs WORKER_ID
+  to be set. Channel messages aren't relayed between servers, so until the
+  old server has drained, people on one only see live messages sent on that
+  one. They catch up on the rest when they reconnect.
+- A supervisor, such as systemd with socket activation, can own the listening
+  socket and hand it down to each server it starts. The socket never closes, so
+  connections wait in its backlog for the next server instead of being refused.
+"""
+
+import asyncio
+import os
+import signal
+import socket
+
+
+def inherited_fds() -> list[int]:
+    """
+    Get the listening sockets a supervisor handed down, using systemd's
+    LISTEN_FDS protocol. They start at file descriptor 3.
+    """
+    # The variables are left for any child processes too, so make sure they
+    # were meant for us.
+    if os.getenv("LISTEN_PID") != str(os.getpid()):
+        return []
+
+    return list(range(3, 3 + int(os.getenv("LISTEN_FDS", "0"))))
+
+
+def reuse_port_socket(address: str) -> int:
+    """
+    Bind a socket to a host:port that other servers can bind to at the same
+    time, and get its file descriptor.
+    """
+    host, _, port = address.rpartition(":")
+    host = host.strip("[]")
+
+    sock = socket.socket(
+        socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM
+    )
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, int(port)))
+
+    # Hypercorn owns the socket from here, so it mustn't be closed when this
+    # object is thrown away.
+    return sock.detach()
+
+
+def binds(addresses: list[str], reuse_port: bool = False) -> list[str]:
+    """
+    Get what Hypercorn should listen on. Sockets that were handed down win,
+    then ones shared with SO_REUSEPORT, then the addresses as they are.
+    """
+    inherited = inherited_fds()
+
+    if inherited:
+        return [f"fd://{fd}" for fd in inherited]
+
+    if reuse_port:
+        if os.getenv("WORKER_ID") is None:
+            raise ValueError(
+                "REUSE_PORT needs WORKER_ID to be set, and different for every "
+                "server sharing the port, so their message IDs don't clash"
+            )
+
+        return [f"fd://{reuse_port_socket(address)}" for address in addresses]
+
+    return addresses
+
+
+async def wait_for_signal(signals=(signal.SIGINT, signal.SIGTERM)) -> None:
+    """
+    Wait for the server to be told to stop. The handlers are only used once,
+    so a second Ctrl+C stops the server straight away, without draining.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+
+    for signum in signals:
+        loop.add_signal_handler(signum, stop.set)
+
+    await stop.wait()
+
+    for signum in signals:
+        loop.remove_signal_handler(signum)
@@ -0,0 +1,336 @@
+"""
+The plugin loader finds command modules in the plugins directory. Modules aren't
+imported until one of their commands is used. The loader reads the source to find
+out which commands a module has, so it can send commands to the right module before
+that module is imported. Modules can also be reloaded while the server is running,
+so changing a command doesn't mean restarting the server and dropping every connection.
+"""
+
+import ast
+import asyncio
+import hashlib
+import importlib.util
+import json
+import re
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+from config import COMMAND_PREFIX
+from errors import PluginImportError
+
+if TYPE_CHECKING:
+    from objects import Command
+
+# Descriptions end with how to use the command, like "Usage: ~remind <minutes> <message>".
+USAGE = re.compile(r"\s*Usage:\s*(.*)$")
+# An argument in a usage: <required>, [optional], or @a_mention.
+ARGUMENT = re.compile(r"<([^>]+)>|\[([^\]]+)\]|@(\w+)")
+
+
+def parse_usage(description: str) -> tuple[str, str | None, list[dict]]:
+    """
+    Split a command's description into what it does, how it's used, and the
+    arguments it takes.
+    """
+    match = USAGE.search(description)
+
+    if match is None:
+        return description, None, []
+
+    args = []
+
+    for required, optional, mention in ARGUMENT.findall(match.group(1)):
+        args.append(
+            {
+                "name": required or optional or mention,
+                "required": not optional,
+                "mention": bool(mention),
+            }
+        )
+
+    return description[: match.start()], match.group(1), args
+
+
+class CommandInfo:
+    """
+    What we know about a command before its module has been imported. The
+    usage and arguments are worked out from the description once, here.
+    """
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.summary, self.usage, self.args = parse_usage(description)
+
+    def as_sendable(self) -> dict:
+        return {
+            "name": self.name,
+            "description": self.summary,
+            "usage": self.usage,
+            "args": self.args,
+        }
+
+
+class CommandCatalog:
+    """
+    The help text and the command list clients are sent, made once whenever
+    the commands change rather than every time someone asks for them.
+    """
+
+    def __init__(
+        self, commands: Iterable[CommandInfo] = (), prefix: str = COMMAND_PREFIX
+    ):
+        commands = list(commands)
+
+        self.help = "\n".join(f"{info.name} - {info.description}" for info in commands)
+        self.body = json.dumps(
+            {
+                "status": "success",
+                "prefix": prefix,
+                "commands": [info.as_sendable() for info in commands],
+            }
+        )
+        # Changes whenever anything in the list does, so clients can cache it.
+        self.etag = hashlib.sha256(self.body.encode()).hexdigest()[:32]
+
+
+class Plugin:
+    """
+    A module in the plugins directory, and the commands it holds.
+    """
+
+    def __init__(self, name: str, path: Path):
+        self.name = name
+        self.path = path
+        self.mtime = path.stat().st_mtime_ns
+        self.module: ModuleType | None = None
+        self.info: dict[str, CommandInfo] = {}
+        self.commands: dict[str, "Command"] = {}
+        self.lock = asyncio.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.module is not None
+
+    def scan(self) -> bool:
+        """
+        Read the module's source to find the commands in it, without running it.
+        Returns False if a command can't be figured out from the source alone,
+        in which case the module needs to be imported to know.
+        """
+        try:
+            tree = ast.parse(self.path.read_text(encoding="utf-8"), str(self.path))
+        except SyntaxError as error:
+            print(f"Failed to read plugin {self.name}: {error}")
+            return False
+
+        info = {}
+        complete = True
+
+        for node in ast.walk(tree):
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+
+            for decorator in node.decorator_list:
+                if not (
+                    isinstance(decorator, ast.Call)
+                    and isinstance(decorator.func, ast.Name)
+                    and decorator.func.id == "command"
+                ):
+                    continue
+
+                try:
+                    name, description = (
+                        ast.literal_eval(arg) for arg in decorator.args[:2]
+                    )
+                except ValueError:
+                    complete = False
+                    continue
+
+                info[name] = CommandInfo(name, description)
+
+        self.info = info
+
+        return complete
+
+
+class PluginLoader:
+    """
+    Keeps track of every plugin and the commands they hold. Iterating over the
+    loader gives you every command, which works whether or not its module has
+    been imported yet.
+    """
+
+    def __init__(self, directory: str | Path, package: str = "plugins"):
+        self.directory = Path(directory)
+        self.package = package
+        self.plugins: dict[str, Plugin] = {}
+        self.index: dict[str, Plugin] = {}  # Which plugin each command lives in
+        self.catalog = CommandCatalog()
+
+    def discover(self) -> None:
+        """
+        Find every plugin in the directory. This doesn't import any of them, unless
+        their commands can't be figured out any other way.
+        """
+        plugins = {}
+
+        for path in sorted(self.directory.glob("*.py")):
+            if path.name.startswith("_"):
+                continue
+
+            plugin = self.plugins.get(path.stem)
+
+            if plugin is None:
+                plugin = Plugin(path.stem, path)
+
+                if not plugin.scan():
+                    self._try_import(plugin)
+
+            plugins[plugin.name] = plugin
+
+        self.plugins = plugins
+        self._build_index()
+
+    async def get(self, name: str) -> "Command | None":
+        """
+        Get a command by its name, importing its plugin if it hasn't been yet.
+        """
+        plugin = self.index.get(name)
+
+        if plugin is None:
+            return None
+
+        if not plugin.is_loaded:
+            async with plugin.lock:
+                # Someone else may have imported it while we were waiting.
+                if not plugin.is_loaded:
+                    self._try_import(plugin)
+                    self._build_index()
+
+        return plugin.commands.get(name)
+
+    async def reload(self, name: str) -> bool:
+        """
+        Re-import a plugin from its file. Commands that are already running keep
+        using the old code, and everything after the reload uses the new code.
+        If the new code fails to import, the old code is kept, and
+        PluginImportError is raised.
+
+        Returns whether there was a plugin with that name.
+        """
+        plugin = self.plugins.get(name)
+
+        if plugin is None:
+            return False
+
+        async with plugin.lock:
+            plugin.mtime = plugin.path.stat().st_mtime_ns
+
+            # Plugins that haven't been used yet only need to be read again.
+            try:
+                if not plugin.scan() or plugin.is_loaded:
+                    self._import(plugin)
+            finally:
+                self._build_index()
+
+        return True
+
+    async def reload_changed(self) -> None:
+        """
+        Pick up plugins that were added, removed, or changed since we last looked.
+        This is meant to be run every few seconds by the scheduler.
+        """
+        self.discover()
+
+        for plugin in list(self.plugins.values()):
+            try:
+                changed = plugin.path.stat().st_mtime_ns != plugin.mtime
+            except FileNotFoundError:
+                continue
+
+            if not changed:
+                continue
+
+            try:
+                await self.reload(plugin.name)
+            except PluginImportError as error:
+                print(error)
+            else:
+                print(f"Reloaded plugin {plugin.name}")
+
+    def __iter__(self) -> Iterator["Command | CommandInfo"]:
+        for plugin in self.plugins.values():
+            if plugin.is_loaded:
+                yield from plugin.commands.values()
+            else:
+                yield from plugin.info.values()
+
+    def _try_import(self, plugin: Plugin) -> None:
+        """
+        Import a plugin, and carry on without it if that fails.
+        """
+        try:
+            self._import(plugin)
+        except PluginImportError as error:
+            print(error)
+
+    def _import(self, plugin: Plugin) -> None:
+        """
+        Import a plugin's module from scratch. The new module and its commands only
+        replace the old ones once it has been fully imported. Raises
+        PluginImportError if it can't be imported.
+        """
+        module_name = f"{self.package}.{plugin.name}"
+        spec = importlib.util.spec_from_file_location(module_name, plugin.path)
+        module = importlib.util.module_from_spec(spec)
+        old_module = sys.modules.get(module_name)
+
+        # Modules expect to be able to find themselves while they're being imported.
+        sys.modules[module_name] = module
+
+        try:
+            spec.loader.exec_module(module)
+        except Exception as error:
+            if old_module is None:
+                del sys.modules[module_name]
+            else:
+                sys.modules[module_name] = old_module
+
+            raise PluginImportError(
+                f"Failed to import plugin {plugin.name}: {error}"
+            ) from error
+
+        commands = {}
+
+        for value in vars(module).values():
+            command = getattr(value, "__command__", None)
+
+            if command is not None:
+                commands[command.name] = command
+
+        plugin.module = module
+        plugin.commands = commands
+        plugin.info = {
+            name: CommandInfo(command.name, command.description)
+            for name, command in commands.items()
+        }
+
+    def _build_index(self) -> None:
+        index = {}
+
+        for plugin in self.plugins.values():
+            for name in plugin.commands if plugin.is_loaded else plugin.info:
+                if name in index:
+                    print(
+                        f"Command {name} in {plugin.name} replaces the one in {index[name].name}"
+                    )
+
+                index[name] = plugin
+
+        self.index = index
+        self.catalog = CommandCatalog(
+            plugin.info[name] for name, plugin in index.items()
+        )
@@ -0,0 +1,95 @@
+"""
+Helpers for reading and writing newline-delimited JSON (NDJSON) streams, which
+are used to export and import data in bulk. Both directions work on a stream
+of chunks, so a dump never has to fit in memory.
+"""
+
+import json
+import zlib
+from typing import AsyncIterable, AsyncIterator
+
+# The first two bytes of every gzip stream.
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+async def encode(
+    rows: AsyncIterable[dict], compress: bool = False, chunk_size: int = 65536
+) -> AsyncIterator[bytes]:
+    """
+    Turn rows into NDJSON, optionally gzip-compressed. Lines are grouped into
+    chunks of about chunk_size bytes, so we're not sending one tiny chunk per row.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = bytearray()
+
+    async for row in rows:
+        buffer += json.dumps(row, separators=(",", ":")).encode("utf-8")
+        buffer += b"\n"
+
+        if len(buffer) >= chunk_size:
+            data = compressor.compress(bytes(buffer)) if compressor else bytes(buffer)
+            buffer.clear()
+
+            # The compressor may hold onto the data for a while, in which case
+            # there's nothing to send yet.
+            if data:
+                yield data
+
+    if compressor:
+        yield compressor.compress(bytes(buffer)) + compressor.flush()
+    elif buffer:
+        yield bytes(buffer)
+
+
+async def decode(chunks: AsyncIterable[bytes]) -> AsyncIterator[dict]:
+    """
+    Turn a stream of NDJSON chunks back into rows. Gzip-compressed streams
+    are detected and decompressed automatically.
+    """
+    decompressor = None
+    checked = False
+    buffer = b""
+    line_number = 0
+
+    async for chunk in chunks:
+        if not chunk:
+            continue
+
+        if not checked:
+            checked = True
+            if chunk.startswith(GZIP_MAGIC):
+                decompressor = zlib.decompressobj(wbits=31)
+
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+
+        # The last piece may be half of a line, so keep it for the next chunk.
+        *lines, buffer = (buffer + chunk).split(b"\n")
+
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield parse(line, line_number)
+
+    if decompressor:
+        buffer += decompressor.flush()
+
+    for line in buffer.split(b"\n"):
+        line_number += 1
+        if line.strip():
+            yield parse(line, line_number)
+
+
+def parse(line: bytes, line_number: int) -> dict:
+    """
+    Parse a single NDJSON line, making sure it holds an object.
+    """
+    try:
+        row = json.loads(line)
+    except ValueError as error:
+        raise ValueError(f"Line {line_number} is not valid JSON.") from error
+
+    if not isinstance(row, dict):
+        raise ValueError(f"Line {line_number} is not a JSON object.")
+
+    return row
@@ -4,37 +4,90 @@ such as the Permission enum, the Message object, and the Context
 object.
 """
 
-from typing import TYPE_CHECKING
+import asyncio
+import random
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator
 
+from attachments import AttachmentStore, attachment_sendable
+from bloom import BloomFilter
+from broadcast import Broadcaster, MessageBatcher
 from database import User, Message, MessageResponse
-from config import COMMAND_PREFIX
-from enums import Permissions
+from config import (
+    COMMAND_THREADS,
+    COMMAND_TIMEOUT,
+    DRAIN_TIMEOUT,
+    HISTORY_CACHE_SIZE,
+    MAX_ATTACHMENTS,
+    MAX_MESSAGE_LENGTH,
+    MESSAGE_BATCH_SIZE,
+    MESSAGE_BATCH_WINDOW,
+    MESSAGE_QUEUE_URL,
+    PLUGIN_RELOAD_INTERVAL,
+    RECONNECT_SPREAD,
+    RESUME_MAX_MESSAGES,
+    REVOCATION_SYNC_INTERVAL,
+    SEND_QUEUE_SIZE,
+    SLOW_CLIENT_POLICY,
+    USERNAME_FILTER_CAPACITY,
+    USERNAME_FILTER_ERROR_RATE,
+)
+from conversations import Conversations, conversation_of, dm_channel
+from enums import MessageType, Permissions
+from errors import CommandTimeoutError, MessageNotFoundError, PermissionDeniedError
+from executor import CommandExecutor
+from history import MessageHistory
+from scheduler import Scheduler
+from sessions import SessionStore, user_room
 
 if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
     from socketio import AsyncServer
-    from database import Database
+    from storage import Storage
+    from loader import PluginLoader
 
 
 class Command:
     """
     Define a command that the user can use.
+
+    Commands that do a lot of work can set threaded, in which case their
+    callback is a regular function that gets run in a thread.
     """
 
-    def __init__(self, name: str, func, description: str):
+    def __init__(
+        self,
+        name: str,
+        func,
+        description: str,
+        timeout: float | None = None,
+        max_concurrency: int | None = None,
+        threaded: bool = False,
+    ):
         self.name = name
         self.callback = func
         self.description = description
+        self.timeout = timeout  # Falls back to the app's default timeout
+        self.max_concurrency = max_concurrency  # None means no limit
+        self.threaded = threaded
 
-    async def execute(self, ctx: "Context") -> Message | None:
+    async def execute(
+        self, ctx: "Context", pool: "Executor | None" = None
+    ) -> Message | None:
         """
         Execute the command based on the context.
         """
-        if (
-            not ctx.is_command
-            or not ctx.message.author.permissions & Permissions.COMMANDS
+        if not ctx.is_command or not ctx.message.author.has_permission(
+            Permissions.COMMANDS
         ):
             return None
 
+        if self.threaded:
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, self.callback, ctx
+            )
+
         return await self.callback(ctx)
 
 
@@ -45,35 +98,420 @@ class Application:
     to common things, such as the database and the socketio server.
     """
 
-    def __init__(self, db: "Database", sio: "AsyncServer", commands: list[Command]):
+    def __init__(self, db: "Storage", sio: "AsyncServer", commands: "PluginLoader"):
         self.db = db
         self.sio = sio
         self.commands = commands
+        self.history = MessageHistory(HISTORY_CACHE_SIZE)
+        self.broadcaster = Broadcaster(sio, SEND_QUEUE_SIZE, SLOW_CLIENT_POLICY)
+        self.batcher = MessageBatcher(
+            self.broadcaster, MESSAGE_BATCH_WINDOW, MESSAGE_BATCH_SIZE
+        )
+        self.scheduler = Scheduler()
+        self.executor = CommandExecutor(COMMAND_TIMEOUT, COMMAND_THREADS)
+        self.sessions = SessionStore(db)
+        self.conversations = Conversations(db)
+        self.attachments = AttachmentStore()
+        # Every username that's taken, so most availability checks don't
+        # need the database. The unique index is what actually stops two
+        # accounts having the same name.
+        self.usernames = BloomFilter(
+            USERNAME_FILTER_CAPACITY, USERNAME_FILTER_ERROR_RATE
+        )
+        # Set once the server is on its way down, so new connections are turned away.
+        self.draining = False
+        self.drained: asyncio.Task | None = None
+        # How many events are being handled, and whether that's none.
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def start(self) -> None:
+        """
+        Connect to the database and start everything that runs in the background.
+        Called once the server is up and running.
+        """
+        await self.db.connect()
+        await self.sessions.load()
+
+        for username in await self.db.users.usernames():
+            self.usernames.add(username)
+
+        self.scheduler.start()
+
+        # Pick up changes to command plugins without a restart.
+        if PLUGIN_RELOAD_INTERVAL:
+            self.scheduler.every(
+                PLUGIN_RELOAD_INTERVAL, self.commands.reload_changed, name="plugins"
+            )
+
+        # Pick up logouts and bans from other servers.
+        if REVOCATION_SYNC_INTERVAL:
+            self.scheduler.every(
+                REVOCATION_SYNC_INTERVAL, self.sync_revocations, name="revocations"
+            )
+
+    async def shutdown(self) -> None:
+        """
+        Stop everything that runs in the background, and close the database.
+        """
+        await self.scheduler.shutdown()
+        await self.executor.shutdown()
+        self.batcher.close()
+        await self.broadcaster.close()
+        await self.attachments.shutdown()
+        await self.db.close()
+
+    @contextmanager
+    def handling(self) -> Iterator[None]:
+        """
+        Count something as being handled until it's done, so draining waits
+        for it to finish saving and sending.
+        """
+        self.in_flight += 1
+        self.idle.clear()
+
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+            if not self.in_flight:
+                self.idle.set()
+
+    def reconnect_after(self) -> int:
+        """
+        Pick when a client should reconnect after this server goes down, in
+        milliseconds. Every client gets a different time, so they come back
+        spread out rather than all at once.
+        """
+        return round(random.uniform(1, RECONNECT_SPREAD) * 1000)
+
+    def drain(self) -> asyncio.Task:
+        """
+        Start draining, if it hasn't started already, and get the task doing it.
+        """
+        if self.drained is None:
+            self.drained = asyncio.create_task(self._drain(DRAIN_TIMEOUT))
+
+        return self.drained
+
+    async def _drain(self, timeout: float) -> None:
+        """
+        Get ready to go down without losing anything. New connections are
+        turned away, the events being handled are finished, everything queued
+        is sent, and then every client is told when to reconnect and is
+        disconnected.
+        """
+        self.draining = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        print(f"Draining {len(self.broadcaster.clients)} connections...")
+
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Gave up waiting for {self.in_flight} events to be handled")
+
+        self.batcher.close()
+
+        for sid in list(self.broadcaster.clients):
+            self.broadcaster.publish(
+                "server_restart", {"reconnect_after": self.reconnect_after()}, to=sid
+            )
+
+        if not await self.broadcaster.flush(max(deadline - loop.time(), 0)):
+            print("Gave up waiting for every client to be sent what was queued")
+
+        for sid in list(self.broadcaster.clients):
+            await self.sio.disconnect(sid)
+
+        print("Drained")
+
+    async def username_available(self, username: str) -> bool:
+        """
+        Whether nobody has a username yet. Names the filter has never seen are
+        free, and only the ones it might have seen are looked up.
+        """
+        if username not in self.usernames:
+            return True
+
+        return not await self.db.users.username_taken(username)
 
     async def process_command(self, ctx: "Context") -> Message | None:
         """
-        Execute the associated callback method of a command.
+        Execute the associated callback method of a command. Commands that
+        take too long are cancelled, and the user gets told why.
         """
-        for command in self.commands:
-            if command.name == ctx.command:
-                return await command.execute(ctx)
+        # The command is looked up once, so a plugin being reloaded halfway
+        # through doesn't change which code runs.
+        command = await self.commands.get(ctx.command)
 
-        return None
+        if command is None:
+            return None
+
+        try:
+            return await self.executor.run(command, ctx)
+        except CommandTimeoutError as error:
+            return MessageResponse(
+                ctx.author,
+                ctx,
+                Message(
+                    content=f"Command timed out: {error}",
+                    author="Server",
+                    type=MessageType.ERROR,
+                ),
+                is_ephemeral=True,
+            )
+
+    async def revoke_sessions(self, username: str) -> None:
+        """
+        Log a user out everywhere. Every token they have is revoked, and every
+        socket they're connected with here is disconnected right away. Other
+        servers disconnect theirs when they next sync revocations.
+        """
+        await self.sessions.revoke(username)
+        await self.disconnect_user(username)
+
+    async def sync_revocations(self) -> None:
+        """
+        Pick up tokens that other servers have revoked, and disconnect anyone
+        connected here with them.
+        """
+        for username in await self.sessions.load():
+            await self.disconnect_user(username)
+
+    async def disconnect_user(self, username: str) -> None:
+        """
+        Disconnect every socket a user is connected with here.
+        """
+        for sid in self.sessions.sids_of(username):
+            await self.sio.disconnect(sid)
+
+    def send_to_user(self, username: str, event: str, data: object) -> None:
+        """
+        Send an event to every tab a user has open. Only their own connections
+        are looked at, so this doesn't get slower as more people connect.
+        """
+        sids = self.sessions.sids_of(username)
+
+        if sids:
+            self.broadcaster.publish(event, data, to=sids)
+
+        # They might also be connected to other servers.
+        if MESSAGE_QUEUE_URL:
+            self.broadcaster.relay(event, data, user_room(username), skip=sids)
 
     async def send_message(self, message: MessageResponse) -> None:
         """
         Send a message to a channel and save the result in a database.
+        The message is sent in the background once it has been saved.
+        Ephemeral messages are only for one person, and only live as long
+        as their client does, so they aren't saved.
         """
-        await message.message.save()
-
         if message.is_ephemeral:
-            await self.sio.emit("message", message.serialize(), to=message.user.sid)
+            self.send_to_user(
+                getattr(message.user, "username", message.user),
+                "message",
+                message.serialize(),
+            )
         else:
-            await self.sio.emit("message", message.serialize())
+            await message.message.save()
+
+            serialized = message.serialize()
+            self.history.add(message.message.channel, serialized)
+            self.batcher.add(message.message.channel, serialized)
+
+    def send_later(self, delay: float, message: MessageResponse) -> None:
+        """
+        Send a message after delay seconds. Useful for commands that need to
+        follow up on something.
+        """
+        self.scheduler.call_later(delay, self.send_message, message)
 
     async def user_message(self, context: "Context") -> None:
         await context.message.save()
-        await self.sio.emit("message", context.message.as_sendable())
+
+        sendable = context.message.as_sendable()
+        self.history.add(context.message.channel, sendable)
+        self.batcher.add(context.message.channel, sendable)
+
+        # Let everyone who was mentioned know, once each.
+        mentioned = {user.username for user in context.mentions}
+        mentioned.discard(context.author.username)
+
+        for username in mentioned:
+            self.send_to_user(
+                username,
+                "mention",
+                {
+                    "id": sendable["id"],
+                    "channel": context.message.channel,
+                    "author": context.author.username,
+                },
+            )
+
+    async def publish_to_channel(self, channel: str, event: str, data: object) -> None:
+        """
+        Send an event about a channel to everyone who can see it. Direct
+        messages only go to the people in the conversation.
+        """
+        conversation = conversation_of(channel)
+
+        if conversation is None:
+            self.batcher.flush(channel)
+            self.broadcaster.publish(event, data)
+            return
+
+        for username in await self.conversations.members_of(conversation):
+            self.send_to_user(username, event, data)
+
+    async def find_attachments(self, user: User, ids: list) -> list[dict]:
+        """
+        Look up the files a user wants to attach to a message, in a sendable
+        format. People can only attach files they uploaded themselves.
+        """
+        if not isinstance(ids, list) or len(ids) > MAX_ATTACHMENTS:
+            raise ValueError(f"Messages can have up to {MAX_ATTACHMENTS} attachments.")
+
+        attachments = []
+
+        for id in dict.fromkeys(map(str, ids)):
+            try:
+                attachment = await self.db.attachments.get(int(id))
+            except (TypeError, ValueError):
+                attachment = None
+
+            if attachment is None or attachment["uploader"] != user.username:
+                raise ValueError("That attachment does not exist.")
+
+            attachments.append(attachment_sendable(attachment))
+
+        return attachments
+
+    async def direct_message(
+        self, user: User, conversation_id: int, content: str, attachment_ids: list = ()
+    ) -> Message:
+        """
+        Send a message to a conversation. Only the people in it are sent the
+        message, and it's counted as unread for everyone but its author.
+        """
+        content = content.strip()
+
+        if len(content) > MAX_MESSAGE_LENGTH or not (content or attachment_ids):
+            raise ValueError(
+                f"Messages must be between 1 and {MAX_MESSAGE_LENGTH} characters."
+            )
+
+        if not user.has_permission(Permissions.SEND):
+            raise PermissionDeniedError("You do not have permission to send messages.")
+
+        members = await self.conversations.check_member(conversation_id, user.username)
+
+        message = Message(content, author=user, channel=dm_channel(conversation_id))
+        message.attachments = await self.find_attachments(user, list(attachment_ids))
+        await message.save()
+        await self.db.conversations.mark_unread(conversation_id, user.username)
+
+        sendable = message.as_sendable()
+
+        for username in members:
+            self.send_to_user(username, "direct_message", sendable)
+
+        return message
+
+    async def missed_messages(self, channel: str, last_id: int) -> list[dict] | None:
+        """
+        Get the messages in a channel that a client missed since the last message
+        it saw. Returns None if they missed too many, in which case they should
+        page through the history instead.
+        """
+        missed = self.history.after(channel, last_id, RESUME_MAX_MESSAGES)
+
+        # If the cache doesn't go back far enough, the database will.
+        if missed is None:
+            missed = [
+                Message.from_row(row).as_sendable()
+                for row in await self.db.messages.after(
+                    channel, last_id, RESUME_MAX_MESSAGES + 1
+                )
+            ]
+
+        if len(missed) > RESUME_MAX_MESSAGES:
+            return None
+
+        return missed
+
+    async def edit_message(self, user: User, message_id: int, content: str) -> Message:
+        """
+        Edit one of the user's messages, and tell everyone what changed.
+        Only the changes are sent, so clients don't have to fetch the history again.
+        """
+        content = content.strip()
+
+        if not content or len(content) > MAX_MESSAGE_LENGTH:
+            raise ValueError(
+                f"Messages must be between 1 and {MAX_MESSAGE_LENGTH} characters."
+            )
+
+        message = await Message.get(message_id)
+
+        if message is None:
+            raise MessageNotFoundError("That message does not exist.")
+
+        # You can only edit your own messages.
+        if message.author != user.username or not user.has_permission(Permissions.EDIT):
+            raise PermissionDeniedError(
+                "You do not have permission to edit that message."
+            )
+
+        await message.edit(content)
+        self.history.edit(
+            message.id, message.content, message.parsed.markup, message.revision
+        )
+        await self.publish_to_channel(
+            message.channel,
+            "message_edit",
+            {
+                "id": str(message.id),
+                "message": message.content,
+                "markup": message.parsed.markup,
+                "revision": message.revision,
+            },
+        )
+
+        return message
+
+    async def delete_message(self, user: User, message_id: int) -> Message:
+        """
+        Delete a message, and tell everyone which message is gone.
+        """
+        message = await Message.get(message_id)
+
+        if message is None:
+            raise MessageNotFoundError("That message does not exist.")
+
+        # Anyone with DELETE can delete their own messages, but deleting someone
+        # else's requires DELETE_OTHERS.
+        if message.author == user.username:
+            allowed = user.has_permission(
+                Permissions.DELETE | Permissions.DELETE_OTHERS
+            )
+        else:
+            allowed = user.has_permission(Permissions.DELETE_OTHERS)
+
+        if not allowed:
+            raise PermissionDeniedError(
+                "You do not have permission to delete that message."
+            )
+
+        await message.delete()
+        self.history.delete(message.id)
+        await self.publish_to_channel(
+            message.channel, "message_delete", {"id": str(message.id)}
+        )
+
+        return message
 
 
 class Context:
@@ -81,16 +519,31 @@ class Context:
     Interaction Context is an object that holds information about interactions between
     a user and the system. This is used to pass useful information between parts of the
     system, especially the command system.
+
+    One of these is made for every message, so it uses slots, and mentions and
+    args start out as empty tuples. Lists are only made when there is something
+    to put in them.
     """
 
+    __slots__ = (
+        "app",
+        "message",
+        "mentions",
+        "mentioned",
+        "is_command",
+        "command",
+        "args",
+        "channel",
+    )
+
     def __init__(self, app: "Application", message: "Message"):
         self.app: "Application" = app
         self.message = message
-        self.mentions = []
+        self.mentions: list[User] | tuple = ()
         self.mentioned = False
         self.is_command = False
         self.command = None
-        self.args = []
+        self.args: list[str] | tuple = ()
         self.channel = "general"
 
     @classmethod
@@ -103,34 +556,35 @@ class Context:
         ctx.command = await ctx.get_command()
         ctx.is_command = ctx.command is not None
 
+        # Everything after the command's name are its arguments.
+        if ctx.is_command:
+            ctx.args = message.parsed.args
+
         return ctx
 
     async def get_mentions(self) -> None:
         """
         Check if the message contains mentions.
         """
-        for word in self.message.content.split():
-            if word.startswith("@"):  # The mention character is @
-                user = await User.get(
-                    username=word[1:],
-                    sid=self.message.author.sid,
-                )  # [1:] removes the @ from the username
+        for username in self.message.parsed.mentions:
+            user = await User.get(
+                username=username,
+                sid=self.message.author.sid,
+            )
 
-                if user is not None:
-                    # If the user exists, add it to the mentions.
-                    # Commands can have multiple mentions.
-                    self.mentions.append(user)
+            if user is not None:
+                # If the user exists, add it to the mentions.
+                # Commands can have multiple mentions.
+                if not self.mentions:
+                    self.mentions = []
+
+                self.mentions.append(user)
 
     async def get_command(self) -> str:
         """
         Get the command from the message.
         """
-        if self.message.content.startswith(COMMAND_PREFIX):
-            # This list comprehension removes the first word from the message, and then
-            # joins the rest of the words back together. The [1:] removes the : from the command.
-            return self.message.content.split()[0][1:]
-
-        return None
+        return self.message.parsed.command
 
     @property
     def first_mention(self) -> User | None:
@@ -0,0 +1,5 @@
+"""
+Command plugins. Every module in here is a plugin, and any function in it that
+is decorated with commands.command becomes a command. Plugins are imported the
+first time one of their commands is used, and are reloaded when they change.
+"""
@@ -0,0 +1,123 @@
+"""
+Fun commands, for bonking, burning and insulting your friends.
+"""
+
+import random
+
+from commands import command
+from enums import MessageType
+from objects import Context, MessageResponse, Message
+
+
+@command("bonk", "Bonk a sucker on the head. Usage: ~bonk @username")
+async def bonk(ctx: Context) -> MessageResponse | None:
+    """
+    'Bonk' a user.
+    """
+    bonk_messages = [
+        "{} bonks {} on the head",
+        "{} breaks {}'s kneecaps",
+        "{} bonks {}'s head into the ground",
+        "{} bonks {}'s head into the wall",
+        "{} bonks {}'s head into the ceiling",
+        "{} bonks {}'s head into the floor",
+        "{} bonks {}'s head into the table",
+        "{} bonks {}'s head into the chair",
+        "{} bonks {}'s head into the door",
+        "{} bonks {}'s head into the window",
+        "{} bonks {}'s head into the computer",
+        "{} bonks {} into the sun",
+    ]
+
+    if not ctx.first_mention:
+        return None
+
+    return MessageResponse(
+        ctx.author,
+        ctx,
+        Message(
+            content=random.choice(bonk_messages).format(
+                ctx.message.author.display_name, ctx.first_mention.display_name
+            ),
+            author="Command Processor",
+            type=MessageType.COMMAND,
+        ),
+    )
+
+
+@command("squiddy", "Send a squidward quote. Usage: ~squiddy @username")
+async def squiddy(ctx: Context) -> MessageResponse | None:
+    """
+    Send a random squidward quote, I guess?
+    """
+    squid_mess = [
+        "{from_user}: AUGUST 12th, 2036: THE HEAT DEATH OF THE UNIVERSE! "
+        "{to}, YOUR RECKONING WILL BEFALL UPON YOU!",
+        "Bruh, your clarinet playing is so bad, it makes me want to move to a different city.",
+    ]
+    if not ctx.first_mention:
+        return None
+
+    return MessageResponse(
+        ctx.author,
+        ctx,
+        Message(
+            content=random.choice(squid_mess).format(
+                from_user=ctx.message.author.display_name,
+                to=ctx.first_mention.display_name,
+            ),
+            author="Command Processor",
+            type=MessageType.COMMAND,
+        ),
+    )
+
+
+@command("kwispy", "Light a sucker on fire. Usage: ~kwispy @username")
+async def kwispy(ctx: Context) -> MessageResponse | None:
+    """
+    Send a fire-based meme message.
+    """
+    kwispy_mess = [
+        "{} sets {} on fire.",
+        "{} sets {} alight with his magic butane blaster.",
+        "{} introduces {} to the complex process of combustion.",
+        "{} proceeds to melt {}'s face off.",
+        "{} lights {} on fire with some good ol' fasioned matches.",
+    ]
+    if not ctx.first_mention:
+        return None
+
+    return MessageResponse(
+        ctx.author,
+        ctx,
+        Message(
+            content=random.choice(kwispy_mess).format(
+                ctx.message.author.display_name, ctx.first_mention.display_name
+            ),
+            author="Command Processor",
+            type=MessageType.COMMAND,
+        ),
+    )
+
+
+@command("chirp", "Insult someone, I guess. Usage: ~chirp @username")
+async def chirp(ctx: Context) -> MessageResponse | None:
+    """
+    I don't know what this command's name is a reference to. Insult someone, I guess?
+    """
+    chirpmess = [
+        "Hey {}, why don't ya skate, ya pheasant!?",
+        "Hey {}, I've seen better hands on a digital clock!",
+    ]
+    if not ctx.first_mention:
+        return None
+
+    return MessageResponse(
+        ctx.author,
+        ctx,
+        Message(
+            content=random.choice(chirpmess).format(ctx.first_mention.display_name),
+            author="Command Processor",
+            type=MessageType.COMMAND,
+        ),
+    )
@@ -0,0 +1,84 @@
+"""
+Moderation commands, for keeping the chat in order.
+"""
+
+from commands import command
+from enums import MessageType, Permissions
+from objects import Context, MessageResponse, Message
+
+
+@command("imprison", "basically just bans a sucker. Usage: ~imprison @username")
+async def ban(ctx: Context) -> MessageResponse | None:
+    """
+    Ban a user from the chat.
+    """
+    # Can't ban a sucker if there's no sucker to ban
+    if not ctx.first_mention:
+        return None
+
+    # Can't ban a sucker if you don't have permissions to do so
+    if not ctx.message.author.has_permission(Permissions.BAN):
+        return MessageResponse(
+            ctx.author,
+            ctx,
+            Message(
+                content="You don't have permission to jail users.",
+                author="Command Processor",
+                type=MessageType.ERROR,
+            ),
+            is_ephemeral=True,
+        )
+
+    # Setting the permissions to 0 will prevent the user from doing anything
+    ctx.first_mention.permissions = Permissions(0)
+    await ctx.first_mention.save()
+
+    # Kick them out now, and make sure none of their tokens work anymore.
+    await ctx.app.revoke_sessions(ctx.first_mention.username)
+
+    return MessageResponse(
+        ctx.author,
+        ctx,
+        Message(
+            content=f"{ctx.first_mention.username} ({ctx.first_mention.display_name}) has been jailed.",
+            author="Command Processor",
+            type=MessageType.COMMAND,
+        ),
+    )
+
+
+@command("Release", "Unbans the once undesirable")
+async def release(ctx: Context) -> MessageResponse | None:
+    """
+    Unban a user from the chat.
+    """
+    # Can't release a sucker if there's no sucker to release
+    if not ctx.first_mention:
+        return None
+
+    # Can't release a sucker if you don't have permissions to do so
+    if not ctx.message.author.has_permission(Permissions.BAN):
+        return MessageResponse(
+            ctx.author,
+            ctx,
+            Message(
+                content="You don't have permission to release users.",
+                author="Command Processor",
+                type=MessageType.ERROR,
+            ),
+            is_ephemeral=True,
+        )
+
+    # Setting the permissions to 1 will allow the user to do things
+    ctx.first_mention.permissions = Permissions(71)
+    await ctx.first_mention.save()
+
+    return MessageResponse(
+        ctx.author,
+        ctx,
+        Message(
+            content=f"{ctx.first_mention.username} ({ctx.first_mention.display_name}) has been released.",
+            author="Command Processor",
+            type=MessageType.COMMAND,
+        ),
+    )
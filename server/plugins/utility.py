@@ -0,0 +1,79 @@
+"""
+Utility commands, for getting help and reminders.
+"""
+
+from commands import command
+from enums import MessageType
+from objects import Context, MessageResponse, Message
+
+
+@command("help", "Get help. Usage: ~help")
+async def help_command(ctx: Context) -> MessageResponse | None:
+    """
+    Displays all available commands and what they do. The text is made
+    whenever the commands change, so this doesn't build it every time.
+    """
+    return MessageResponse(
+        ctx.message.author,
+        ctx,
+        Message(
+            content=ctx.app.commands.catalog.help,
+            author="Command Processor",
+            type=MessageType.COMMAND,
+        ),
+        is_ephemeral=True,
+    )
+
+
+@command(
+    "remind", "Remind yourself of something later. Usage: ~remind <minutes> <message>"
+)
+async def remind(ctx: Context) -> MessageResponse | None:
+    """
+    Send the user a message after a few minutes.
+    """
+    if len(ctx.args) < 2:
+        return None
+
+    try:
+        minutes = float(ctx.args[0])
+    except ValueError:
+        return None
+
+    # Reminders only live in memory, so keep them to a day or less.
+    if not 0 < minutes <= 24 * 60:
+        return MessageResponse(
+            ctx.author,
+            ctx,
+            Message(
+                content="Reminders have to be between 0 and 1440 minutes away.",
+                author="Command Processor",
+                type=MessageType.ERROR,
+            ),
+            is_ephemeral=True,
+        )
+
+    ctx.app.send_later(
+        minutes * 60,
+        MessageResponse(
+            ctx.author,
+            ctx,
+            Message(
+                content=f"Reminder: {' '.join(ctx.args[1:])}",
+                author="Command Processor",
+                type=MessageType.COMMAND,
+            ),
+            is_ephemeral=True,
+        ),
+    )
+
+    return MessageResponse(
+        ctx.author,
+        ctx,
+        Message(
+            content=f"Okay, I'll remind you in {ctx.args[0]} minutes.",
+            author="Command Processor",
+            type=MessageType.COMMAND,
+        ),
+        is_ephemeral=True,
+    )
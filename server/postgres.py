@@ -0,0 +1,545 @@
+"""
+The PostgreSQL storage backend. Unlike SQLite, PostgreSQL can handle many writers
+at once, so this is the backend to use once one SQLite file isn't enough.
+It's picked by setting DATABASE_URL to a postgresql:// URL.
+
+Queries go through a pool of connections. asyncpg prepares every statement the
+first time a connection runs it and keeps it in that connection's statement cache,
+so after that each query only sends its parameters.
+
+To try it out locally, a throwaway PostgreSQL server will do:
+    docker run --rm -e POSTGRES_HOST_AUTH_METHOD=trust -p 5432:5432 postgres
+    DATABASE_URL=postgresql://postgres@localhost/postgres python server/server.py
+"""
+
+from typing import AsyncIterable, AsyncIterator
+from uuid import uuid4
+
+from errors import ConstraintError
+from storage import (
+    BINARY_COLUMNS,
+    CONFLICT_KEYS,
+    EXPORT_COLUMNS,
+    AttachmentRepository,
+    ConversationRepository,
+    MessageRepository,
+    Storage,
+    UserRepository,
+    import_values,
+    user_taken_error,
+)
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg is only needed if PostgreSQL is being used
+    asyncpg = None
+
+# The columns of a user that get handed around, leaving out the password.
+USER_COLUMNS = "email, username, displayname, dob, session, creation_date, permissions, token_generation"
+
+
+class PostgresUsers(UserRepository):
+    """
+    Stores users in PostgreSQL.
+    """
+
+    def __init__(self, storage: "PostgresStorage") -> None:
+        self.storage = storage
+
+    async def get(self, username: str) -> dict | None:
+        user = await self.storage.pool.fetchrow(
+            f"SELECT {USER_COLUMNS} FROM users WHERE username = $1", username
+        )
+
+        return None if user is None else dict(user)
+
+    async def get_by_session(self, session: str) -> str | None:
+        return await self.storage.pool.fetchval(
+            "SELECT username FROM users WHERE session = $1", session
+        )
+
+    async def get_password(self, username: str) -> bytes | None:
+        return await self.storage.pool.fetchval(
+            "SELECT password FROM users WHERE username = $1", username
+        )
+
+    async def create(self, user: dict, password: bytes, salt: bytes) -> None:
+        try:
+            await self.storage.pool.execute(
+                """
+                INSERT INTO users (username, email, permissions, displayname, dob, password, password_salt)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+            """,
+                user["username"],
+                user["email"],
+                user["permissions"],
+                user["displayname"],
+                user["dob"],
+                password,
+                salt,
+            )
+        except asyncpg.UniqueViolationError as error:
+            raise user_taken_error(error.constraint_name or str(error)) from error
+
+    async def update(self, username: str, user: dict) -> None:
+        try:
+            await self.storage.pool.execute(
+                """
+                UPDATE users SET username = $1, email = $2, permissions = $3, displayname = $4, dob = $5
+                WHERE username = $6
+            """,
+                user["username"],
+                user["email"],
+                user["permissions"],
+                user["displayname"],
+                user["dob"],
+                username,
+            )
+        except asyncpg.UniqueViolationError as error:
+            raise user_taken_error(error.constraint_name or str(error)) from error
+
+    async def usernames(self) -> list[str]:
+        users = await self.storage.pool.fetch("SELECT username FROM users")
+
+        return [user["username"] for user in users]
+
+    async def username_taken(self, username: str) -> bool:
+        return (
+            await self.storage.pool.fetchval(
+                "SELECT 1 FROM users WHERE username = $1", username
+            )
+            is not None
+        )
+
+    async def email_taken(self, email: str) -> bool:
+        return (
+            await self.storage.pool.fetchval(
+                "SELECT 1 FROM users WHERE email = $1 LIMIT 1", email
+            )
+            is not None
+        )
+
+    async def set_session(self, username: str, session: str) -> None:
+        await self.storage.pool.execute(
+            "UPDATE users SET session = $1 WHERE username = $2", session, username
+        )
+
+    async def token_generations(self) -> dict[str, int]:
+        users = await self.storage.pool.fetch(
+            "SELECT username, token_generation FROM users WHERE token_generation > 0"
+        )
+
+        return {user["username"]: user["token_generation"] for user in users}
+
+    async def revoke_tokens(self, username: str) -> int:
+        generation = await self.storage.pool.fetchval(
+            """
+            UPDATE users SET token_generation = token_generation + 1
+            WHERE username = $1 RETURNING token_generation
+        """,
+            username,
+        )
+
+        return generation or 0
+
+
+class PostgresMessages(MessageRepository):
+    """
+    Stores messages in PostgreSQL.
+    """
+
+    def __init__(self, storage: "PostgresStorage") -> None:
+        self.storage = storage
+
+    async def get(self, id: int) -> dict | None:
+        message = await self.storage.pool.fetchrow(
+            "SELECT * FROM messages WHERE id = $1 AND deleted = 0", id
+        )
+
+        return None if message is None else dict(message)
+
+    async def insert(self, message: dict) -> None:
+        await self.storage.pool.execute(
+            """
+            INSERT INTO messages (id, message, author, channel, created_at, attachments)
+            VALUES ($1, $2, $3, $4, $5, $6)
+        """,
+            message["id"],
+            message["message"],
+            message["author"],
+            message["channel"],
+            message["created_at"],
+            message.get("attachments"),
+        )
+
+    async def edit(self, id: int, content: str, revision: int) -> None:
+        await self.storage.pool.execute(
+            "UPDATE messages SET message = $1, revision = $2 WHERE id = $3",
+            content,
+            revision,
+            id,
+        )
+
+    async def delete(self, id: int) -> None:
+        await self.storage.pool.execute(
+            "UPDATE messages SET message = '', deleted = 1 WHERE id = $1", id
+        )
+
+    async def recent(
+        self, channel: str, amount: int, before: int | None = None
+    ) -> list[dict]:
+        messages = await self.storage.pool.fetch(
+            """
+            SELECT * FROM messages
+            WHERE channel = $1 AND id < $2 AND deleted = 0
+            ORDER BY id DESC LIMIT $3
+        """,
+            channel,
+            before if before is not None else 2**63 - 1,
+            amount,
+        )
+
+        return [dict(message) for message in messages][::-1]
+
+    async def after(self, channel: str, after: int, amount: int) -> list[dict]:
+        messages = await self.storage.pool.fetch(
+            """
+            SELECT * FROM messages
+            WHERE channel = $1 AND id > $2 AND deleted = 0
+            ORDER BY id LIMIT $3
+        """,
+            channel,
+            after,
+            amount,
+        )
+
+        return [dict(message) for message in messages]
+
+
+class PostgresConversations(ConversationRepository):
+    """
+    Stores conversations in PostgreSQL.
+    """
+
+    def __init__(self, storage: "PostgresStorage") -> None:
+        self.storage = storage
+
+    async def get(self, id: int) -> dict | None:
+        conversation = await self.storage.pool.fetchrow(
+            "SELECT * FROM conversations WHERE id = $1", id
+        )
+
+        return None if conversation is None else dict(conversation)
+
+    async def find(self, members: str) -> dict | None:
+        conversation = await self.storage.pool.fetchrow(
+            "SELECT * FROM conversations WHERE members = $1", members
+        )
+
+        return None if conversation is None else dict(conversation)
+
+    async def create(self, conversation: dict, usernames: list[str]) -> None:
+        async with self.storage.pool.acquire() as conn:
+            async with conn.transaction():
+                try:
+                    await conn.execute(
+                        "INSERT INTO conversations (id, members, created_at) VALUES ($1, $2, $3)",
+                        conversation["id"],
+                        conversation["members"],
+                        conversation["created_at"],
+                    )
+                except asyncpg.UniqueViolationError as error:
+                    raise ConstraintError(
+                        "That conversation already exists."
+                    ) from error
+                await conn.executemany(
+                    "INSERT INTO conversation_members (conversation_id, username) VALUES ($1, $2)",
+                    [(conversation["id"], username) for username in usernames],
+                )
+
+    async def for_user(self, username: str) -> list[dict]:
+        conversations = await self.storage.pool.fetch(
+            """
+            SELECT conversations.*, conversation_members.unread, conversation_members.last_read_id
+            FROM conversation_members
+            JOIN conversations ON conversations.id = conversation_members.conversation_id
+            WHERE conversation_members.username = $1
+            ORDER BY conversations.id DESC
+        """,
+            username,
+        )
+
+        return [dict(conversation) for conversation in conversations]
+
+    async def mark_unread(self, id: int, author: str) -> None:
+        await self.storage.pool.execute(
+            """
+            UPDATE conversation_members SET unread = unread + 1
+            WHERE conversation_id = $1 AND username != $2
+        """,
+            id,
+            author,
+        )
+
+    async def mark_read(
+        self, id: int, channel: str, username: str, last_read_id: int
+    ) -> None:
+        await self.storage.pool.execute(
+            """
+            UPDATE conversation_members SET
+                last_read_id = GREATEST(last_read_id, $1),
+                unread = (
+                    SELECT count(*) FROM messages
+                    WHERE channel = $2 AND id > GREATEST(conversation_members.last_read_id, $1)
+                    AND author != $4 AND deleted = 0
+                )
+            WHERE conversation_id = $3 AND username = $4
+        """,
+            last_read_id,
+            channel,
+            id,
+            username,
+        )
+
+
+class PostgresAttachments(AttachmentRepository):
+    """
+    Stores attachments in PostgreSQL.
+    """
+
+    def __init__(self, storage: "PostgresStorage") -> None:
+        self.storage = storage
+
+    async def get(self, id: int) -> dict | None:
+        attachment = await self.storage.pool.fetchrow(
+            "SELECT * FROM attachments WHERE id = $1", id
+        )
+
+        return None if attachment is None else dict(attachment)
+
+    async def create(self, attachment: dict) -> None:
+        await self.storage.pool.execute(
+            """
+            INSERT INTO attachments (id, hash, filename, content_type, size, uploader, created_at, thumbnail)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+        """,
+            attachment["id"],
+            attachment["hash"],
+            attachment["filename"],
+            attachment["content_type"],
+            attachment["size"],
+            attachment["uploader"],
+            attachment["created_at"],
+            int(attachment["thumbnail"]),
+        )
+
+
+class PostgresStorage(Storage):
+    """
+    Keeps the app's data in PostgreSQL, through a pool of connections.
+    """
+
+    def __init__(self, url: str, min_size: int = 2, max_size: int = 10) -> None:
+        self.url = url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool: "asyncpg.Pool"
+        self.users = PostgresUsers(self)
+        self.messages = PostgresMessages(self)
+        self.conversations = PostgresConversations(self)
+        self.attachments = PostgresAttachments(self)
+
+    async def connect(self) -> None:
+        if asyncpg is None:
+            raise RuntimeError("asyncpg has to be installed to use PostgreSQL.")
+
+        self.pool = await asyncpg.create_pool(
+            self.url,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            statement_cache_size=256,
+        )
+
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS users (
+                    email TEXT NOT NULL,
+                    username TEXT NOT NULL,
+                    password BYTEA NOT NULL,
+                    password_salt BYTEA NOT NULL,
+                    displayname TEXT NOT NULL,
+                    dob TEXT NOT NULL,
+                    session TEXT NULL,
+                    creation_date TEXT DEFAULT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS'),
+                    permissions INTEGER DEFAULT 71,
+                    token_generation INTEGER NOT NULL DEFAULT 0
+                );
+
+                -- Databases made before token generations existed need the column added.
+                ALTER TABLE users ADD COLUMN IF NOT EXISTS token_generation INTEGER NOT NULL DEFAULT 0;
+
+                CREATE INDEX IF NOT EXISTS users_session ON users (session);
+                -- Revoked tokens are synced every few seconds, and few users
+                -- ever have any, so only they are indexed.
+                CREATE INDEX IF NOT EXISTS users_revoked ON users (token_generation)
+                    WHERE token_generation > 0;
+
+                CREATE TABLE IF NOT EXISTS messages (
+                    id BIGINT PRIMARY KEY,
+                    message TEXT NOT NULL,
+                    author TEXT NOT NULL,
+                    channel TEXT NOT NULL,
+                    created_at BIGINT NOT NULL,
+                    revision INTEGER NOT NULL DEFAULT 0,
+                    deleted INTEGER NOT NULL DEFAULT 0,
+                    attachments TEXT NULL
+                );
+
+                ALTER TABLE messages ADD COLUMN IF NOT EXISTS attachments TEXT NULL;
+
+                CREATE INDEX IF NOT EXISTS messages_channel_id ON messages (channel, id);
+
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id BIGINT PRIMARY KEY,
+                    members TEXT NOT NULL UNIQUE,
+                    created_at BIGINT NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS conversation_members (
+                    conversation_id BIGINT NOT NULL,
+                    username TEXT NOT NULL,
+                    unread INTEGER NOT NULL DEFAULT 0,
+                    last_read_id BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (username, conversation_id)
+                );
+
+                CREATE INDEX IF NOT EXISTS conversation_members_conversation
+                    ON conversation_members (conversation_id);
+
+                CREATE TABLE IF NOT EXISTS attachments (
+                    id BIGINT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    content_type TEXT NOT NULL,
+                    size BIGINT NOT NULL,
+                    uploader TEXT NOT NULL,
+                    created_at BIGINT NOT NULL,
+                    thumbnail INTEGER NOT NULL DEFAULT 0
+                );
+            """
+            )
+
+            # Nothing used to stop two people signing up with the same username.
+            # Only the first of them can ever log in, so the rest are dropped
+            # before usernames are made unique.
+            if await conn.fetchval("SELECT to_regclass('users_username')") is None:
+                async with conn.transaction():
+                    status = await conn.execute(
+                        """
+                        DELETE FROM users a USING users b
+                        WHERE a.username = b.username AND a.ctid > b.ctid
+                    """
+                    )
+                    await conn.execute(
+                        "CREATE UNIQUE INDEX users_username ON users (username)"
+                    )
+
+                # The status is "DELETE <rows>".
+                if (removed := int(status.split()[-1])) > 0:
+                    print(f"Removed {removed} users with duplicate usernames")
+
+            # Emails weren't unique either, and were only checked before signing
+            # up, so two people could race for one. The oldest account keeps it.
+            if not await conn.fetchval(
+                "SELECT indisunique FROM pg_index WHERE indexrelid = to_regclass('users_email')"
+            ):
+                async with conn.transaction():
+                    status = await conn.execute(
+                        """
+                        DELETE FROM users a USING users b
+                        WHERE a.email = b.email AND a.ctid > b.ctid
+                    """
+                    )
+                    await conn.execute("DROP INDEX IF EXISTS users_email")
+                    await conn.execute(
+                        "CREATE UNIQUE INDEX users_email ON users (email)"
+                    )
+
+                if (removed := int(status.split()[-1])) > 0:
+                    print(f"Removed {removed} users with duplicate emails")
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    async def iter_rows(
+        self, table: str, batch_size: int = 1000
+    ) -> AsyncIterator[dict]:
+        columns = EXPORT_COLUMNS[table]
+        binary = BINARY_COLUMNS[table]
+        order = " ORDER BY id" if "id" in columns else ""
+
+        # Cursors only work inside a transaction. The rows are fetched
+        # batch_size at a time, so only one batch is ever in memory.
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(
+                    f"SELECT {', '.join(columns)} FROM {table}{order}",
+                    prefetch=batch_size,
+                ):
+                    row = dict(row)
+
+                    for column in binary:
+                        if isinstance(row[column], bytes):
+                            row[column] = row[column].decode("utf-8")
+
+                    yield row
+
+    async def import_rows(
+        self,
+        table: str,
+        rows: AsyncIterable[dict],
+        batch_size: int = 1000,
+    ) -> int:
+        columns = EXPORT_COLUMNS[table]
+        staging = f"import_{uuid4().hex}"
+
+        async with self.pool.acquire() as conn:
+            try:
+                # One transaction, so the rows all go in or none do. They're
+                # copied into a temporary table first, which is much faster
+                # than inserting them. It has no constraints, so only the
+                # final insert can fail, and it's dropped with the transaction.
+                async with conn.transaction():
+                    await conn.execute(
+                        f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                        f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA"
+                    )
+                    batch = []
+                    count = 0
+
+                    async for row in rows:
+                        count += 1
+                        batch.append(import_values(table, row, count))
+
+                        if len(batch) >= batch_size:
+                            await conn.copy_records_to_table(
+                                staging, records=batch, columns=columns
+                            )
+                            batch.clear()
+
+                    if batch:
+                        await conn.copy_records_to_table(
+                            staging, records=batch, columns=columns
+                        )
+
+                    status = await conn.execute(
+                        f"INSERT INTO {table} ({', '.join(columns)}) "
+                        f"SELECT {', '.join(columns)} FROM {staging} "
+                        f"ON CONFLICT ({', '.join(CONFLICT_KEYS[table])}) DO NOTHING"
+                    )
+            except asyncpg.IntegrityConstraintViolationError as error:
+                raise ConstraintError(str(error)) from error
+
+        # The status is "INSERT 0 <rows>".
+        return int(status.split()[-1])
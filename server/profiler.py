@@ -0,0 +1,77 @@
+"""
+A sampling profiler for the running server. For a few seconds, it looks at what
+every thread is doing many times a second, and counts how often each stack was
+seen. The result is in the "folded stacks" format, which flamegraph.pl, inferno
+and https://www.speedscope.app turn into a flamegraph.
+
+Sampling only reads the stacks, so the server keeps running normally while it's
+being profiled, just a little slower.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+
+from config import PROFILE_INTERVAL
+from errors import ProfilerBusyError
+
+
+class SamplingProfiler:
+    """
+    Takes one profile at a time, in its own thread, so the event loop is
+    sampled while it carries on.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL) -> None:
+        self.interval = interval
+        self.running = False
+
+    async def profile(self, seconds: float) -> str:
+        """
+        Sample every thread for a number of seconds, and get the folded stacks.
+        """
+        if self.running:
+            raise ProfilerBusyError("A profile is already being taken.")
+
+        self.running = True
+
+        try:
+            samples = await asyncio.to_thread(self.sample, seconds)
+        finally:
+            self.running = False
+
+        return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+    def sample(self, seconds: float) -> Counter[str]:
+        """
+        Count the stacks every thread but this one is in, until the time is up.
+        """
+        me = threading.get_ident()
+        samples: Counter[str] = Counter()
+        deadline = time.monotonic() + seconds
+
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+
+                stack.append(names.get(ident, str(ident)))
+                stack.reverse()
+                samples[";".join(stack)] += 1
+
+            time.sleep(self.interval)
+
+        return samples
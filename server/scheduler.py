@@ -0,0 +1,214 @@
+"""
+The scheduler runs background jobs for the app, such as things that need to
+happen every few minutes, or a reply that should be sent a little later.
+Everything runs on the event loop, and every job is cancelled on shutdown.
+"""
+
+import asyncio
+import random
+from itertools import count
+from typing import Any, Awaitable, Callable
+
+JobCallback = Callable[..., Awaitable[Any]]
+
+
+class Job:
+    """
+    A job that the scheduler runs, either once or every interval seconds.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        callback: JobCallback,
+        args: tuple = (),
+        interval: float | None = None,
+        delay: float = 0,
+        jitter: float = 0,
+        max_concurrency: int = 1,
+    ):
+        self.name = name
+        self.callback = callback
+        self.args = args
+        self.interval = interval  # None means the job only runs once
+        self.delay = delay  # How long to wait before the first run
+        self.jitter = jitter  # Up to this many extra seconds are added to each wait
+        self.max_concurrency = max_concurrency
+        self.running: set[asyncio.Task] = set()
+        self.loop_task: asyncio.Task | None = None
+        self.runs = 0
+        self.skipped = 0  # Runs skipped because the last ones were still going
+        self.failures = 0
+
+    @property
+    def is_repeating(self) -> bool:
+        return self.interval is not None
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "running": len(self.running),
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "failures": self.failures,
+        }
+
+
+class Scheduler:
+    """
+    Runs jobs in the background. Jobs can be added at any time, but they only start
+    running once the scheduler has been started.
+    """
+
+    def __init__(self):
+        self.jobs: dict[str, Job] = {}
+        self.started = False
+        self._ids = count()
+
+    def every(
+        self,
+        interval: float,
+        callback: JobCallback,
+        *args,
+        name: str | None = None,
+        delay: float | None = None,
+        jitter: float = 0,
+        max_concurrency: int = 1,
+    ) -> Job:
+        """
+        Run a job every interval seconds. If max_concurrency runs are still going
+        when the next one is due, that run is skipped rather than piling up.
+        """
+        return self._add(
+            Job(
+                name or self._name(callback),
+                callback,
+                args,
+                interval=interval,
+                delay=interval if delay is None else delay,
+                jitter=jitter,
+                max_concurrency=max_concurrency,
+            )
+        )
+
+    def call_later(
+        self,
+        delay: float,
+        callback: JobCallback,
+        *args,
+        name: str | None = None,
+        jitter: float = 0,
+    ) -> Job:
+        """
+        Run a job once, after delay seconds.
+        """
+        return self._add(
+            Job(
+                name or self._name(callback), callback, args, delay=delay, jitter=jitter
+            )
+        )
+
+    def cancel(self, name: str) -> bool:
+        """
+        Stop a job from running again. Runs that are already going are cancelled too.
+        Returns whether there was a job with that name.
+        """
+        job = self.jobs.pop(name, None)
+
+        if job is None:
+            return False
+
+        if job.loop_task is not None:
+            job.loop_task.cancel()
+
+        for task in job.running:
+            task.cancel()
+
+        return True
+
+    def start(self) -> None:
+        """
+        Start running every job. This has to be called from inside the event loop.
+        """
+        self.started = True
+
+        for job in self.jobs.values():
+            self._start(job)
+
+    async def shutdown(self) -> None:
+        """
+        Cancel every job, and wait for them all to stop.
+        """
+        self.started = False
+        tasks = []
+
+        for name in list(self.jobs):
+            job = self.jobs[name]
+            tasks.extend(job.running)
+
+            if job.loop_task is not None:
+                tasks.append(job.loop_task)
+
+            self.cancel(name)
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> list[dict]:
+        return [job.stats() for job in self.jobs.values()]
+
+    def _name(self, callback: JobCallback) -> str:
+        return f"{getattr(callback, '__name__', 'job')}-{next(self._ids)}"
+
+    def _add(self, job: Job) -> Job:
+        # Replacing a job stops the old one.
+        self.cancel(job.name)
+        self.jobs[job.name] = job
+
+        if self.started:
+            self._start(job)
+
+        return job
+
+    def _start(self, job: Job) -> None:
+        if job.loop_task is None:
+            job.loop_task = asyncio.create_task(self._loop(job))
+
+    async def _loop(self, job: Job) -> None:
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + job.delay
+
+        while True:
+            await asyncio.sleep(
+                max(next_run - loop.time(), 0) + random.uniform(0, job.jitter)
+            )
+
+            if not job.is_repeating:
+                await self._run(job)
+                break
+
+            if len(job.running) >= job.max_concurrency:
+                # The last run is taking longer than the interval. Skip this one.
+                job.skipped += 1
+            else:
+                task = asyncio.create_task(self._run(job))
+                job.running.add(task)
+                task.add_done_callback(job.running.discard)
+
+            # If we've fallen behind, don't try to make up for the missed runs.
+            next_run = max(next_run + job.interval, loop.time())
+
+        # One-shot jobs are forgotten once they have run.
+        if self.jobs.get(job.name) is job:
+            del self.jobs[job.name]
+
+    async def _run(self, job: Job) -> None:
+        job.runs += 1
+
+        try:
+            await job.callback(*job.args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            job.failures += 1
+            print(f"Job {job.name} failed: {error}")
@@ -4,21 +4,56 @@ the HTTP requests.
 """
 
 import asyncio
+import functools
+import zlib
 
 import hypercorn.asyncio as hasync
 import hypercorn.config as hconfig
 import socketio
+import ndjson
+from attachments import attachment_sendable, is_inline
 from commands import command_register
 from database import User, db, Message, MessageResponse
 from enums import MessageType, Permissions
 from objects import Application, Context
-from config import COMMAND_PREFIX, REQUIRED_USER_FIELDS
-from quart import Quart, request, jsonify
+from config import (
+    BIND,
+    COMMAND_PREFIX,
+    DRAIN_TIMEOUT,
+    MAX_CONVERSATION_MEMBERS,
+    MAX_MESSAGE_LENGTH,
+    MESSAGE_QUEUE_URL,
+    PROFILE_MAX_SECONDS,
+    REQUIRED_USER_FIELDS,
+    REUSE_PORT,
+    TRACE_FILE,
+)
+from conversations import dm_channel, is_dm_channel
+from errors import (
+    AttachmentTooLargeError,
+    ConstraintError,
+    ConversationNotFoundError,
+    MessageNotFoundError,
+    PermissionDeniedError,
+    PluginImportError,
+    ProfilerBusyError,
+)
+import listeners
+from profiler import SamplingProfiler
+from sessions import user_room
+from snowflake import parse_id
+from storage import EXPORT_COLUMNS
+from traces import TraceRecorder
+import spans
+from spans import span, traced
+from quart import Quart, g, request, jsonify, send_file
 from quart_cors import cors
+from werkzeug.routing import IntegerConverter
 from quart_jwt_extended import (
     JWTManager,
     create_access_token,
     decode_token,
+    get_jwt_identity,
     jwt_required,
 )
 from dotenv import load_dotenv
@@ -29,17 +64,133 @@ load_dotenv()
 # Define the socketIO server and the Quart app
 # SocketIO controls the chat functionality, while Quart
 # handles HTTP requests for using the API.
-sio = socketio.AsyncServer(cors_allowed_origins="*", async_mode="asgi")
+# With a message queue, servers can send events to clients connected to each other.
+sio = socketio.AsyncServer(
+    cors_allowed_origins="*",
+    async_mode="asgi",
+    client_manager=(
+        socketio.AsyncRedisManager(MESSAGE_QUEUE_URL) if MESSAGE_QUEUE_URL else None
+    ),
+)
 app = Quart(__name__, instance_relative_config=True)
 app = cors(app, allow_origin="*")
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET")
+# Tokens never expire, so revoked ones have to be turned away instead.
+app.config["JWT_BLACKLIST_ENABLED"] = True
+app.config["JWT_BLACKLIST_TOKEN_CHECKS"] = ["access"]
+
+
+class IDConverter(IntegerConverter):
+    """
+    Matches IDs in URLs. They're stored as 64-bit integers, so bigger numbers
+    don't match at all, instead of overflowing when they're looked up.
+    """
+
+    def __init__(self, map, *args, **kwargs):
+        super().__init__(map, max=2**63 - 1)
+
+
+app.url_map.converters["id"] = IDConverter
 
 # Connect to the database and connect an ASGI app to the socketIO server
 # in this case, Hypercorn is used as the ASGI server.
 sio_app = socketio.ASGIApp(sio, app)
-hypercorn_config = hconfig.Config.from_mapping(bind=["localhost:5000"], debug=True)
+# Connections get the whole drain to finish before Hypercorn gives up on them.
+hypercorn_config = hconfig.Config.from_mapping(
+    bind=BIND, debug=True, graceful_timeout=DRAIN_TIMEOUT + 5
+)
+command_register.discover()
 server = Application(db, sio, command_register)
 jwt = JWTManager(app)
+# Records what clients send, so the simulator can replay it later.
+recorder = TraceRecorder(TRACE_FILE) if TRACE_FILE else None
+profiler = SamplingProfiler()
+
+
+def trace(event: str, sid: str, user: str | None = None, data: object = None) -> None:
+    """
+    Record an event a client sent, if traces are being recorded.
+    """
+    if recorder is not None:
+        recorder.record(event, sid, user, data)
+
+
+def handled(function):
+    """
+    Count a socket event as being handled until it's done, so the server
+    doesn't go down halfway through saving or sending something.
+    """
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        with server.handling():
+            return await function(*args, **kwargs)
+
+    return wrapper
+
+
+def token_generation(token: dict) -> int:
+    """
+    Get the generation a token was made in. Tokens made before generations
+    existed are treated as generation 0.
+    """
+    return (token.get("user_claims") or {}).get("generation", 0)
+
+
+@jwt.token_in_blacklist_loader
+def token_revoked(token: dict) -> bool:
+    """
+    Check whether a token has been revoked. This runs on every request
+    that needs a token, so it only looks in memory.
+    """
+    return server.sessions.is_revoked(token["identity"], token_generation(token))
+
+
+@app.before_serving
+async def startup() -> None:
+    """
+    Start the app's background work once the server is up.
+    """
+    await server.start()
+
+
+@app.after_serving
+async def shutdown() -> None:
+    """
+    Stop the app's background work before the server goes down. If it wasn't
+    drained yet, it is first.
+    """
+    await server.drain()
+    await server.shutdown()
+    spans.close()
+
+    if recorder is not None:
+        recorder.close()
+
+
+@app.before_request
+async def start_request_span() -> None:
+    """
+    Start a trace for every HTTP request.
+    """
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    g.span = span(f"http.{request.method} {rule}", root=True)
+    g.span.__enter__()
+
+
+@app.after_request
+async def tag_request_span(response):
+    g.span.set("status", response.status_code)
+
+    return response
+
+
+@app.teardown_request
+async def end_request_span(error: BaseException | None) -> None:
+    request_span = g.pop("span", None)
+
+    if request_span is not None:
+        request_span.__exit__(None, error, None)
 
 
 @app.route("/api/signup", methods=["POST"])
@@ -61,29 +212,89 @@ async def signup() -> tuple[dict[str, str], int]:
     # Get the data from the request
     data: dict[str, str] = await request.get_json()
 
-    # Make sure all of the necessary information is supplied by the client
-    if not data or not all(key in data and data[key] for key in REQUIRED_USER_FIELDS):
+    if not isinstance(data, dict):
         return {"status": "error", "message": "Invalid data"}, 400
 
+    # Check everything at once, so the user can fix every problem in one go.
+    errors = {
+        key: "This is required."
+        for key in REQUIRED_USER_FIELDS
+        if not isinstance(data.get(key), str) or not data[key]
+    }
+
     # Check if the email is valid, poorly. Maybe regex would be helpful here?
-    if data["email"].find("@") == -1 or data["email"].find(".") == -1:
-        return {"status": "error", "message": "Invalid email"}, 400
+    if "email" not in errors and (
+        data["email"].find("@") == -1 or data["email"].find(".") == -1
+    ):
+        errors["email"] = "Invalid email"
+
+    if errors:
+        return {"status": "error", "message": "Invalid data", "errors": errors}, 400
+
+    # These are much cheaper than hashing the password, so do them first.
+    if not await server.username_available(data["username"]):
+        errors["username"] = "That username is taken."
+
+    if await db.users.email_taken(data["email"]):
+        errors["email"] = "That email is already in use."
+
+    if errors:
+        return {"status": "error", "message": "Already in use", "errors": errors}, 409
 
     # If there is no display name, set it to the username
     if not data.get("displayname"):
         data["displayname"] = data["username"]
 
-    # Create a user object and insert it into the database
-    user = await User(
-        username=data["username"],
-        email=data["email"],
-        displayname=data["displayname"],
-        dob=data["dob"],
-    ).create(data["password"])
+    # Create a user object and insert it into the database. Two people can
+    # still race for the same username or email, and the database picks the
+    # winner.
+    try:
+        user = await User(
+            username=data["username"],
+            email=data["email"],
+            displayname=data["displayname"],
+            dob=data["dob"],
+        ).create(data["password"])
+    except ConstraintError as error:
+        if error.field == "username":
+            server.usernames.add(data["username"])
+
+        return {
+            "status": "error",
+            "message": "Already in use",
+            "errors": {error.field or "username": str(error)},
+        }, 409
+
+    server.usernames.add(user.username)
 
     return {"status": "success", "user": user.as_sendable()}, 200
 
 
+@app.route("/api/signup/available", methods=["GET"])
+async def signup_available() -> tuple[dict[str, str | bool], int]:
+    """
+    Check whether a username or email (or both) can still be signed up with,
+    so the signup form can say so while the user is typing.
+
+    Query example: /api/signup/available?username=test&email=test@test.test
+    """
+    username = request.args.get("username")
+    email = request.args.get("email")
+
+    if not username and not email:
+        return {"status": "error", "message": "Give a username or an email"}, 400
+
+    response = {"status": "success"}
+
+    if username:
+        response["username"] = await server.username_available(username)
+
+    if email:
+        response["email"] = not await db.users.email_taken(email)
+
+    return response, 200
+
+
 @app.route("/api/login", methods=["POST"])
 async def login() -> tuple[dict[str, str], int]:
     """
@@ -113,7 +324,11 @@ async def login() -> tuple[dict[str, str], int]:
     # The check_password function will return True if the password matches,
     # and False if it does not.
     if await user.check_password(data["password"]):
-        access_token = create_access_token(identity=user.username, expires_delta=False)
+        access_token = create_access_token(
+            identity=user.username,
+            expires_delta=False,
+            user_claims={"generation": user.token_generation},
+        )
 
         return jsonify(body={"status": "success"}, access_token=access_token), 200
 
@@ -121,6 +336,18 @@ async def login() -> tuple[dict[str, str], int]:
     return {"status": "error", "message": "Incorrect password"}, 401
 
 
+@app.route("/api/logout", methods=["POST"])
+@jwt_required
+async def logout():
+    """
+    Log out everywhere. Every token the user has stops working, and all of
+    their connections are closed.
+    """
+    await server.revoke_sessions(get_jwt_identity())
+
+    return {"status": "success"}, 200
+
+
 @app.route("/api/user/<username>", methods=["GET"])
 async def get_user(username) -> tuple[dict[str, str | dict], int]:
     """
@@ -154,31 +381,473 @@ async def validate_token():
     return {"status": "success", "message": "Token is valid"}, 200
 
 
+@app.route("/api/commands", methods=["GET"])
+async def get_commands():
+    """
+    Get every command, what it does and the arguments it takes, so clients can
+    autocomplete them. The list only changes when plugins do, so clients should
+    send the ETag back in If-None-Match, and they'll get a 304 until it changes.
+    """
+    catalog = server.commands.catalog
+    headers = {"ETag": f'"{catalog.etag}"', "Cache-Control": "no-cache"}
+
+    if request.if_none_match.contains(catalog.etag):
+        return "", 304, headers
+
+    return catalog.body, 200, {**headers, "Content-Type": "application/json"}
+
+
 @app.route("/api/messages", methods=["GET"])
 @jwt_required
 async def get_messages():
     """
-    Get all messages from the database
+    Get the most recent messages in a channel. Older messages can be paged through
+    by passing the ID of the oldest message you have as "before".
+
+    /api/messages?channel=general&before=1234&limit=50
     """
-    raw_messages = await db.get_messages()
-    messages = []
+    channel = request.args.get("channel", "general")
 
-    for message in raw_messages:
-        messages.append(
-            Message(
-                message["message"],
-                message["author"],
-                message["id"],
-                message["channel"],
-                message["timestamp"],
-                MessageType.NORMAL,
-            ).as_sendable()
-        )
+    # Direct messages are only for the people in them.
+    if is_dm_channel(channel):
+        return {
+            "status": "error",
+            "message": "Use /api/conversations for direct messages",
+        }, 400
+
+    before = request.args.get("before", type=parse_id)
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+
+    raw_messages = await db.messages.recent(channel, limit, before)
+    messages = [Message.from_row(message).as_sendable() for message in raw_messages]
 
     return {"status": "success", "messages": messages}, 200
 
 
+@app.route("/api/messages/<id:message_id>", methods=["PATCH"])
+@jwt_required
+async def edit_message(message_id: int):
+    """
+    Edit one of your messages.
+
+    Data example:
+    {
+        "message": "The new content"
+    }
+    """
+    data = await request.get_json()
+    user = await User.get(get_jwt_identity())
+
+    if user is None:
+        return {"status": "error", "message": "User does not exist"}, 401
+
+    if not data or not isinstance(data.get("message"), str):
+        return {"status": "error", "message": "Invalid data"}, 400
+
+    try:
+        message = await server.edit_message(user, message_id, data["message"])
+    except ValueError as error:
+        return {"status": "error", "message": str(error)}, 400
+    except PermissionDeniedError as error:
+        return {"status": "error", "message": str(error)}, 403
+    except MessageNotFoundError as error:
+        return {"status": "error", "message": str(error)}, 404
+
+    return {"status": "success", "message": message.as_sendable()}, 200
+
+
+@app.route("/api/messages/<id:message_id>", methods=["DELETE"])
+@jwt_required
+async def delete_message(message_id: int):
+    """
+    Delete a message.
+    """
+    user = await User.get(get_jwt_identity())
+
+    if user is None:
+        return {"status": "error", "message": "User does not exist"}, 401
+
+    try:
+        await server.delete_message(user, message_id)
+    except PermissionDeniedError as error:
+        return {"status": "error", "message": str(error)}, 403
+    except MessageNotFoundError as error:
+        return {"status": "error", "message": str(error)}, 404
+
+    return {"status": "success"}, 200
+
+
+@app.route("/api/conversations", methods=["GET"])
+@jwt_required
+async def get_conversations():
+    """
+    Get every direct message conversation you're in, with how many of their
+    messages you haven't read.
+    """
+    conversations = await server.conversations.for_user(get_jwt_identity())
+
+    return {"status": "success", "conversations": conversations}, 200
+
+
+@app.route("/api/conversations", methods=["POST"])
+@jwt_required
+async def open_conversation():
+    """
+    Start a direct message conversation, or get the one you already have with
+    the same people.
+
+    Data example:
+    {
+        "members": ["test2", "test3"]
+    }
+    """
+    data = await request.get_json()
+    username = get_jwt_identity()
+
+    if not data or not isinstance(data.get("members"), list):
+        return {"status": "error", "message": "Invalid data"}, 400
+
+    members = {str(member) for member in data["members"]} | {username}
+
+    if len(members) > MAX_CONVERSATION_MEMBERS:
+        return {
+            "status": "error",
+            "message": f"Conversations can have up to {MAX_CONVERSATION_MEMBERS} people in them.",
+        }, 400
+
+    for member in members:
+        if await User.get(member) is None:
+            return {"status": "error", "message": f"User {member} does not exist"}, 404
+
+    try:
+        conversation = await server.conversations.open(list(members))
+    except ValueError as error:
+        return {"status": "error", "message": str(error)}, 400
+
+    return {
+        "status": "success",
+        "conversation": {"id": str(conversation["id"]), "members": sorted(members)},
+    }, 200
+
+
+@app.route("/api/conversations/<id:conversation_id>/messages", methods=["GET"])
+@jwt_required
+async def get_conversation_messages(conversation_id: int):
+    """
+    Get the most recent messages in a conversation. Like /api/messages, older
+    messages can be paged through with "before".
+
+    /api/conversations/1234/messages?before=5678&limit=50
+    """
+    try:
+        await server.conversations.check_member(conversation_id, get_jwt_identity())
+    except ConversationNotFoundError as error:
+        return {"status": "error", "message": str(error)}, 404
+
+    before = request.args.get("before", type=parse_id)
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+
+    raw_messages = await db.messages.recent(dm_channel(conversation_id), limit, before)
+    messages = [Message.from_row(message).as_sendable() for message in raw_messages]
+
+    return {"status": "success", "messages": messages}, 200
+
+
+@app.route("/api/conversations/<id:conversation_id>/read", methods=["POST"])
+@jwt_required
+async def read_conversation(conversation_id: int):
+    """
+    Mark a conversation as read, up to the last message you've seen.
+
+    Data example:
+    {
+        "last_read_id": "370502957784911872"
+    }
+    """
+    data = await request.get_json()
+    username = get_jwt_identity()
+
+    try:
+        last_read_id = parse_id(data.get("last_read_id"))
+    except (AttributeError, TypeError, ValueError):
+        return {"status": "error", "message": "Invalid data"}, 400
+
+    try:
+        await server.conversations.check_member(conversation_id, username)
+    except ConversationNotFoundError as error:
+        return {"status": "error", "message": str(error)}, 404
+
+    await db.conversations.mark_read(
+        conversation_id, dm_channel(conversation_id), username, last_read_id
+    )
+
+    return {"status": "success"}, 200
+
+
+@app.route("/api/attachments", methods=["POST"])
+@jwt_required
+async def upload_attachment():
+    """
+    Upload a file to attach to messages. The body is the file itself, not a
+    form, so it can be written to disk as it arrives. Its name is given with
+    the "filename" query parameter, and its type with the Content-Type header.
+
+    curl -H "Authorization: Bearer <token>" -H "Content-Type: image/png" --data-binary @cat.png "http://127.0.0.1:5000/api/attachments?filename=cat.png"
+
+    The attachment's ID can then be sent with a message:
+    {"message": "Look at my cat", "attachments": ["370502957784911872"]}
+    """
+    user = await User.get(get_jwt_identity())
+
+    if user is None or not user.has_permission(Permissions.SEND):
+        return {
+            "status": "error",
+            "message": "You do not have permission to upload files",
+        }, 403
+
+    # Turn away files that say they're too big before reading any of them.
+    if (request.content_length or 0) > server.attachments.max_size:
+        return {"status": "error", "message": "That file is too big"}, 413
+
+    try:
+        attachment = await server.attachments.create(
+            request.body,
+            request.args.get("filename"),
+            request.headers.get("Content-Type"),
+            user.username,
+        )
+    except AttachmentTooLargeError as error:
+        return {"status": "error", "message": str(error)}, 413
+
+    await db.attachments.create(attachment)
+
+    return {"status": "success", "attachment": attachment_sendable(attachment)}, 201
+
+
+async def send_attachment(path: str, attachment: dict, content_type: str, etag: str):
+    """
+    Send a stored file. Stored files never change, so they can be cached for
+    good, and their hash is their ETag. Range requests are handled for us,
+    so videos can be skipped through and downloads can be resumed.
+    """
+    inline = is_inline(content_type)
+    response = await send_file(
+        path,
+        mimetype=content_type if inline else "application/octet-stream",
+        as_attachment=not inline,
+        attachment_filename=attachment["filename"],
+        add_etags=False,
+        cache_timeout=365 * 24 * 60 * 60,
+    )
+
+    # The ETag has to be set before the response is made conditional, so
+    # If-None-Match is checked against the hash.
+    response.set_etag(etag)
+    await response.make_conditional(
+        request, accept_ranges=True, complete_length=response.content_length
+    )
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    response.cache_control.immutable = True
+
+    return response
+
+
+@app.route("/api/attachments/<id:attachment_id>", methods=["GET"])
+async def get_attachment(attachment_id: int):
+    """
+    Download an attachment. Anyone with the link can, since images are loaded
+    without a token, which is why attachment IDs can't be guessed.
+    """
+    attachment = await db.attachments.get(attachment_id)
+
+    if attachment is None:
+        return {"status": "error", "message": "Attachment does not exist"}, 404
+
+    return await send_attachment(
+        server.attachments.path_of(attachment["hash"]),
+        attachment,
+        attachment["content_type"],
+        attachment["hash"],
+    )
+
+
+@app.route("/api/attachments/<id:attachment_id>/thumbnail", methods=["GET"])
+async def get_thumbnail(attachment_id: int):
+    """
+    Get a small version of an image attachment, as a JPEG.
+    """
+    attachment = await db.attachments.get(attachment_id)
+
+    if attachment is None or not attachment["thumbnail"]:
+        return {"status": "error", "message": "Thumbnail does not exist"}, 404
+
+    return await send_attachment(
+        server.attachments.thumbnail_path_of(attachment["hash"]),
+        attachment,
+        "image/jpeg",
+        f"{attachment['hash']}-thumbnail",
+    )
+
+
+async def is_admin() -> bool:
+    """
+    Check whether the user making the current request is an admin.
+    """
+    user = await User.get(get_jwt_identity())
+
+    return user is not None and user.has_permission(Permissions.ADMIN)
+
+
+@app.route("/api/admin/metrics", methods=["GET"])
+@jwt_required
+async def metrics():
+    """
+    Get numbers on how the server is doing, such as how far behind clients are.
+    """
+    if not await is_admin():
+        return {"status": "error", "message": "You are not an admin"}, 403
+
+    return {
+        "status": "success",
+        "broadcast": server.broadcaster.stats(),
+        "batching": server.batcher.stats(),
+        "jobs": server.scheduler.stats(),
+        "commands": server.executor.stats(),
+        "queries": db.stats(),
+        "sessions": server.sessions.stats(),
+        "attachments": server.attachments.stats(),
+        "usernames": server.usernames.stats(),
+    }, 200
+
+
+@app.route("/api/admin/profile", methods=["POST"])
+@jwt_required
+async def profile():
+    """
+    Profile the whole server for a number of seconds (the "seconds" query
+    parameter, 10 by default), and get where the time went as folded stacks.
+    Open the file in https://www.speedscope.app, or turn it into a flamegraph
+    with flamegraph.pl.
+
+    curl -X POST -H "Authorization: Bearer <token>" "http://127.0.0.1:5000/api/admin/profile?seconds=30" > server.folded
+    """
+    if not await is_admin():
+        return {"status": "error", "message": "You are not an admin"}, 403
+
+    try:
+        seconds = float(request.args.get("seconds", 10))
+    except ValueError:
+        return {"status": "error", "message": "Invalid number of seconds"}, 400
+
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return {
+            "status": "error",
+            "message": f"Profiles can be up to {PROFILE_MAX_SECONDS} seconds long",
+        }, 400
+
+    try:
+        stacks = await profiler.profile(seconds)
+    except ProfilerBusyError as error:
+        return {"status": "error", "message": str(error)}, 409
+
+    return (
+        stacks,
+        200,
+        {
+            "Content-Type": "text/plain; charset=utf-8",
+            "Content-Disposition": "attachment; filename=server.folded",
+        },
+    )
+
+
+@app.route("/api/admin/plugins/<name>/reload", methods=["POST"])
+@jwt_required
+async def reload_plugin(name: str):
+    """
+    Reload a command plugin from its file, without restarting the server.
+    """
+    if not await is_admin():
+        return {"status": "error", "message": "You are not an admin"}, 403
+
+    try:
+        if not await server.commands.reload(name):
+            return {"status": "error", "message": "Plugin does not exist"}, 404
+    except PluginImportError as error:
+        return {"status": "error", "message": str(error)}, 500
+
+    return {
+        "status": "success",
+        "commands": [
+            command.name for command in server.commands.plugins[name].info.values()
+        ],
+    }, 200
+
+
+@app.route("/api/admin/export", methods=["GET"])
+@jwt_required
+async def export_data():
+    """
+    Stream every row of a table as newline-delimited JSON. The table is picked
+    with the "table" query parameter (users or messages), and "gzip=1" will
+    compress the stream.
+
+    curl -H "Authorization: Bearer <token>" "http://127.0.0.1:5000/api/admin/export?table=messages&gzip=1" > messages.ndjson.gz
+    """
+    if not await is_admin():
+        return {"status": "error", "message": "You are not an admin"}, 403
+
+    table = request.args.get("table", "messages")
+    compress = request.args.get("gzip") in ("1", "true")
+
+    if table not in EXPORT_COLUMNS:
+        return {"status": "error", "message": "Unknown table"}, 400
+
+    filename = f"{table}.ndjson.gz" if compress else f"{table}.ndjson"
+
+    return (
+        ndjson.encode(db.iter_rows(table), compress),
+        200,
+        {
+            "Content-Type": "application/gzip" if compress else "application/x-ndjson",
+            "Content-Disposition": f"attachment; filename={filename}",
+        },
+    )
+
+
+@app.route("/api/admin/import", methods=["POST"])
+@jwt_required
+async def import_data():
+    """
+    Insert rows into a table from a newline-delimited JSON body, in the same
+    format that /api/admin/export produces. Gzip-compressed bodies are detected
+    automatically. Rows that already exist are skipped.
+
+    Send large dumps chunked so the body isn't rejected for being too large:
+    curl -H "Authorization: Bearer <token>" -H "Transfer-Encoding: chunked" -T messages.ndjson.gz "http://127.0.0.1:5000/api/admin/import?table=messages"
+    """
+    if not await is_admin():
+        return {"status": "error", "message": "You are not an admin"}, 403
+
+    table = request.args.get("table", "messages")
+
+    if table not in EXPORT_COLUMNS:
+        return {"status": "error", "message": "Unknown table"}, 400
+
+    try:
+        count = await db.import_rows(table, ndjson.decode(request.body))
+    except ValueError as error:
+        return {"status": "error", "message": str(error)}, 400
+    except zlib.error:
+        return {"status": "error", "message": "Invalid gzip data"}, 400
+    except ConstraintError as error:
+        return {"status": "error", "message": str(error)}, 400
+
+    return {"status": "success", "rows": count}, 200
+
+
 @sio.event
+@traced("socket.connect")
+@handled
 async def connect(sid: str, data: dict, auth: str):
     """
     When a user connects, their session token will be checked. If the
@@ -191,6 +860,12 @@ async def connect(sid: str, data: dict, auth: str):
     # to stop complaining.
     print(data)
 
+    # The server is going down, so tell them when to try again.
+    if server.draining:
+        raise socketio.exceptions.ConnectionRefusedError(
+            {"reconnect_after": server.reconnect_after()}
+        )
+
     # If the auth variable is not a string, disconnect the user.
     # This means the user did not provide a session token.
     if not isinstance(auth, dict):
@@ -212,6 +887,11 @@ async def connect(sid: str, data: dict, auth: str):
         await sio.disconnect(sid)
         return
 
+    # The user logged out or was banned after this token was made.
+    if server.sessions.is_revoked(username, token_generation(decoded_token)):
+        await sio.disconnect(sid)
+        return
+
     user = await User.get(username, sid)
 
     # If the user does not exist, or the user does not have permission to connect,
@@ -220,26 +900,58 @@ async def connect(sid: str, data: dict, auth: str):
         await sio.disconnect(sid)
         return
 
-    # raw_messages: list[dict] = await db.get_messages()  # Get recent messages from the database
-
-    # messages = []
+    # Another server might have revoked the token since we last synced, so
+    # check again with the generation we just read. Anyone already connected
+    # here with the old tokens has to go too.
+    if server.sessions.update(user.username, user.token_generation):
+        await server.disconnect_user(user.username)
 
-    # for message in raw_messages:
-    #     messages.append(
-    #         Message(
-    #             message["message"],
-    #             message["author"],
-    #             message["id"],
-    #             message["channel"],
-    #             message["timestamp"],
-    #             MessageType.NORMAL,
-    #         ).as_sendable()
-    #     )
+    if server.sessions.is_revoked(username, token_generation(decoded_token)):
+        await sio.disconnect(sid)
+        return
 
     # Save the session token to the socketIO session
     await sio.save_session(sid, {"username": user.username})
-    # Send the messages to the user
-    # await sio.emit("previous_messages", messages, to=sid)
+    server.sessions.add(user.username, sid)
+    await sio.enter_room(sid, user_room(user.username))
+    server.broadcaster.add_client(sid)
+    trace("connect", sid, user.username, {"last_seen_id": auth.get("last_seen_id")})
+
+    # Catch the user up on what they missed. Clients that have connected before
+    # tell us the last message they saw in each channel, so we only send them
+    # what's new. Everyone else gets the most recent messages.
+    last_seen = auth.get("last_seen_id")
+    messages = []
+
+    if isinstance(last_seen, dict) and last_seen:
+        for channel, last_id in last_seen.items():
+            # Direct messages are caught up through /api/conversations.
+            if is_dm_channel(str(channel)):
+                continue
+
+            try:
+                missed = await server.missed_messages(str(channel), parse_id(last_id))
+            except (TypeError, ValueError):
+                continue
+
+            # They missed too much to send at once, so they should page through
+            # the history with /api/messages instead.
+            if missed is None:
+                server.broadcaster.publish(
+                    "history_gap", {"channel": channel, "last_seen_id": last_id}, to=sid
+                )
+            else:
+                messages.extend(missed)
+    else:
+        messages = [
+            Message.from_row(row).as_sendable()
+            for row in await db.messages.recent("general", 20)
+        ]
+
+    # Send all of the messages in one go
+    if messages:
+        server.broadcaster.publish("previous_messages", messages, to=sid)
+
     # Send the message through the chat
     await server.send_message(
         MessageResponse(
@@ -257,10 +969,16 @@ async def connect(sid: str, data: dict, auth: str):
 
 
 @sio.event
+@traced("socket.disconnect")
+@handled
 async def disconnect(sid):
     """
     What happens when a user disconnects from the server.
     """
+    await server.broadcaster.remove_client(sid)
+    server.executor.cancel(sid)
+    server.sessions.remove(sid)
+
     session = await sio.get_session(sid)
 
     # if, for some reason, the session is None or the username is not set,
@@ -268,6 +986,12 @@ async def disconnect(sid):
     if session is None or not session.get("username"):
         return
 
+    trace("disconnect", sid, session["username"])
+
+    # Everyone is being disconnected, so nobody is left to tell.
+    if server.draining:
+        return
+
     # Send a message to all users that the user has disconnected.
     await server.send_message(
         MessageResponse(
@@ -282,7 +1006,151 @@ async def disconnect(sid):
     )
 
 
+async def send_error(user: User, content: str) -> None:
+    """
+    Send an error message that only the user can see.
+    """
+    await server.send_message(
+        MessageResponse(
+            user,
+            Context(server, Message(content, author=user)),
+            message=Message(content, author="Server", type=MessageType.ERROR),
+            is_ephemeral=True,
+        )
+    )
+
+
+@sio.event
+@traced("socket.edit")
+@handled
+async def edit(sid, data):
+    """
+    Control when a user edits one of their messages.
+
+    Data example:
+    {
+        "id": "370502957784911872",
+        "message": "The new content"
+    }
+    """
+    session = await sio.get_session(sid)
+
+    if session is None or not session.get("username"):
+        return
+
+    user = await User.get(session["username"], sid)
+
+    if user is None:
+        return
+
+    trace("edit", sid, user.username, data)
+
+    if not isinstance(data, dict) or not isinstance(data.get("message"), str):
+        await send_error(user, "Invalid edit.")
+        return
+
+    try:
+        message_id = parse_id(data.get("id"))
+    except (TypeError, ValueError):
+        await send_error(user, "Invalid edit.")
+        return
+
+    try:
+        await server.edit_message(user, message_id, data["message"])
+    except (ValueError, PermissionDeniedError, MessageNotFoundError) as error:
+        await send_error(user, str(error))
+
+
+@sio.event
+@traced("socket.delete")
+@handled
+async def delete(sid, data):
+    """
+    Control when a user deletes a message.
+
+    Data example:
+    {
+        "id": "370502957784911872"
+    }
+    """
+    session = await sio.get_session(sid)
+
+    if session is None or not session.get("username"):
+        return
+
+    user = await User.get(session["username"], sid)
+
+    if user is None:
+        return
+
+    trace("delete", sid, user.username, data)
+
+    if not isinstance(data, dict):
+        await send_error(user, "Invalid delete.")
+        return
+
+    try:
+        message_id = parse_id(data.get("id"))
+    except (TypeError, ValueError):
+        await send_error(user, "Invalid delete.")
+        return
+
+    try:
+        await server.delete_message(user, message_id)
+    except (ValueError, PermissionDeniedError, MessageNotFoundError) as error:
+        await send_error(user, str(error))
+
+
+@sio.event
+@traced("socket.direct_message")
+@handled
+async def direct_message(sid, data):
+    """
+    Control when a user sends a message to one of their conversations.
+
+    Data example:
+    {
+        "conversation": "370502957784911872",
+        "message": "Hello"
+    }
+    """
+    session = await sio.get_session(sid)
+
+    if session is None or not session.get("username"):
+        return
+
+    user = await User.get(session["username"], sid)
+
+    if user is None:
+        return
+
+    if not isinstance(data, dict) or not isinstance(data.get("message"), str):
+        await send_error(user, "Invalid message.")
+        return
+
+    try:
+        conversation_id = parse_id(data.get("conversation"))
+    except (TypeError, ValueError):
+        await send_error(user, "Invalid message.")
+        return
+
+    try:
+        await server.direct_message(
+            user, conversation_id, data["message"], data.get("attachments") or []
+        )
+    except (ValueError, PermissionDeniedError, ConversationNotFoundError) as error:
+        await send_error(user, str(error))
+        return
+
+    # Conversation IDs mean nothing to a replay, so record who was in it.
+    if recorder is not None:
+        members = await server.conversations.members_of(conversation_id)
+        trace("direct_message", sid, user.username, {**data, "members": list(members)})
+
+
 @sio.event
+@traced("socket.message")
+@handled
 async def message(sid, data):
     """
     Control when a user sends a message.
@@ -292,28 +1160,35 @@ async def message(sid, data):
     print("message from ", session)
     print(data)
 
+    trace("message", sid, session.get("username") if session else None, data)
+
+    # Messages with files attached to them come as
+    # {"message": "Look at this", "attachments": ["370502957784911872"]}
+    attachment_ids = []
+
+    if isinstance(data, dict):
+        attachment_ids = data.get("attachments") or []
+        data = data.get("message", "")
+
+    if not isinstance(data, str):
+        return
+
+    # The content is tokenized once here, and everything after this reuses it.
+    message = Message(content=data, author=None)
+
     # if there is no message data, do nothing.
-    if not data or data.strip() == "":
+    if message.parsed.is_empty and not attachment_ids:
         return
 
-    # Get the current time in hours, minutes, and seconds.
-    # Perhaps the database should store the day the message was
-    # send too, and it should be the client's decision what
-    # to show.
-    context = await Context.from_message(
-        server,
-        Message(
-            content=data,
-            author=await User.get(session["username"], sid),
-        ),
-    )
+    message.author = await User.get(session["username"], sid)
+    context = await Context.from_message(server, message)
 
     # If the user does not exist, do nothing.
     if context.author is None:
         return
 
     # If the user does not have permission to send messages, reject the message.
-    if not context.author.permissions & Permissions.SEND:
+    if not context.author.has_permission(Permissions.SEND):
         await server.send_message(
             MessageResponse(
                 context.author,
@@ -328,14 +1203,14 @@ async def message(sid, data):
         )
         return
 
-    # Enforce the character limit of 1000 characters.
-    if len(context.message.content) > 1000:
+    # Enforce the character limit.
+    if len(context.message.content) > MAX_MESSAGE_LENGTH:
         await server.send_message(
             MessageResponse(
                 context.author,
                 context,
                 Message(
-                    "Your message was too long. Please keep your messages under 1000 characters.",
+                    f"Your message was too long. Please keep your messages under {MAX_MESSAGE_LENGTH} characters.",
                     author="Server",
                     type=MessageType.ERROR,
                 ),
@@ -344,9 +1219,18 @@ async def message(sid, data):
         )
         return
 
+    if attachment_ids:
+        try:
+            message.attachments = await server.find_attachments(
+                context.author, attachment_ids
+            )
+        except ValueError as error:
+            await send_error(context.author, str(error))
+            return
+
     # If the message starts with a colon, it is a command.
     if context.message.content.startswith(COMMAND_PREFIX):
-        if not context.author.permissions & Permissions.COMMANDS:
+        if not context.author.has_permission(Permissions.COMMANDS):
             # Reject the command if the user does not have permission to send commands.
             await server.send_message(
                 MessageResponse(
@@ -390,10 +1274,22 @@ async def message(sid, data):
     await server.user_message(context)
 
 
+async def shutdown_trigger() -> None:
+    """
+    Wait to be told to stop, then start draining. Hypercorn stops listening as
+    soon as this returns, waits for the drain to disconnect everyone, and then
+    runs the shutdown hook.
+    """
+    await listeners.wait_for_signal()
+    server.drain()
+
+
 if __name__ == "__main__":
-    try:
-        asyncio.run(hasync.serve(sio_app, hypercorn_config))
-    except Exception as error:
-        raise error
-    finally:
-        asyncio.run(db.conn.close())
+    # The sockets are only made here, so processes that import this module,
+    # like the thumbnail makers, don't bind them too.
+    hypercorn_config.bind = listeners.binds(BIND, REUSE_PORT)
+
+    # The database is connected and closed by the startup and shutdown hooks.
+    asyncio.run(
+        hasync.serve(sio_app, hypercorn_config, shutdown_trigger=shutdown_trigger)
+    )
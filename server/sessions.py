@@ -0,0 +1,144 @@
+"""
+Keeps track of who is connected, and which of their tokens are still good.
+
+Every connection is indexed both ways, from a username to all of the sockets
+that user is connected with (one for each tab), and from a socket back to its
+user. Sending something to a user only touches their own sockets.
+
+Tokens never expire, so to log someone out, every token they have is revoked at
+once. Each user has a token generation, which is put into every token they're
+given. Revoking their tokens bumps their generation, and any token with an older
+generation is turned away. Checking a token is just a dict lookup, since the
+generations of everyone who's had their tokens revoked are kept in memory.
+
+Other servers sharing the database can revoke tokens too, so the generations are
+loaded again every REVOCATION_SYNC_INTERVAL seconds, and connecting always checks
+the generation in the database.
+"""
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from storage import Storage
+
+
+class SessionStore:
+    """
+    Holds the token generation of every user whose tokens have been revoked,
+    and the socket IDs of every user who is connected.
+
+    Users who have never had their tokens revoked are on generation 0, and
+    aren't kept in memory at all.
+    """
+
+    def __init__(self, db: "Storage") -> None:
+        self.db = db
+        self.generations: dict[str, int] = {}
+        self.sids: dict[str, set[str]] = {}  # Username to their socket IDs
+        self.usernames: dict[str, str] = {}  # Socket ID to its username
+
+    async def load(self) -> list[str]:
+        """
+        Load the token generations from the database. Called once the
+        database has been connected, then every so often to pick up tokens
+        revoked by other servers. Returns who has had tokens revoked since
+        the last time.
+        """
+        revoked = []
+
+        for username, generation in (await self.db.users.token_generations()).items():
+            if self.update(username, generation):
+                revoked.append(username)
+
+        return revoked
+
+    def update(self, username: str, generation: int) -> bool:
+        """
+        Remember a user's generation, as read from the database. Generations
+        only ever go up, so an older one is ignored. Returns whether it was new.
+        """
+        if generation <= self.generations.get(username, 0):
+            return False
+
+        self.generations[username] = generation
+        return True
+
+    def generation(self, username: str) -> int:
+        """
+        Get the generation that new tokens for a user should have.
+        """
+        return self.generations.get(username, 0)
+
+    def is_revoked(self, username: str, generation: int) -> bool:
+        """
+        Check whether a token with this generation has been revoked.
+        """
+        return generation < self.generations.get(username, 0)
+
+    async def revoke(self, username: str) -> int:
+        """
+        Revoke every token a user has, and return the generation their new
+        tokens will have. This doesn't disconnect them.
+        """
+        generation = await self.db.users.revoke_tokens(username)
+        self.update(username, generation)
+
+        return generation
+
+    def add(self, username: str, sid: str) -> None:
+        """
+        Remember that a user is connected with this socket ID.
+        """
+        self.sids.setdefault(username, set()).add(sid)
+        self.usernames[sid] = username
+
+    def remove(self, sid: str) -> str | None:
+        """
+        Forget a socket ID once it has disconnected. Returns the username
+        it belonged to.
+        """
+        username = self.usernames.pop(sid, None)
+        sids = self.sids.get(username)
+
+        if sids is None:
+            return username
+
+        sids.discard(sid)
+
+        if not sids:
+            del self.sids[username]
+
+        return username
+
+    def username_of(self, sid: str) -> str | None:
+        """
+        Get the username of whoever is connected with a socket ID.
+        """
+        return self.usernames.get(sid)
+
+    def is_online(self, username: str) -> bool:
+        """
+        Check whether a user is connected to this server.
+        """
+        return username in self.sids
+
+    def sids_of(self, username: str) -> set[str]:
+        """
+        Get the socket IDs a user is connected with.
+        """
+        return set(self.sids.get(username, ()))
+
+    def stats(self) -> dict:
+        return {
+            "online_users": len(self.sids),
+            "connections": sum(len(sids) for sids in self.sids.values()),
+            "revoked_users": len(self.generations),
+        }
+
+
+def user_room(username: str) -> str:
+    """
+    Get the socket.io room every connection of a user is in. Servers that share
+    a message queue can send to a user through it, wherever they're connected.
+    """
+    return f"user:{username}"
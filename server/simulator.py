@@ -0,0 +1,562 @@
+"""
+Runs the chat server in-process, without Hypercorn or a browser. The socket.io
+event handlers in server.py are driven directly with fake connections, against
+an in-memory database, and everything the server sends is kept so it can be
+looked at afterwards.
+
+On top of that, the simulator can replay traces recorded with TRACE_FILE (or made
+up with the synthesize command) faster than they happened, and reports how long
+the server took to handle and deliver each kind of event:
+
+    python server/simulator.py synthesize trace.ndjson --users 50 --messages 2000
+    python server/simulator.py replay trace.ndjson --speed 10 --max-p99 25
+
+Replays use a simulated clock, so message IDs and timestamps come out the same
+every time the same trace is replayed. With --max-p99 the replay fails if the
+slowest events took too long, so it can be used as a performance check in CI.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+
+from clock import MessageClock
+from snowflake import EPOCH
+from traces import read_trace, write_trace
+
+# server.py refuses to make tokens without a secret.
+os.environ.setdefault("JWT_SECRET", "simulator")
+
+
+class SimulatedClock(MessageClock):
+    """
+    A message clock that only moves when it's told to, plus a microsecond every
+    time it's read, so that making lots of IDs never waits on a real clock.
+    """
+
+    def __init__(self, start: int = EPOCH) -> None:
+        super().__init__()
+        self.micros = start * 1000
+
+    def advance_to(self, ms: float) -> None:
+        """
+        Move the clock forward to a time, in milliseconds since the epoch.
+        """
+        self.micros = max(self.micros, int(ms * 1000))
+
+    def now(self) -> int:
+        self.micros += 1
+        self.last = max(self.last, self.micros // 1000)
+        return self.last
+
+
+class FakePacket:
+    """
+    Stands in for socketio.Packet. Nothing is really sent anywhere, so an
+    encoded event is just the event and its data.
+    """
+
+    def __init__(self, packet_type: int, data: list, namespace: str | None = None):
+        self.data = data
+
+    def encode(self) -> tuple:
+        return tuple(self.data)
+
+
+class FakeSocketServer:
+    """
+    Stands in for socketio.AsyncServer, and for its manager and engine.io
+    server as far as the broadcaster uses them. Events the server emits are
+    kept for each connection instead of being sent anywhere.
+    """
+
+    packet_class = FakePacket
+
+    def __init__(self) -> None:
+        self.handlers: dict[str, object] = {}
+        self.sessions: dict[str, dict] = {}
+        self.rooms: dict[str, set[str]] = defaultdict(set)
+        self.connected: set[str] = set()
+        self.received: dict[str, list[tuple[str, object]]] = defaultdict(list)
+        self.emitted = 0
+        self.manager = self.eio = self
+
+    def on(self, event: str, handler) -> None:
+        self.handlers[event] = handler
+
+    async def emit(
+        self,
+        event: str,
+        data: object = None,
+        to=None,
+        room=None,
+        skip_sid=None,
+        **kwargs,
+    ) -> None:
+        target = to if to is not None else room
+
+        if target is None:
+            sids = set(self.connected)
+        elif target in self.rooms:
+            sids = set(self.rooms[target])
+        else:
+            sids = {target}
+
+        if skip_sid is not None:
+            sids -= {skip_sid} if isinstance(skip_sid, str) else set(skip_sid)
+
+        for sid in sids & self.connected:
+            self.received[sid].append((event, data))
+            self.emitted += 1
+
+    def eio_sid_from_sid(self, sid: str, namespace: str) -> str:
+        return sid
+
+    async def send(self, sid: str, encoded: tuple) -> None:
+        if sid in self.connected:
+            self.received[sid].append(encoded)
+            self.emitted += 1
+
+    async def save_session(self, sid: str, session: dict) -> None:
+        self.sessions[sid] = session
+
+    async def get_session(self, sid: str) -> dict | None:
+        return self.sessions.get(sid)
+
+    async def enter_room(self, sid: str, room: str) -> None:
+        self.rooms[room].add(sid)
+
+    async def leave_room(self, sid: str, room: str) -> None:
+        self.rooms[room].discard(sid)
+
+    async def disconnect(self, sid: str) -> None:
+        """
+        Disconnect a connection, running the server's disconnect handler like
+        socket.io would.
+        """
+        if sid not in self.connected:
+            return
+
+        self.connected.discard(sid)
+        await self.handlers["disconnect"](sid)
+
+        for members in self.rooms.values():
+            members.discard(sid)
+
+        self.sessions.pop(sid, None)
+
+
+class Harness:
+    """
+    A whole chat server, running in-process with fake connections.
+
+        harness = Harness()
+        await harness.start()
+        sid = await harness.connect("alice")
+        await harness.send(sid, "hello")
+        await harness.settle()
+        print(harness.received(sid))
+        await harness.stop()
+    """
+
+    def __init__(self, quiet: bool = True) -> None:
+        self.quiet = quiet  # Hide what the handlers print
+        self.clock = SimulatedClock()
+        self.sio = FakeSocketServer()
+        self.users: set[str] = set()
+        self.next_sid = 0
+
+    async def start(self) -> None:
+        """
+        Swap the fakes into server.py, and start the app.
+        """
+        # Imported here, since importing server.py sets up the whole app.
+        import conversations
+        import database
+        import server as chat
+        from objects import Application
+
+        self.chat = chat
+        self.db = database.Database(":memory:")
+
+        # Everything looks these up when it's called, so swapping them in
+        # is enough to point the whole server at the fakes.
+        database.db = self.db
+        chat.db = self.db
+        chat.sio = self.sio
+        chat.recorder = None
+        self.app = Application(self.db, self.sio, chat.command_register)
+        chat.server = self.app
+        self.sio.on("disconnect", chat.disconnect)
+
+        # Make message and conversation IDs, and so timestamps, from the
+        # simulated clock.
+        for ids in (database.message_ids, conversations.conversation_ids):
+            ids.clock = self.clock
+            ids.last = -1
+
+        await self.app.start()
+
+    async def stop(self) -> None:
+        for sid in list(self.sio.connected):
+            await self.sio.disconnect(sid)
+
+        await self.app.shutdown()
+
+    async def add_user(self, username: str, permissions: int = 71) -> None:
+        """
+        Add a user to the database. Passwords aren't needed, since tokens are
+        made directly, so there's no hashing to wait on.
+        """
+        if username in self.users:
+            return
+
+        await self.db.users.create(
+            {
+                "username": username,
+                "email": f"{username}@simulator.test",
+                "permissions": permissions,
+                "displayname": username,
+                "dob": "2000-01-01",
+            },
+            b"",
+            b"",
+        )
+        self.users.add(username)
+
+    async def connect(self, username: str, last_seen_id: dict | None = None) -> str:
+        """
+        Connect as a user, adding them first if they don't exist. Returns the
+        sid of the new connection.
+        """
+        await self.add_user(username)
+
+        async with self.chat.app.app_context():
+            token = self.chat.create_access_token(
+                identity=username,
+                expires_delta=False,
+                user_claims={"generation": self.app.sessions.generation(username)},
+            )
+
+        self.next_sid += 1
+        sid = f"sim-{self.next_sid}"
+        self.sio.connected.add(sid)
+
+        await self._call(
+            self.chat.connect, sid, {}, {"token": token, "last_seen_id": last_seen_id}
+        )
+
+        return sid
+
+    async def disconnect(self, sid: str) -> None:
+        with self._output():
+            await self.sio.disconnect(sid)
+
+    async def send(self, sid: str, content: str) -> None:
+        await self._call(self.chat.message, sid, content)
+
+    async def direct_message(self, sid: str, members: list[str], content: str) -> None:
+        """
+        Send a direct message to a group of people, starting a conversation
+        with them if there isn't one.
+        """
+        for username in members:
+            await self.add_user(username)
+
+        conversation = await self.app.conversations.open(members)
+        await self._call(
+            self.chat.direct_message,
+            sid,
+            {"conversation": str(conversation["id"]), "message": content},
+        )
+
+    async def edit(self, sid: str, id: str, content: str) -> None:
+        await self._call(self.chat.edit, sid, {"id": id, "message": content})
+
+    async def delete(self, sid: str, id: str) -> None:
+        await self._call(self.chat.delete, sid, {"id": id})
+
+    async def settle(self, timeout: float = 5.0) -> None:
+        """
+        Wait until everything the server queued up has been sent.
+        """
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            # Batched messages are held until their window closes.
+            if any(self.app.batcher.pending.values()):
+                await asyncio.sleep(0.001)
+                continue
+
+            if not any(
+                client.queue.qsize() for client in self.app.broadcaster.clients.values()
+            ):
+                # Give the send loops a chance to finish what they picked up.
+                for _ in range(3):
+                    await asyncio.sleep(0)
+                return
+
+            await asyncio.sleep(0)
+
+    def received(self, sid: str, event: str | None = None) -> list:
+        """
+        Get what a connection has been sent, optionally only one kind of event.
+        """
+        return [
+            data
+            for name, data in self.sio.received[sid]
+            if event is None or name == event
+        ]
+
+    def last_message_of(self, username: str, channel: str = "general") -> str | None:
+        """
+        Get the ID of the last message a user sent to a channel.
+        """
+        for message in reversed(self.app.history.channels.get(channel, ())):
+            author = message["author"]
+
+            if (author["username"] if isinstance(author, dict) else author) == username:
+                return message["id"]
+
+        return None
+
+    async def _call(self, handler, *args) -> None:
+        with self._output():
+            await handler(*args)
+
+    def _output(self):
+        return (
+            contextlib.redirect_stdout(io.StringIO())
+            if self.quiet
+            else contextlib.nullcontext()
+        )
+
+
+async def replay(path: str, speed: float = 1.0) -> dict[str, list[float]]:
+    """
+    Replay a trace against a fresh in-process server. Events are sent speed times
+    faster than they were recorded, or as fast as possible if speed is 0.
+
+    Returns how long each event took, in milliseconds, by the kind of event.
+    Each time covers handling the event and delivering everything it sent.
+    """
+    harness = Harness()
+    await harness.start()
+
+    timings: dict[str, list[float]] = defaultdict(list)
+    sids: dict[str, str] = {}  # Recorded sids to the harness' sids
+    users: dict[str, str] = {}  # Recorded sids to their usernames
+    started = time.perf_counter()
+
+    try:
+        for event in read_trace(path):
+            # Wait until the event is due.
+            if speed:
+                delay = event["t"] / 1000 / speed - (time.perf_counter() - started)
+
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            harness.clock.advance_to(EPOCH + event["t"])
+
+            kind = event["event"]
+            sid = event.get("sid")
+            data = event.get("data")
+            start = time.perf_counter()
+
+            if kind == "connect":
+                last_seen = (data or {}).get("last_seen_id")
+                sids[sid] = await harness.connect(event["user"], last_seen)
+                users[sid] = event["user"]
+            elif sid not in sids:
+                # The connection was made before the recording started.
+                continue
+            elif kind == "disconnect":
+                await harness.disconnect(sids.pop(sid))
+            elif kind == "message":
+                await harness.send(sids[sid], data)
+            elif kind == "direct_message":
+                await harness.direct_message(
+                    sids[sid], data["members"], data["message"]
+                )
+            elif kind in ("edit", "delete"):
+                # Recorded IDs don't exist in the replay, so act on the user's
+                # last message instead.
+                id = harness.last_message_of(users[sid])
+
+                if id is None:
+                    continue
+
+                if kind == "edit":
+                    await harness.edit(sids[sid], id, data.get("message", ""))
+                else:
+                    await harness.delete(sids[sid], id)
+            else:
+                continue
+
+            await harness.settle()
+            timings[kind].append((time.perf_counter() - start) * 1000)
+    finally:
+        await harness.stop()
+
+    return timings
+
+
+def synthesize(users: int, messages: int, rate: float, seed: int = 0) -> list[dict]:
+    """
+    Make up a trace of users connecting, chatting at rate messages a second,
+    mentioning and messaging each other, and leaving. The same seed always makes
+    the same trace.
+    """
+    rng = random.Random(seed)
+    names = [f"user{i}" for i in range(users)]
+    words = ["hello", "there", "how", "is", "everyone", "doing", "today", "lol"]
+    events = []
+    t = 0.0
+
+    for i, name in enumerate(names):
+        events.append(
+            {"t": t, "event": "connect", "sid": f"s{i}", "user": name, "data": {}}
+        )
+        t += rng.uniform(1, 20)
+
+    for _ in range(messages):
+        t += rng.expovariate(rate) * 1000
+        i = rng.randrange(users)
+        content = " ".join(rng.choices(words, k=rng.randint(1, 20)))
+        roll = rng.random()
+
+        if roll < 0.05:
+            content += f" @{rng.choice(names)}"
+        elif roll < 0.07:
+            content = "~help"
+
+        if roll > 0.97 and users > 1:
+            other = rng.choice([name for name in names if name != names[i]])
+            events.append(
+                {
+                    "t": round(t, 3),
+                    "event": "direct_message",
+                    "sid": f"s{i}",
+                    "user": names[i],
+                    "data": {"message": content, "members": [names[i], other]},
+                }
+            )
+        elif 0.95 < roll <= 0.96:
+            events.append(
+                {
+                    "t": round(t, 3),
+                    "event": "edit",
+                    "sid": f"s{i}",
+                    "user": names[i],
+                    "data": {"message": content},
+                }
+            )
+        else:
+            events.append(
+                {
+                    "t": round(t, 3),
+                    "event": "message",
+                    "sid": f"s{i}",
+                    "user": names[i],
+                    "data": content,
+                }
+            )
+
+    for i, name in enumerate(names):
+        t += rng.uniform(1, 20)
+        events.append(
+            {"t": round(t, 3), "event": "disconnect", "sid": f"s{i}", "user": name}
+        )
+
+    return events
+
+
+def summarize(timings: dict[str, list[float]]) -> dict[str, dict]:
+    """
+    Get the count and percentiles of each kind of event's timings.
+    """
+    summary = {}
+
+    for kind, times in timings.items():
+        times = sorted(times)
+        # Inclusive percentiles stay within what was measured. The default
+        # guesses past the slowest event when there are only a few of them.
+        quantiles = (
+            statistics.quantiles(times, n=100, method="inclusive")
+            if len(times) > 1
+            else times * 99
+        )
+
+        summary[kind] = {
+            "count": len(times),
+            "p50": quantiles[49],
+            "p95": quantiles[94],
+            "p99": quantiles[98],
+            "max": times[-1],
+        }
+
+    return summary
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    synth = commands.add_parser("synthesize", help="Make up a trace")
+    synth.add_argument("path")
+    synth.add_argument("--users", type=int, default=20)
+    synth.add_argument("--messages", type=int, default=1000)
+    synth.add_argument("--rate", type=float, default=50, help="Messages a second")
+    synth.add_argument("--seed", type=int, default=0)
+
+    play = commands.add_parser("replay", help="Replay a trace")
+    play.add_argument("path")
+    play.add_argument(
+        "--speed", type=float, default=1.0, help="0 replays as fast as possible"
+    )
+    play.add_argument(
+        "--max-p99", type=float, help="Fail if any event's p99 is over this many ms"
+    )
+    play.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    args = parser.parse_args()
+
+    if args.command == "synthesize":
+        count = write_trace(
+            args.path, synthesize(args.users, args.messages, args.rate, args.seed)
+        )
+        print(f"Wrote {count} events to {args.path}")
+        return 0
+
+    summary = summarize(asyncio.run(replay(args.path, args.speed)))
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        for kind, stats in summary.items():
+            print(
+                f"{kind}: {stats['count']} events, p50 {stats['p50']:.2f}ms, "
+                f"p95 {stats['p95']:.2f}ms, p99 {stats['p99']:.2f}ms, max {stats['max']:.2f}ms"
+            )
+
+    if args.max_p99 is not None:
+        slow = [kind for kind, stats in summary.items() if stats["p99"] > args.max_p99]
+
+        if slow:
+            print(f"p99 over {args.max_p99}ms for: {', '.join(slow)}")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Snowflake IDs are 64-bit message IDs that are made in memory, instead of by the
+database. Each one is made of the time it was made at, the ID of the worker that
+made it, and a sequence number, so sorting IDs sorts messages by when they were sent,
+and several servers can make IDs at once without ever making the same one.
+
+ 63 bits: | 41 bits of milliseconds since EPOCH | 10 bits of worker ID | 12 bits of sequence |
+"""
+
+from clock import MessageClock, clock
+
+# 2024-01-01 00:00:00 UTC, in milliseconds. IDs run out 69 years after this.
+EPOCH = 1704067200000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+class SnowflakeGenerator:
+    """
+    Makes snowflake IDs for one worker. Up to 4096 IDs can be made every millisecond,
+    after which the IDs get ahead of the clock, by a millisecond for every 4096
+    more.
+    """
+
+    def __init__(self, worker_id: int, clock: MessageClock = clock):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"The worker ID has to be between 0 and {MAX_WORKER_ID}.")
+
+        self.worker_id = worker_id
+        self.clock = clock
+        self.last = -1
+        self.sequence = 0
+
+    def next_id(self) -> int:
+        """
+        Make a new ID.
+        """
+        # This runs on the event loop, so it never waits for the clock. If the
+        # clock is behind the last ID, that ID's millisecond is used again.
+        now = max(self.clock.now(), self.last)
+
+        if now == self.last:
+            self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+
+            # We've used up every ID for this millisecond, so borrow the next
+            # one, and let the clock catch up.
+            if self.sequence == 0:
+                now = self.last + 1
+        else:
+            self.sequence = 0
+
+        self.last = now
+
+        return (
+            (now - EPOCH) << TIMESTAMP_SHIFT
+            | self.worker_id << SEQUENCE_BITS
+            | self.sequence
+        )
+
+
+def timestamp_of(id: int) -> int:
+    """
+    Get the time an ID was made at, in milliseconds since the Unix epoch.
+    """
+    return (id >> TIMESTAMP_SHIFT) + EPOCH
+
+
+def parse_id(value: object) -> int:
+    """
+    Turn an ID a client sent into an int. IDs are stored as signed 64-bit
+    integers, so anything that can't be one raises ValueError, just like text
+    that isn't a number does.
+    """
+    id = int(value)
+
+    if not 0 <= id < 2**63:
+        raise ValueError(f"{id} isn't a valid ID.")
+
+    return id
@@ -0,0 +1,200 @@
+"""
+Tracing spans show where the time went while the server handled something. Every
+socket.io event and HTTP request starts a trace, and the work done for it, such
+as database statements, commands and sending events, is timed as spans nested
+inside it.
+
+Spans are only recorded when SPANS_FILE is set. They're written in the Chrome
+trace event format, which chrome://tracing, https://ui.perfetto.dev and
+speedscope can all open, with each trace on its own row.
+"""
+
+import functools
+import itertools
+import json
+import os
+import time
+from contextvars import ContextVar
+from typing import TextIO
+
+from config import SPANS_FILE
+
+# The span that whatever is running right now belongs to.
+current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+
+trace_ids = itertools.count(1)
+span_ids = itertools.count(1)
+
+
+class SpanExporter:
+    """
+    Writes finished spans to a file as they end. The file is a JSON array that
+    is never closed, which trace viewers are fine with, so nothing is lost if
+    the server dies.
+
+    The file is only opened once there's a span to write, so processes that
+    import the server without running it, such as the thumbnail processes,
+    don't wipe it.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file: TextIO | None = None
+        self.pid = os.getpid()
+        self.exported = 0
+
+    def export(self, span: "Span", end: int) -> None:
+        if self.file is None:
+            self.file = open(self.path, "w", encoding="utf-8")
+            self.file.write("[\n")
+
+        event = {
+            "name": span.name,
+            "cat": span.name.split(".", 1)[0],
+            "ph": "X",
+            "ts": span.start // 1000,  # Microseconds
+            "dur": (end - span.start) / 1000,
+            "pid": self.pid,
+            "tid": span.trace_id,
+            "args": {
+                "span_id": span.id,
+                "parent_id": span.parent_id,
+                **span.attributes,
+            },
+        }
+        self.file.write(json.dumps(event, default=str) + ",\n")
+        self.exported += 1
+
+        # Only flush at the end of a trace, so busy traces don't write for every span.
+        if span.parent_id is None:
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+
+exporter = SpanExporter(SPANS_FILE) if SPANS_FILE else None
+
+
+class Span:
+    """
+    Times the code inside it. Spans started inside another one, even in tasks it
+    starts, become its children.
+    """
+
+    __slots__ = (
+        "name",
+        "attributes",
+        "root",
+        "parent",
+        "trace_id",
+        "id",
+        "parent_id",
+        "start",
+        "token",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        attributes: dict,
+        root: bool = False,
+        parent: "Span | None" = None,
+    ) -> None:
+        self.name = name
+        self.attributes = attributes
+        self.root = root
+        self.parent = parent
+
+    def set(self, key: str, value: object) -> None:
+        """
+        Attach something to the span, such as the status of a response.
+        """
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        parent = None if self.root else self.parent or current_span.get()
+
+        self.trace_id = next(trace_ids) if parent is None else parent.trace_id
+        self.parent_id = None if parent is None else parent.id
+        self.id = next(span_ids)
+        self.token = current_span.set(self)
+        self.start = time.perf_counter_ns()
+
+        return self
+
+    def __exit__(self, kind, error, traceback) -> None:
+        end = time.perf_counter_ns()
+
+        try:
+            current_span.reset(self.token)
+        except ValueError:
+            # The span was ended from somewhere else than where it started.
+            pass
+
+        if error is not None:
+            self.attributes["error"] = repr(error)
+
+        if exporter is not None:
+            exporter.export(self, end)
+
+
+class NoSpan:
+    """
+    What span gives back when spans aren't being recorded, so timing something
+    costs next to nothing.
+    """
+
+    __slots__ = ()
+
+    def set(self, key: str, value: object) -> None:
+        pass
+
+    def __enter__(self) -> "NoSpan":
+        return self
+
+    def __exit__(self, kind, error, traceback) -> None:
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(
+    name: str, root: bool = False, parent: Span | None = None, **attributes
+) -> Span | NoSpan:
+    """
+    Time a block of code. Use it with "with". Root spans start a new trace
+    instead of joining the one that's running, and giving a parent joins its
+    trace instead, for work that was handed off to somewhere else.
+
+        with span("db.messages.insert", channel=channel):
+            ...
+    """
+    if exporter is None:
+        return NO_SPAN
+
+    return Span(name, attributes, root, parent)
+
+
+def traced(name: str):
+    """
+    Start a new trace every time an async function is called, such as a
+    socket.io event handler.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with span(name, root=True):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def close() -> None:
+    if exporter is not None:
+        exporter.close()
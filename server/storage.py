@@ -0,0 +1,358 @@
+"""
+The storage interface. User, Message and MessageResponse never talk to a database
+directly; they go through one of these repositories instead, so the database
+behind them can be swapped out. SQLite (database.Database) is the default, and
+PostgreSQL (postgres.PostgresStorage) can be used when one writer isn't enough.
+"""
+
+from abc import ABC, abstractmethod
+from typing import AsyncIterable, AsyncIterator
+
+from errors import ConstraintError
+
+# The columns of each table that can be exported and imported, in the
+# order they are written out. Only these tables can be exported.
+EXPORT_COLUMNS: dict[str, tuple[str, ...]] = {
+    "users": (
+        "email",
+        "username",
+        "password",
+        "password_salt",
+        "displayname",
+        "dob",
+        "session",
+        "creation_date",
+        "permissions",
+    ),
+    "messages": (
+        "id",
+        "message",
+        "author",
+        "channel",
+        "created_at",
+        "revision",
+        "deleted",
+        "attachments",
+    ),
+    "conversations": ("id", "members", "created_at"),
+    "conversation_members": ("conversation_id", "username", "unread", "last_read_id"),
+    "attachments": (
+        "id",
+        "hash",
+        "filename",
+        "content_type",
+        "size",
+        "uploader",
+        "created_at",
+        "thumbnail",
+    ),
+}
+
+# Columns that bcrypt hands us as bytes. JSON can't hold bytes, so these
+# are decoded on export and encoded again on import.
+BINARY_COLUMNS: dict[str, tuple[str, ...]] = {
+    "users": ("password", "password_salt"),
+    "messages": (),
+    "conversations": (),
+    "conversation_members": (),
+    "attachments": (),
+}
+
+# What makes a row the same as one that's already there. Imported rows that
+# clash on these are skipped, and any other problem stops the import.
+CONFLICT_KEYS: dict[str, tuple[str, ...]] = {
+    "users": ("username",),
+    "messages": ("id",),
+    "conversations": ("id",),
+    "conversation_members": ("username", "conversation_id"),
+    "attachments": ("id",),
+}
+
+
+def import_values(table: str, row: dict, number: int) -> tuple:
+    """
+    Get the values of an imported row, in the order of EXPORT_COLUMNS, with
+    binary columns encoded again. Raises ValueError for anything a column
+    can't hold, like an object or a number too big for 64 bits, rather than
+    letting the database driver fail on it.
+    """
+    values = []
+
+    for column in EXPORT_COLUMNS[table]:
+        value = row.get(column)
+
+        if column in BINARY_COLUMNS[table] and isinstance(value, str):
+            value = value.encode("utf-8")
+
+        if not isinstance(value, (str, int, float, bytes, type(None))):
+            raise ValueError(
+                f"Row {number}: {column} has to be a string, number or null."
+            )
+
+        if isinstance(value, int) and not -(2**63) <= value < 2**63:
+            raise ValueError(f"Row {number}: {column} is too big.")
+
+        values.append(value)
+
+    return tuple(values)
+
+
+def user_taken_error(detail: str) -> ConstraintError:
+    """
+    Turn a clash with another user into an error saying what was taken. Both
+    usernames and emails are unique, and detail is whatever the database said
+    about the clash, which names the column or index.
+    """
+    if "email" in detail:
+        return ConstraintError("That email is already in use.", "email")
+
+    return ConstraintError("That username is taken.", "username")
+
+
+class UserRepository(ABC):
+    """
+    Stores users. Users are handed around as dicts of their columns, without
+    their password or salt, which have to be asked for separately.
+    """
+
+    @abstractmethod
+    async def get(self, username: str) -> dict | None:
+        """
+        Get a user by their username.
+        """
+
+    @abstractmethod
+    async def get_by_session(self, session: str) -> str | None:
+        """
+        Get the username of the user with a session token.
+        """
+
+    @abstractmethod
+    async def get_password(self, username: str) -> bytes | None:
+        """
+        Get a user's hashed password.
+        """
+
+    @abstractmethod
+    async def create(self, user: dict, password: bytes, salt: bytes) -> None:
+        """
+        Add a new user. The user dict holds their username, email,
+        permissions, displayname and dob. Raises ConstraintError if the
+        username or email is taken.
+        """
+
+    @abstractmethod
+    async def update(self, username: str, user: dict) -> None:
+        """
+        Save changes to a user. The user dict holds the same fields as in create.
+        Raises ConstraintError if they're given a username or email that's taken.
+        """
+
+    @abstractmethod
+    async def usernames(self) -> list[str]:
+        """
+        Get the username of every user.
+        """
+
+    @abstractmethod
+    async def username_taken(self, username: str) -> bool:
+        """
+        Check whether someone already has a username.
+        """
+
+    @abstractmethod
+    async def email_taken(self, email: str) -> bool:
+        """
+        Check whether someone already signed up with an email address.
+        """
+
+    @abstractmethod
+    async def set_session(self, username: str, session: str) -> None:
+        """
+        Change a user's session token.
+        """
+
+    @abstractmethod
+    async def token_generations(self) -> dict[str, int]:
+        """
+        Get the token generation of every user whose tokens have been revoked.
+        """
+
+    @abstractmethod
+    async def revoke_tokens(self, username: str) -> int:
+        """
+        Bump a user's token generation, revoking every token they have.
+        Returns their new generation.
+        """
+
+
+class MessageRepository(ABC):
+    """
+    Stores messages. Messages are handed around as dicts of their columns.
+    """
+
+    @abstractmethod
+    async def get(self, id: int) -> dict | None:
+        """
+        Get a message by its ID. Deleted messages are not returned.
+        """
+
+    @abstractmethod
+    async def insert(self, message: dict) -> None:
+        """
+        Save a new message. The message dict holds its id, message, author,
+        channel and created_at, and attachments if it has any, as a JSON list.
+        """
+
+    @abstractmethod
+    async def edit(self, id: int, content: str, revision: int) -> None:
+        """
+        Change the content of a message.
+        """
+
+    @abstractmethod
+    async def delete(self, id: int) -> None:
+        """
+        Delete a message, leaving a tombstone behind.
+        """
+
+    @abstractmethod
+    async def recent(
+        self, channel: str, amount: int, before: int | None = None
+    ) -> list[dict]:
+        """
+        Get the most recent messages in a channel, oldest first. If before is
+        given, only messages older than that ID are returned.
+        """
+
+    @abstractmethod
+    async def after(self, channel: str, after: int, amount: int) -> list[dict]:
+        """
+        Get the first messages in a channel that were sent after the given ID.
+        """
+
+
+class ConversationRepository(ABC):
+    """
+    Stores direct message conversations and who is in them. A conversation's
+    members never change, and are kept on the conversation as a key, which is
+    their sorted usernames as a JSON list. That way each group of people only
+    ever has one conversation.
+
+    Every member has an unread counter, which is bumped as messages are sent
+    instead of being counted when someone asks for it.
+    """
+
+    @abstractmethod
+    async def get(self, id: int) -> dict | None:
+        """
+        Get a conversation by its ID.
+        """
+
+    @abstractmethod
+    async def find(self, members: str) -> dict | None:
+        """
+        Get the conversation between exactly these members, by their key.
+        """
+
+    @abstractmethod
+    async def create(self, conversation: dict, usernames: list[str]) -> None:
+        """
+        Add a new conversation. The conversation dict holds its id, members
+        and created_at, and usernames are who to add to it. Raises
+        ConstraintError if these members already have a conversation.
+        """
+
+    @abstractmethod
+    async def for_user(self, username: str) -> list[dict]:
+        """
+        Get every conversation a user is in, with their unread count and the
+        last message they read, newest conversations first.
+        """
+
+    @abstractmethod
+    async def mark_unread(self, id: int, author: str) -> None:
+        """
+        Count a new message as unread for every member but its author.
+        """
+
+    @abstractmethod
+    async def mark_read(
+        self, id: int, channel: str, username: str, last_read_id: int
+    ) -> None:
+        """
+        Mark every message up to last_read_id as read for a member. Their
+        unread count is counted again from the conversation's channel, so
+        anything sent after last_read_id is still unread.
+        """
+
+
+class AttachmentRepository(ABC):
+    """
+    Stores what's known about uploaded files. The files themselves are kept on
+    disk, named by the hash of their content, so the same file uploaded twice
+    has two rows but is only stored once.
+    """
+
+    @abstractmethod
+    async def get(self, id: int) -> dict | None:
+        """
+        Get an attachment by its ID.
+        """
+
+    @abstractmethod
+    async def create(self, attachment: dict) -> None:
+        """
+        Add a new attachment. The attachment dict holds its id, hash, filename,
+        content_type, size, uploader, created_at and whether it has a thumbnail.
+        """
+
+
+class Storage(ABC):
+    """
+    A database the app can keep its data in.
+    """
+
+    users: UserRepository
+    messages: MessageRepository
+    conversations: ConversationRepository
+    attachments: AttachmentRepository
+
+    @abstractmethod
+    async def connect(self) -> None:
+        """
+        Connect to the database, and create the tables if they don't exist.
+        """
+
+    @abstractmethod
+    async def close(self) -> None:
+        """
+        Close the connection to the database.
+        """
+
+    @abstractmethod
+    def iter_rows(self, table: str, batch_size: int = 1000) -> AsyncIterator[dict]:
+        """
+        Iterate over every row in a table, without holding the whole table in
+        memory. Binary columns are decoded into strings.
+        """
+
+    @abstractmethod
+    async def import_rows(
+        self,
+        table: str,
+        rows: AsyncIterable[dict],
+        batch_size: int = 1000,
+    ) -> int:
+        """
+        Insert rows into a table in batches, skipping rows that already exist.
+        Either every other row is inserted, or none are. Raises ValueError for
+        values a column can't hold. Returns the number of rows that were
+        inserted.
+        """
+
+    def stats(self) -> dict:
+        """
+        Get numbers on the queries that have been run, if the backend keeps any.
+        """
+        return {}
@@ -0,0 +1,112 @@
+"""
+Breaks a message's content into the parts the server cares about, in one pass:
+the command and its arguments, who was mentioned, any links, and the markup
+clients show. Messages keep what this finds, so nothing has to split the
+content again.
+"""
+
+import html
+import re
+from dataclasses import dataclass
+
+from config import COMMAND_PREFIX
+
+# The only parts of a message that need more than escaping are mentions, links
+# and line breaks. Each starts with fixed text, so the regex engine can jump
+# straight to them, which is a lot faster than trying a combined pattern at
+# every character.
+MENTION = re.compile(r"@(\S+)")
+LINK = re.compile(r"https?://[^\s<>\"']+")
+NEWLINE = re.compile(r"\r?\n")
+# Punctuation that ends a sentence rather than a username or link.
+TRAILING = ".,!?:;)'\""
+
+
+@dataclass(slots=True, frozen=True)
+class ParsedMessage:
+    """
+    Everything the tokenizer found in a message. The markup is the message as
+    HTML that's safe to show, with links and mentions picked out.
+    """
+
+    command: str | None  # The command's name, without the prefix
+    args: tuple[str, ...]  # Every word after the command's name
+    mentions: tuple[str, ...]  # Usernames that were mentioned, once each
+    links: tuple[str, ...]
+    markup: str
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.markup
+
+
+def tokenize(content: str, prefix: str = COMMAND_PREFIX) -> ParsedMessage:
+    """
+    Parse a message's content. Mentions, links and line breaks are found first,
+    then the markup is built in one pass over them, escaping the plain text
+    between them a chunk at a time. Only commands are split into words, to get
+    their arguments.
+    """
+    content = content.strip()
+    command = None
+    args = ()
+
+    if content.startswith(prefix):
+        words = content.split()
+        command = words[0][len(prefix) :]
+        args = tuple(words[1:])
+
+    # Most messages are only text, which just needs escaping.
+    if "@" not in content and "http" not in content and "\n" not in content:
+        return ParsedMessage(command, args, (), (), html.escape(content))
+
+    specials = []
+
+    for kind, pattern in (("mention", MENTION), ("link", LINK), ("newline", NEWLINE)):
+        for match in pattern.finditer(content):
+            start = match.start()
+
+            # Mentions and links only count at the start of a word.
+            if kind == "newline" or not start or content[start - 1].isspace():
+                specials.append((start, kind, match))
+
+    specials.sort(key=lambda special: special[0])
+
+    mentions = {}  # A dict keeps them in order, but only once each
+    links = []
+    markup = []
+    last = 0
+
+    for start, kind, match in specials:
+        markup.append(html.escape(content[last:start]))
+        last = match.end()
+
+        if kind == "newline":
+            markup.append("<br/>")
+            continue
+
+        word = match.group(1) if kind == "mention" else match.group()
+        name = word.rstrip(TRAILING)
+        rest = html.escape(word[len(name) :])
+
+        if not name:
+            markup.append(html.escape(match.group()))
+        elif kind == "mention":
+            mentions[name] = None
+            markup.append(f'<span class="mention">@{html.escape(name)}</span>{rest}')
+        else:
+            links.append(name)
+            escaped = html.escape(name)
+            markup.append(
+                f'<a href="{escaped}" target="_blank" rel="noopener noreferrer">{escaped}</a>{rest}'
+            )
+
+    markup.append(html.escape(content[last:]))
+
+    return ParsedMessage(
+        command=command,
+        args=args,
+        mentions=tuple(mentions),
+        links=tuple(links),
+        markup="".join(markup),
+    )
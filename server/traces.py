@@ -0,0 +1,79 @@
+"""
+Event traces are recordings of what clients sent the server, one JSON object per
+line, each with the milliseconds since the recording started. The simulator can
+replay them against an in-memory server to reproduce how a busy period went.
+
+Tokens are never recorded, only who a connection belonged to. Message content is,
+so traces should be treated like the database itself.
+"""
+
+import json
+import time
+from typing import Iterable, Iterator, TextIO
+
+
+class TraceRecorder:
+    """
+    Writes every event it's given to a trace file, as it happens.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file: TextIO = open(path, "a", encoding="utf-8", buffering=1)
+        self.start = time.monotonic()
+        self.recorded = 0
+
+    def record(
+        self, event: str, sid: str, user: str | None = None, data: object = None
+    ) -> None:
+        """
+        Record that a client sent an event.
+        """
+        offset = round((time.monotonic() - self.start) * 1000, 3)
+        self.file.write(
+            json.dumps(
+                {"t": offset, "event": event, "sid": sid, "user": user, "data": data}
+            )
+            + "\n"
+        )
+        self.recorded += 1
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_trace(path: str) -> Iterator[dict]:
+    """
+    Read the events in a trace file, in the order they were recorded.
+    """
+    with open(path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError as error:
+                raise ValueError(
+                    f"Line {line_number} is not valid JSON: {error}"
+                ) from error
+
+            if not isinstance(event, dict) or "event" not in event or "t" not in event:
+                raise ValueError(f"Line {line_number} is not a trace event")
+
+            yield event
+
+
+def write_trace(path: str, events: Iterable[dict]) -> int:
+    """
+    Write a whole trace at once, such as one made up by the simulator.
+    Returns how many events were written.
+    """
+    count = 0
+
+    with open(path, "w", encoding="utf-8") as file:
+        for event in events:
+            file.write(json.dumps(event) + "\n")
+            count += 1
+
+    return count
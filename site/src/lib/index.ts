@@ -8,11 +8,22 @@ export interface user {
     creation_date: string;
 }
 
+export interface attachment {
+    id: string;
+    filename: string;
+    content_type: string;
+    size: number;
+    thumbnail: boolean;
+}
+
 export interface message { 
-    id: Number;
+    id: string;
     message: string;
+    markup: string;
+    attachments?: attachment[];
     author: user | string;
-    timestamp: string;
+    timestamp: number;
     type: Number;
+    revision: Number;
     ephemeral: boolean;
 }
\ No newline at end of file